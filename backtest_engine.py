@@ -0,0 +1,190 @@
+from datetime import timedelta
+import heapq
+import time
+
+from qc_interface import Slice, OptionSecurityObject
+from data_sources import EventKind, synthetic_sources
+
+
+def _seek(events, time):
+    """
+    Next event of a source at or after time. Seeking generators jump straight
+    to it, see DataSource, other iterators are read through
+    :return: event, None when the source is exhausted
+    """
+    try:
+        send = getattr(events, 'send', None)
+        event = send(time) if send is not None else next(events)
+        while event[0] < time:
+            event = next(events)
+        return event
+    except StopIteration:
+        return None
+
+
+class RunStatistics(object):
+
+    def __init__(self):
+        self.events = 0 # market events consumed from the sources
+        self.slices = 0 # OnData dispatches
+        self.warm_up_slices = 0
+        self.elapsed = 0.0 # wall clock seconds
+
+    def EventsPerSecond(self):
+        return self.events / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "{} events, {} slices ({} warm up) in {:.3f}s, {:.0f} events/sec".format(
+            self.events, self.slices, self.warm_up_slices, self.elapsed, self.EventsPerSecond())
+
+
+class BacktestEngine(object):
+    """
+    Local event driven backtest of a QCAlgorithm. Events from every DataSource
+    are merged in time order through a heap holding the next event of each
+    source. Events sharing a timestamp are grouped into one Slice, the
+    algorithm clock is advanced to it, the portfolio is marked against it and
+    OnData is called. Data before the
+    start date is replayed with IsWarmingUp set. OnEndOfDay is called for each
+    equity symbol when the date changes and OnEndOfAlgorithm at the end.
+    When the algorithm sets a data schedule (QCAlgorithm.SetDataSchedule) the
+    sources are advanced straight to the next time it asks for, so slices it
+    would ignore are never built or dispatched.
+    """
+
+    def __init__(self, algorithm, sources=None, seed=0, end=None, restore_from=None, save_to=None):
+        """
+        :param algorithm: QCAlgorithm instance, Initialize is called by Run
+        :param sources: list of DataSource, or fn(algorithm, start, end) returning one
+                        which is called after Initialize. Defaults to synthetic data for
+                        every security the algorithm adds
+        :param seed: seed for the default synthetic sources
+        :param end: datetime to stop at instead of the algorithm's end date
+        :param restore_from: QCAlgorithm.SaveState snapshot to resume from. The run
+                             starts right after the snapshot time without warming up
+        :param save_to: path to write a snapshot to after the last slice
+        """
+        self.algorithm = algorithm
+        self.sources = sources
+        self.seed = seed
+        self.end = end
+        self.restore_from = restore_from
+        self.save_to = save_to
+        self.statistics = RunStatistics()
+
+    def WarmUpStart(self):
+        """
+        Start of the warm up, warm_up_length weekdays before the start date
+        :return: datetime
+        """
+        algorithm = self.algorithm
+        start = algorithm.start_date
+        remaining = algorithm.warm_up_length
+        while remaining > 0:
+            start -= timedelta(days=1)
+            if start.weekday() < 5:
+                remaining -= 1
+        return start
+
+    def _EquitySymbols(self):
+        symbols = []
+        for security in self.algorithm.Securities:
+            if not isinstance(security, OptionSecurityObject) and security.symbol not in symbols:
+                symbols.append(security.symbol)
+        return symbols
+
+    def Run(self):
+        """
+        Runs the algorithm from its warm up start to its end date
+        :return: RunStatistics
+        """
+        algorithm = self.algorithm
+        algorithm.Initialize()
+        algorithm.WrapProfiledStages()
+        if self.restore_from is not None:
+            # slices up to the snapshot were dispatched by the run that saved it
+            start = algorithm.RestoreState(self.restore_from) + timedelta(seconds=1)
+        else:
+            start = self.WarmUpStart()
+        end = self.end or algorithm.end_date
+        algorithm.IsWarmingUp = start < algorithm.start_date
+        if self.sources is None:
+            # paths start at the warm up start even when resuming, so a resumed run
+            # sees the prices of the run it continues
+            self.sources = synthetic_sources(algorithm, self.WarmUpStart(), end, seed=self.seed)
+        elif callable(self.sources):
+            self.sources = self.sources(algorithm, start, end)
+        equity_symbols = self._EquitySymbols()
+        stats = self.statistics
+
+        # heap entries are (time, kind, source index, event, iterator). The source
+        # index is unique in the heap so events themselves are never compared
+        heap = []
+        for i, source in enumerate(self.sources):
+            events = iter(source.Events(start, end))
+            for event in events:
+                heap.append((event[0], event[1], i, event, events))
+                break
+        heapq.heapify(heap)
+        schedule = algorithm.data_schedule
+
+        wall_start = time.time()
+        curr_date = None
+        while heap:
+            if schedule is not None:
+                skip_to = schedule.next_time(heap[0][0])
+                if skip_to is None:
+                    break
+                while heap and heap[0][0] < skip_to:
+                    _, _, i, _, events = heap[0]
+                    event = _seek(events, skip_to)
+                    if event is None:
+                        heapq.heappop(heap)
+                    else:
+                        heapq.heapreplace(heap, (event[0], event[1], i, event, events))
+                if not heap:
+                    break
+            slice_time = heap[0][0]
+            slice = Slice()
+            slice.Time = slice_time
+            while heap and heap[0][0] == slice_time:
+                _, _, i, event, events = heap[0]
+                _, kind, symbol, data = event
+                if kind == EventKind.BAR:
+                    slice.Bars[symbol] = data
+                else:
+                    slice.OptionChains.append(data)
+                stats.events += 1
+                for event in events:
+                    heapq.heapreplace(heap, (event[0], event[1], i, event, events))
+                    break
+                else:
+                    heapq.heappop(heap)
+
+            if curr_date is not None and slice_time.date() != curr_date and not algorithm.IsWarmingUp:
+                for symbol in equity_symbols:
+                    algorithm.OnEndOfDay(symbol)
+            curr_date = slice_time.date()
+            if algorithm.IsWarmingUp and slice_time >= algorithm.start_date:
+                algorithm.IsWarmingUp = False
+            algorithm.Time = slice_time
+            algorithm.CurrentSlice = slice
+            algorithm.MarkPortfolio(slice)
+            algorithm.OnData(slice)
+            stats.slices += 1
+            if algorithm.IsWarmingUp:
+                stats.warm_up_slices += 1
+
+        if curr_date is not None and not algorithm.IsWarmingUp:
+            for symbol in equity_symbols:
+                algorithm.OnEndOfDay(symbol)
+        algorithm.IsWarmingUp = False
+        if self.save_to is not None:
+            algorithm.SaveState(self.save_to)
+        algorithm.OnEndOfAlgorithm()
+        stats.elapsed = time.time() - wall_start
+        algorithm.Debug("Backtest finished: {}".format(stats))
+        algorithm.Debug("Portfolio value {:.2f}, realized profit {:.2f}".format(
+            algorithm.Portfolio.TotalPortfolioValue, algorithm.Portfolio.TotalProfit))
+        algorithm.CloseLogs()
+        return stats
@@ -0,0 +1,133 @@
+"""
+Runs a QCAlgorithm through the local backtest engine.
+
+    python -m backtest_runner iron_condor:IronCondorAlgorithm \
+        [--data synthetic | csv:DIR | store:DIR] [--start YYYY-MM-DD] [--end YYYY-MM-DD] \
+        [--parameter name=value ...] [--seed N] [--profile] [--json]
+
+Strategy modules do nothing when imported, this is the entry point that runs
+them. Events are streamed from the chosen data source into the algorithm and
+the run's throughput, wall time and peak RSS are printed at the end.
+"""
+from datetime import datetime
+import argparse
+import importlib
+import json
+import sys
+import time
+
+
+def load_algorithm(spec):
+    """
+    :param spec: "module:ClassName" E.g "iron_condor:IronCondorAlgorithm"
+    :return: the QCAlgorithm subclass
+    """
+    module_name, class_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def make_sources(spec):
+    """
+    :param spec: "synthetic", "csv:DIR" (see data_ingest) or "store:DIR" (see bar_store)
+    :return: sources argument of BacktestEngine, None for synthetic data
+    """
+    kind, _, root = spec.partition(":")
+    if kind == "synthetic":
+        return None
+    if kind not in ("csv", "store"):
+        raise ValueError("Unknown data spec {}, expected synthetic, csv:DIR or store:DIR".format(spec))
+    if not root:
+        raise ValueError("Data spec {} needs a directory, E.g {}:data".format(spec, kind))
+    if kind == "csv":
+        from data_ingest import csv_sources
+        return csv_sources(root)
+    if kind == "store":
+        from bar_store import BarStore, store_sources
+        return store_sources(BarStore(root))
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process, None where resource is unavailable
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run(algorithm_spec, data="synthetic", start=None, end=None, parameters=None, seed=0, profile=False,
+        log_stream=None):
+    """
+    :param start: datetime overriding the algorithm's start date
+    :param end: datetime overriding the algorithm's end date
+    :param parameters: dict of algorithm parameters, see QCAlgorithm.GetParameter
+    :param log_stream: stream the algorithm's messages go to, stdout when None
+    :return: (algorithm, dict of run results)
+    """
+    from backtest_engine import BacktestEngine
+    algorithm = load_algorithm(algorithm_spec)()
+    if log_stream is not None:
+        algorithm.SetLogStream(log_stream)
+    algorithm.OverrideDates(start, end)
+    if parameters:
+        algorithm.SetParameters(parameters)
+    if profile:
+        algorithm.EnableProfiling()
+    wall_start = time.time()
+    stats = BacktestEngine(algorithm, make_sources(data), seed=seed).Run()
+    wall = time.time() - wall_start
+    return algorithm, {
+        "algorithm": algorithm_spec,
+        "data": data,
+        "start": str(algorithm.start_date),
+        "end": str(algorithm.end_date),
+        "events": stats.events,
+        "slices": stats.slices,
+        "events_per_sec": stats.EventsPerSecond(),
+        "wall_s": wall,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "portfolio_value": algorithm.Portfolio.TotalPortfolioValue,
+    }
+
+
+def _parse_date(text):
+    return datetime.strptime(text, "%Y-%m-%d")
+
+
+def _parse_parameter(text):
+    name, _, value = text.partition("=")
+    return name, value
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run a QCAlgorithm on local data")
+    parser.add_argument("algorithm", help="module:ClassName of the algorithm")
+    parser.add_argument("--data", default="synthetic", help="synthetic, csv:DIR or store:DIR")
+    parser.add_argument("--start", type=_parse_date, default=None, help="YYYY-MM-DD, overrides the algorithm's")
+    parser.add_argument("--end", type=_parse_date, default=None, help="YYYY-MM-DD, overrides the algorithm's")
+    parser.add_argument("--parameter", type=_parse_parameter, action="append", default=[],
+                        help="name=value algorithm parameter, repeatable")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--profile", action="store_true", help="time the algorithm's stages")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as one JSON line, the algorithm's messages go to stderr")
+    args = parser.parse_args(argv)
+
+    # stdout only holds the JSON line, so it can be piped into a parser
+    _, results = run(args.algorithm, args.data, args.start, args.end, dict(args.parameter),
+                     args.seed, args.profile, log_stream=sys.stderr if args.json else None)
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+        return
+    print("{} events, {} slices in {:.3f}s wall, {:.0f} events/sec".format(
+        results["events"], results["slices"], results["wall_s"], results["events_per_sec"]))
+    if results["peak_rss_bytes"] is not None:
+        print("peak RSS {:.1f} MB".format(results["peak_rss_bytes"] / 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,290 @@
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import os
+
+from lazy_import import lazy_import
+from qc_interface import ColumnarOptionChain, OptionSecurityObject
+from data_sources import DataSource, EventKind, RepeatedChainSource
+
+np = lazy_import("numpy", globals(), "np")
+
+
+# Fixed width little endian records. Field names match the attributes of
+# qc_interface.Bar and OptionChain.OptionChainValue.Option so rows can be
+# handed to strategies without conversion. The dtypes are built by
+# record_dtype on first use, so importing this module does not load NumPy.
+BAR_FIELDS = [
+    ('Time', '<M8[s]'), # bar end time
+    ('Open', '<f8'),
+    ('High', '<f8'),
+    ('Low', '<f8'),
+    ('Close', '<f8'),
+    ('Volume', '<f8'),
+]
+
+QUOTE_FIELDS = [
+    ('Time', '<M8[s]'), # quote snapshot time
+    ('Right', 'i1'),
+    ('Strike', '<f8'),
+    ('Expiry', '<M8[s]'),
+    ('BidPrice', '<f8'),
+    ('AskPrice', '<f8'),
+    ('UnderlyingLastPrice', '<f8'),
+]
+
+_RECORD_FIELDS = {'bars': BAR_FIELDS, 'quotes': QUOTE_FIELDS}
+_record_dtypes = {}
+
+
+def record_dtype(kind):
+    """
+    :param kind: BarStore.BARS or BarStore.QUOTES
+    :return: numpy dtype of the records of kind
+    """
+    dtype = _record_dtypes.get(kind)
+    if dtype is None:
+        dtype = _record_dtypes[kind] = np.dtype(_RECORD_FIELDS[kind])
+    return dtype
+
+
+class StoredOptionChain(object):
+    """
+    OptionChain for one snapshot of a quote file. Value is a ColumnarOptionChain
+    whose columns are views into the memory mapped file
+    """
+
+    def __init__(self, symbol, value):
+        self.Key = symbol
+        self.Value = value
+
+    @classmethod
+    def FromRecords(cls, symbol, records, presorted=True):
+        """
+        :param records: recarray of quote records of a single snapshot
+        :param presorted: records are in (right, expiry, strike) order, as in a BarStore
+        """
+        return cls(symbol, ColumnarOptionChain(records.Right, records.Strike, records.Expiry,
+                                               records.BidPrice, records.AskPrice,
+                                               underlying_price=float(records.UnderlyingLastPrice[0]),
+                                               symbol=symbol, presorted=presorted))
+
+
+class BarStore(object):
+    """
+    On disk store of bars and option quotes with one raw record file per symbol
+    per day: <root>/<SYMBOL>/<YYYYMMDD>.bars and <YYYYMMDD>.quotes. Files have no
+    header, they are plain arrays of record_dtype(BARS) / record_dtype(QUOTES) records sorted by
+    time (quotes by time, right, expiry, strike) and are read through numpy.memmap,
+    so nothing is parsed and only the pages touched are loaded.
+    """
+
+    BARS = 'bars'
+    QUOTES = 'quotes'
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, symbol, date, kind):
+        return os.path.join(self.root, symbol, "{}.{}".format(date.strftime("%Y%m%d"), kind))
+
+    def _write(self, symbol, date, kind, records, sort_fields):
+        dtype = record_dtype(kind)
+        records = np.asarray(records)
+        if records.dtype != dtype:
+            raise ValueError("Expected records of dtype {}, got {}".format(dtype, records.dtype))
+        order = np.lexsort(tuple(records[f] for f in reversed(sort_fields)))
+        path = self._path(symbol, date, kind)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        records[order].tofile(path)
+        return path
+
+    def WriteBars(self, symbol, date, records):
+        """
+        :param records: array of record_dtype(BARS) for a single day
+        :return: path written
+        """
+        return self._write(symbol, date, self.BARS, records, ('Time',))
+
+    def WriteQuotes(self, symbol, date, records):
+        """
+        :param records: array of record_dtype(QUOTES) for a single day
+        :return: path written
+        """
+        return self._write(symbol, date, self.QUOTES, records,
+                           ('Time', 'Right', 'Expiry', 'Strike'))
+
+    def _read(self, symbol, date, kind):
+        path = self._path(symbol, date, kind)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        return np.memmap(path, dtype=record_dtype(kind), mode='r').view(np.recarray)
+
+    def ReadBars(self, symbol, date):
+        """
+        :return: read only recarray over the day's bars, None if there is no file
+        """
+        return self._read(symbol, date, self.BARS)
+
+    def ReadQuotes(self, symbol, date):
+        """
+        :return: read only recarray over the day's quotes, None if there is no file
+        """
+        return self._read(symbol, date, self.QUOTES)
+
+    def Dates(self, symbol, kind):
+        """
+        :return: sorted list of datetimes with a file of kind for symbol
+        """
+        directory = os.path.join(self.root, symbol)
+        if not os.path.isdir(directory):
+            return []
+        suffix = "." + kind
+        return sorted(datetime.strptime(name[:-len(suffix)], "%Y%m%d")
+                      for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def time_bounds(records, start, end):
+    """
+    :param records: records sorted by Time
+    :return: (lo, hi) such that records[lo:hi] have start <= Time < end
+    """
+    times = records.Time
+    lo = int(np.searchsorted(times, np.datetime64(start, 's'), side='left'))
+    hi = int(np.searchsorted(times, np.datetime64(end, 's'), side='left'))
+    return lo, hi
+
+
+def snapshot_runs(records, lo, hi):
+    """
+    Runs of quote records in [lo, hi) sharing a time, each one chain snapshot
+    :return: (starts, stops, times) lists
+    """
+    if lo == hi:
+        return [], [], []
+    times = records.Time[lo:hi]
+    starts = np.concatenate(([0], np.flatnonzero(times[1:] != times[:-1]) + 1)) + lo
+    stops = np.append(starts[1:], hi).tolist()
+    return starts.tolist(), stops, times[starts - lo].tolist()
+
+
+class StoredBarSource(DataSource):
+    """
+    Streams the bars of one symbol from a BarStore. Each event's data is a row of
+    the memory mapped file, which exposes Open, High, Low, Close and Volume as
+    attributes like qc_interface.Bar
+    """
+
+    def __init__(self, store, symbol):
+        self.store = store
+        self.symbol = symbol
+
+    def Events(self, start, end):
+        # seeks when sent a time, see DataSource. Days before it are not read
+        for date in self.store.Dates(self.symbol, BarStore.BARS):
+            if date + timedelta(days=1) <= start or date >= end:
+                continue
+            records = self.store.ReadBars(self.symbol, date)
+            if records is None:
+                continue
+            lo, hi = time_bounds(records, start, end)
+            times = records.Time[lo:hi].tolist()
+            i = 0
+            while i < len(times):
+                skip_to = yield times[i], EventKind.BAR, self.symbol, records[lo + i]
+                if skip_to is None:
+                    i += 1
+                else:
+                    start = max(start, skip_to)
+                    i = max(i + 1, bisect_left(times, skip_to))
+
+
+class StoredOptionChainSource(DataSource):
+    """
+    Streams option chain snapshots of one symbol from a BarStore. Every run of
+    quotes sharing a time becomes a ColumnarOptionChain over slices of the file
+    """
+
+    def __init__(self, store, symbol):
+        self.store = store
+        self.symbol = symbol
+
+    def Events(self, start, end):
+        for date in self.store.Dates(self.symbol, BarStore.QUOTES):
+            if date + timedelta(days=1) <= start or date >= end:
+                continue
+            records = self.store.ReadQuotes(self.symbol, date)
+            if records is None:
+                continue
+            lo, hi = time_bounds(records, start, end)
+            starts, stops, snapshot_times = snapshot_runs(records, lo, hi)
+            i = 0
+            while i < len(starts):
+                chain = StoredOptionChain.FromRecords(self.symbol, records[starts[i]:stops[i]])
+                skip_to = yield snapshot_times[i], EventKind.OPTION_CHAIN, self.symbol, chain
+                if skip_to is None:
+                    i += 1
+                else:
+                    start = max(start, skip_to)
+                    i = max(i + 1, bisect_left(snapshot_times, skip_to))
+
+
+def store_sources(store):
+    """
+    Source factory for BacktestEngine reading every security of the algorithm from store
+    :param store: BarStore
+    :return: fn(algorithm, start, end) -> list of DataSource
+    """
+    def make_sources(algorithm, start, end):
+        sources = []
+        for security in algorithm.Securities:
+            if isinstance(security, OptionSecurityObject):
+                sources.append(RepeatedChainSource(StoredOptionChainSource(store, security.symbol),
+                                                   security.Resolution))
+            else:
+                sources.append(StoredBarSource(store, security.symbol))
+        return sources
+    return make_sources
+
+
+def write_events(store, sources, start, end):
+    """
+    Copies the events of other sources (E.g synthetic ones) into store, one file
+    per symbol per day. A chain snapshot is only written when the source hands
+    out a new chain object, sources that reuse a chain across bars are stored
+    once per reuse rather than once per bar. store_sources repeats it at every
+    bar time again.
+    :param store: BarStore
+    :param sources: list of DataSource
+    :return: number of records written
+    """
+    written = 0
+    for source in sources:
+        bars = {}  # (symbol, date) -> [record tuples]
+        quotes = {}
+        last_chain = None
+        for t, kind, symbol, data in source.Events(start, end):
+            day = datetime(t.year, t.month, t.day)
+            if kind == EventKind.BAR:
+                bars.setdefault((symbol, day), []).append(
+                    (t, data.Open, data.High, data.Low, data.Close, getattr(data, 'Volume', 0.0)))
+            elif data is not last_chain:
+                last_chain = data
+                chain = ColumnarOptionChain.FromContracts(data.Value)
+                records = np.empty(len(chain), dtype=record_dtype(BarStore.QUOTES))
+                records['Time'] = np.datetime64(t, 's')
+                records['Right'] = chain.Right
+                records['Strike'] = chain.Strike
+                records['Expiry'] = chain.Expiry
+                records['BidPrice'] = chain.BidPrice
+                records['AskPrice'] = chain.AskPrice
+                records['UnderlyingLastPrice'] = chain.UnderlyingLastPrice
+                quotes.setdefault((symbol, day), []).append(records)
+        for (symbol, day), rows in bars.items():
+            store.WriteBars(symbol, day, np.array(rows, dtype=record_dtype(BarStore.BARS)))
+            written += len(rows)
+        for (symbol, day), blocks in quotes.items():
+            records = np.concatenate(blocks)
+            store.WriteQuotes(symbol, day, records)
+            written += len(records)
+    return written
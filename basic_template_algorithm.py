@@ -1,6 +1,7 @@
-from qc_utils import SMA
+from qc_utils import RollingStatsBank
 from qc_interface import QCAlgorithm, Resolution
 import os
+from decimal import Decimal
 
 ### <summary>
 ### Basic template algorithm simply initializes the date range and cash. This is a skeleton
@@ -19,8 +20,15 @@ class BasicTemplateAlgorithm(QCAlgorithm):
         self.AddEquity("SPY", Resolution.Daily)
         # self.Debug("numpy test >>> print numpy.pi: " + str(np.pi))
         lookback = 200 # in days
-        self.sma = SMA(lookback)
+        self.rolling_stats = RollingStatsBank(["SPY"], lookback)
         self.SetWarmUp(lookback)
+
+    def GetState(self):
+        # a resumed run skips the warm up, so the window comes from the snapshot
+        return {"rolling_stats": self.rolling_stats.get_state()}
+
+    def SetState(self, state):
+        self.rolling_stats.set_state(state["rolling_stats"])
         
     def OnData(self, data):
         '''OnData event is the primary entry point for your algorithm. Each new data point will be pumped in here.
@@ -29,10 +37,10 @@ class BasicTemplateAlgorithm(QCAlgorithm):
             data: Slice object keyed by symbol containing the stock data
         '''
         bar = data['SPY']
-        mid_bar = (bar.Open + bar.Close) / Decimal(2.0)
-        self.sma.update(float(mid_bar))
-        if not self.IsWarmingUp and self.sma.get_sma():
-            ave = self.sma.get_sma()
+        mid_bar = Decimal(bar.Open + bar.Close) / Decimal(2.0)
+        self.rolling_stats.update([float(mid_bar)])
+        ave = self.rolling_stats.get_sma('SPY')
+        if not self.IsWarmingUp and ave:
             self.Log("Open {}, Ave {}".format(float(bar.Open), ave))
             if bar.Open > ave: 
                 if not self.Portfolio['SPY'].IsLong:
@@ -42,7 +50,5 @@ class BasicTemplateAlgorithm(QCAlgorithm):
                     self.SetHoldings('SPY', -1.0, liquidateExistingHoldings=True)
 
 
-
-
-b = BasicTemplateAlgorithm()
-b.TestRun()
\ No newline at end of file
+if __name__ == "__main__":
+    BasicTemplateAlgorithm().TestRun()
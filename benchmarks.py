@@ -0,0 +1,572 @@
+"""
+Benchmarks for the local harness and strategy hot paths.
+
+    python benchmarks.py [--output FILE] [--list] [name ...]
+
+Each benchmark prints one JSON object per line, tagged with the commit and
+python version, so results can be appended to a file and compared from commit
+to commit. Every benchmark runs in a forked worker so RSS figures are not
+skewed by memory freed by an earlier one.
+"""
+from datetime import datetime, timedelta
+from timeit import default_timer
+import argparse
+import functools
+import gc
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import traceback
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+BENCHMARKS = [] # (name, fn) in registration order
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+
+def rss_bytes():
+    """
+    Current resident set size of this process
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        # peak rather than current RSS, KB on Linux
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(build):
+    """
+    Times build() and the RSS it leaves allocated
+    :return: (result, seconds, rss bytes)
+    """
+    gc.collect()
+    rss_before = rss_bytes()
+    start = time.time()
+    result = build()
+    elapsed = time.time() - start
+    gc.collect()
+    return result, elapsed, rss_bytes() - rss_before
+
+
+############## Records
+
+class DictOption(object):
+    # the Option record as it was before it was slotted
+    def __init__(self, right):
+        self.Right = right
+        self.Symbol = None
+        self.Strike = 0.0
+        self.BidPrice = 0.0
+        self.AskPrice = 0.0
+        self.UnderlyingLastPrice = 0.0
+        self.Expiry = datetime(year=2018, month=1, day=1)
+
+
+def _full_year_chain(option_cls):
+    from qc_interface import OptionChain, OptionRight
+    Option = OptionChain.OptionChainValue.Option
+    start = datetime(2018, 1, 1)
+    ret = []
+    for day in range(365):
+        expiry = start + timedelta(days=day)
+        for right in (OptionRight.PUT, OptionRight.CALL):
+            for offset in range(-20, 20):
+                o = option_cls(right)
+                o.Expiry = expiry
+                o.Strike = 2000.0 + offset
+                o.UnderlyingLastPrice = 2000.0
+                o.Symbol = Option.MakeSymbol("SPY", right, expiry, o.Strike)
+                ret.append(o)
+    return ret
+
+
+def _attribute_reads(contracts):
+    start = time.time()
+    total = 0.0
+    for o in contracts:
+        total += o.Strike + o.BidPrice + o.AskPrice
+    return time.time() - start
+
+
+@benchmark("option_records_dict")
+def bench_option_records_dict():
+    contracts, elapsed, rss = measure(lambda: _full_year_chain(DictOption))
+    return {"contracts": len(contracts), "construct_s": elapsed, "rss_bytes": rss,
+            "read_s": _attribute_reads(contracts)}
+
+
+@benchmark("option_records_slotted")
+def bench_option_records_slotted():
+    from qc_interface import OptionChain
+    contracts, elapsed, rss = measure(lambda: _full_year_chain(OptionChain.OptionChainValue.Option))
+    return {"contracts": len(contracts), "construct_s": elapsed, "rss_bytes": rss,
+            "read_s": _attribute_reads(contracts)}
+
+
+@benchmark("option_chain_full_year")
+def bench_option_chain_full_year():
+    # the harness chain with every contract materialized
+    from qc_interface import OptionChain
+    chain, elapsed, rss = measure(lambda: list(OptionChain("SPY").Value))
+    return {"contracts": len(chain), "construct_s": elapsed, "rss_bytes": rss}
+
+
+############## Rolling statistics
+
+NUM_UPDATES = 200000
+
+
+def _prices(n, seed=0):
+    import numpy as np
+    return (2000.0 + np.cumsum(np.random.RandomState(seed).normal(0.0, 1.0, n))).tolist()
+
+
+@benchmark("sliding_window_update")
+def bench_sliding_window_update():
+    from qc_utils import SlidingWindow
+    prices = _prices(NUM_UPDATES)
+    window = SlidingWindow(14)
+    start = default_timer()
+    for p in prices:
+        window.update(p)
+        window.get_std()
+    elapsed = default_timer() - start
+    return {"updates": len(prices), "elapsed_s": elapsed, "updates_per_sec": len(prices) / elapsed}
+
+
+@benchmark("sma_update")
+def bench_sma_update():
+    from qc_utils import SMA
+    prices = _prices(NUM_UPDATES)
+    sma = SMA(14)
+    start = default_timer()
+    for p in prices:
+        sma.update(p)
+        sma.get_sma()
+    elapsed = default_timer() - start
+    return {"updates": len(prices), "elapsed_s": elapsed, "updates_per_sec": len(prices) / elapsed}
+
+
+@benchmark("rolling_stats_bank_update")
+def bench_rolling_stats_bank_update():
+    # one row per symbol, so this is updates of 100 windows at once
+    import numpy as np
+    from qc_utils import RollingStatsBank
+    symbols = ["S{}".format(i) for i in range(100)]
+    bank = RollingStatsBank(symbols, 14)
+    mids = 2000.0 + np.random.RandomState(0).normal(0.0, 1.0, (NUM_UPDATES // 100, len(symbols)))
+    start = default_timer()
+    for row in mids:
+        bank.update(row)
+    elapsed = default_timer() - start
+    return {"updates": len(mids), "symbols": len(symbols), "elapsed_s": elapsed,
+            "updates_per_sec": len(mids) / elapsed}
+
+
+############## Option chains and leg selection
+
+@benchmark("option_chain_columnar")
+def bench_option_chain_columnar():
+    # a filtered harness chain as the synthetic sources build it, then its columnar view
+    from qc_interface import OptionChain
+    repeats = 200
+    start = default_timer()
+    for day in range(repeats):
+        chain = OptionChain.FromFilter("SPY", datetime(2018, 1, 1) + timedelta(days=day),
+                                       (-20, 20, timedelta(0), timedelta(30)), underlying_price=2000.0)
+        columnar = chain.Value.ToColumnar()
+    elapsed = default_timer() - start
+    return {"chains": repeats, "contracts": len(columnar), "chain_us": elapsed / repeats * 1e6}
+
+
+def _columnar_chain(num_contracts):
+    # num_contracts split evenly over both rights and daily expiries, about 200
+    # strikes 1.0 apart per expiry
+    import numpy as np
+    from qc_interface import ColumnarOptionChain
+    num_expiries = max(1, num_contracts // 400)
+    strikes_per_expiry = num_contracts // (2 * num_expiries)
+    expiries = np.datetime64(datetime(2018, 1, 1), 's') + \
+        np.arange(num_expiries) * np.timedelta64(86400, 's')
+    strikes = 2000.0 + np.arange(strikes_per_expiry) - strikes_per_expiry // 2
+    right = np.repeat([0, 1], num_expiries * strikes_per_expiry)
+    expiry = np.tile(np.repeat(expiries, strikes_per_expiry), 2)
+    strike = np.tile(strikes, 2 * num_expiries)
+    price = np.full(len(right), 1.0)
+    return ColumnarOptionChain(right, strike, expiry, price, price + 0.1, underlying_price=2000.0,
+                               symbol="SPY")
+
+
+def bench_leg_selection(num_contracts):
+    from leg_selection import first_common_expiry, select_iron_condor_legs
+    chain, build_s, _ = measure(lambda: _columnar_chain(num_contracts))
+    repeats = 2000
+    min_date = datetime(2018, 1, 1) + timedelta(days=min(14, len(chain.Expiries(0)) // 2))
+    start = default_timer()
+    for i in range(repeats):
+        # the selection IronCondorAlgorithm.IronCondor makes, with moving targets
+        expiry = first_common_expiry(chain, min_date)
+        offset = (i % 20) + 0.5
+        select_iron_condor_legs(chain, expiry, 2000.0 + offset, 2004.0 + offset,
+                                2000.0 - offset, 1996.0 - offset)
+    elapsed = default_timer() - start
+    return {"contracts": len(chain), "build_s": build_s, "selections": repeats,
+            "selection_us": elapsed / repeats * 1e6}
+
+
+for _n in (1000, 10000, 100000):
+    benchmark("leg_selection_{}".format(_n))(functools.partial(bench_leg_selection, _n))
+
+
+@benchmark("chain_greeks")
+def bench_chain_greeks():
+    # implied volatility and greeks of a filtered synthetic chain, as IronCondorAlgorithm
+    # computes them when short_delta is set
+    from qc_interface import OptionChain
+    from option_pricing import chain_greeks
+    time = datetime(2018, 1, 2, 10, 0)
+    chain = OptionChain.FromFilter("SPY", time, (-20, 20, timedelta(0), timedelta(30)),
+                                   underlying_price=2000.0, volatility=0.15).Value.ToColumnar()
+    repeats = 200
+    start = default_timer()
+    for _ in range(repeats):
+        greeks = chain_greeks(chain, time)
+    elapsed = default_timer() - start
+    solved = int((greeks.ImpliedVol == greeks.ImpliedVol).sum())
+    return {"contracts": len(chain), "solved": solved, "chain_us": elapsed / repeats * 1e6,
+            "contract_us": elapsed / repeats / len(chain) * 1e6}
+
+
+@benchmark("vol_surface_update")
+def bench_vol_surface_update():
+    # consecutive snapshots of one chain where a small share of the quotes change
+    import numpy as np
+    from qc_interface import ColumnarOptionChain, OptionChain
+    from vol_surface import ImpliedVolSurface
+    time = datetime(2018, 1, 2, 10, 0)
+    base = OptionChain.FromFilter("SPY", time, (-20, 20, timedelta(0), timedelta(30)),
+                                  underlying_price=2000.0, volatility=0.15).Value.ToColumnar()
+    rng = np.random.RandomState(0)
+    chains = []
+    for _ in range(20):
+        bid = base.BidPrice.copy()
+        changed = rng.rand(len(bid)) < 0.05
+        bid[changed] += 0.05
+        chains.append(ColumnarOptionChain(base.Right, base.Strike, base.Expiry, bid, base.AskPrice,
+                                          underlying_price=2000.0, presorted=True))
+    surface = ImpliedVolSurface()
+    surface.Update(base, time)
+    repeats = 200
+    solved = 0
+    start = default_timer()
+    for i in range(repeats):
+        surface.Update(chains[i % len(chains)], time)
+        solved += surface.solved
+    elapsed = default_timer() - start
+    return {"contracts": len(base), "points": len(surface), "solved_per_update": solved / float(repeats),
+            "update_us": elapsed / repeats * 1e6}
+
+
+@benchmark("payoff_10000")
+def bench_payoff():
+    # risk and PnL grids of ten thousand candidate condors on one expiry
+    import numpy as np
+    from qc_interface import OptionChain
+    from leg_selection import first_common_expiry, select_iron_condor_legs
+    from payoff import Legs, expiry_payoff, model_value, risk_summary
+    time = datetime(2018, 1, 2, 10, 0)
+    chain = OptionChain.FromFilter("SPY", time, (-20, 20, timedelta(0), timedelta(30)),
+                                   underlying_price=2000.0, volatility=0.15).Value.ToColumnar()
+    expiry = first_common_expiry(chain, time + timedelta(days=14))
+    offsets = np.arange(10000)
+    short_call = 2000.0 + offsets % 15
+    short_put = 2000.0 - (offsets // 15) % 15
+    width = 1.0 + (offsets // 225) % 4
+    legs = select_iron_condor_legs(chain, expiry, short_call, short_call + width, short_put, short_put - width)
+    legs = Legs.FromChain(chain, legs[legs[:, 0] >= 0], [-1, 1, -1, 1])
+    prices = np.linspace(1900.0, 2100.0, 101)
+    times = [time, time + timedelta(days=7)]
+    results = {"positions": len(legs), "grid": len(prices)}
+    for name, fn in (("risk_ms", lambda: risk_summary(legs)),
+                     ("expiry_payoff_ms", lambda: expiry_payoff(legs, prices)),
+                     ("model_value_ms", lambda: model_value(legs, prices, times, 0.15))):
+        start = default_timer()
+        for _ in range(5):
+            fn()
+        results[name] = (default_timer() - start) / 5 * 1e3
+    return results
+
+
+@benchmark("condor_search")
+def bench_condor_search():
+    # every condor of a filtered chain enumerated, then ranked by each objective
+    from qc_interface import OptionChain
+    from condor_search import OBJECTIVES, enumerate_condors, rank_condors
+    time = datetime(2018, 1, 2, 10, 0)
+    chain = OptionChain.FromFilter("SPY", time, (-20, 20, timedelta(0), timedelta(30)),
+                                   underlying_price=2000.0, volatility=0.15).Value.ToColumnar()
+    start = default_timer()
+    candidates = enumerate_condors(chain, time, min_expiry=time + timedelta(days=14), max_width=10.0, vol=0.15)
+    results = {"contracts": len(chain), "candidates": len(candidates),
+               "enumerate_ms": (default_timer() - start) * 1e3}
+    for name in sorted(OBJECTIVES):
+        start = default_timer()
+        rank_condors(candidates, name, top=10)
+        results["rank_{}_ms".format(name)] = (default_timer() - start) * 1e3
+    return results
+
+
+############## Data ingest
+
+def _write_quotes_csv(path, rows):
+    # quotes as a vendor file holds them, prices to the cent
+    import numpy as np
+    rng = np.random.RandomState(0)
+    prices = np.round(rng.uniform(0.05, 50.0, rows), 2)
+    with open(path, "w") as f:
+        f.write("Time,Right,Strike,Expiry,BidPrice,AskPrice,UnderlyingLastPrice\n")
+        for i in range(rows):
+            f.write("2018-01-02 {:02d}:{:02d}:00,{},{:.1f},2018-01-19 00:00:00,{:.2f},{:.2f},2000.25\n".format(
+                9 + i // 60000 % 7, i // 1000 % 60, "CP"[i % 2], 1900.0 + i % 200, prices[i], prices[i] + 0.05))
+
+
+def _read_quotes_csv_reader(path):
+    # the row by row baseline, a Python string per field then one conversion per column
+    import csv
+    import numpy as np
+    from bar_store import record_dtype
+    from data_ingest import QUOTES, _right_column
+    dtype = record_dtype(QUOTES)
+    with open(path) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = [[] for _ in header]
+        for row in reader:
+            for column, field in zip(columns, row):
+                column.append(field)
+    records = np.zeros(len(columns[0]), dtype=dtype)
+    for name, column in zip(header, columns):
+        values = np.array(column).astype(bytes)
+        records[name] = _right_column(values) if name == "Right" else values.astype(dtype[name])
+    return records
+
+
+@benchmark("csv_ingest")
+def bench_csv_ingest():
+    import shutil
+    import tempfile
+    from data_ingest import QUOTES, read_batches
+    rows = 400000
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, "SPY_quotes.csv")
+        _write_quotes_csv(path, rows)
+        start = default_timer()
+        baseline = _read_quotes_csv_reader(path)
+        csv_reader_s = default_timer() - start
+        start = default_timer()
+        parsed = sum(len(records) for records in read_batches(path, QUOTES))
+        read_batches_s = default_timer() - start
+    finally:
+        shutil.rmtree(root)
+    assert parsed == len(baseline) == rows
+    return {"rows": rows, "csv_reader_s": csv_reader_s, "read_batches_s": read_batches_s,
+            "rows_per_sec": rows / read_batches_s, "speedup": csv_reader_s / read_batches_s}
+
+
+############## Position tracking
+
+def bench_position_tracker(history):
+    from position_tracker import PositionTracker, PositionScheduler
+
+    def legs(i):
+        return [("SPY C{}".format(i), -1), ("SPY C{}L".format(i), 1),
+                ("SPY P{}".format(i), -1), ("SPY P{}L".format(i), 1)]
+
+    tracker = PositionTracker()
+    scheduler = PositionScheduler()
+    expiry = datetime(2018, 1, 1)
+    start = default_timer()
+    for i in range(history):
+        structure_id = tracker.OpenStructure(legs(i), expiry + timedelta(minutes=i))
+        scheduler.Schedule(structure_id, expiry + timedelta(minutes=i))
+        if i % 10:
+            # keep one in ten open
+            scheduler.Cancel(structure_id)
+            tracker.CloseStructure(structure_id)
+    build_s = default_timer() - start
+
+    repeats = 20000
+    start = default_timer()
+    for i in range(repeats):
+        tracker.IsFlat()
+        tracker.NumOpenLegs()
+        structure_id = tracker.OpenStructure(legs(history + i), expiry)
+        tracker.CloseStructure(structure_id)
+    ops_s = default_timer() - start
+    start = default_timer()
+    for i in range(repeats // 100):
+        tracker.ToCloseOrders()
+    close_orders_s = default_timer() - start
+    start = default_timer()
+    due = scheduler.PopDue(expiry + timedelta(minutes=history))
+    pop_due_s = default_timer() - start
+    return {"history": history, "open_structures": tracker.NumOpenStructures(), "build_s": build_s,
+            "open_close_us": ops_s / repeats * 1e6,
+            "to_close_orders_us": close_orders_s / (repeats // 100) * 1e6,
+            "pop_due_us": pop_due_s * 1e6, "due": len(due)}
+
+
+for _n in (1000, 10000, 100000):
+    benchmark("position_tracker_{}".format(_n))(functools.partial(bench_position_tracker, _n))
+
+
+############## End to end
+
+@benchmark("backtest_iron_condor")
+def bench_backtest_iron_condor():
+    from backtest_engine import BacktestEngine
+    from iron_condor import IronCondorAlgorithm
+    devnull = open(os.devnull, "w")
+    try:
+        algorithm = IronCondorAlgorithm()
+        algorithm.SetLogStream(devnull) # the algorithm logs every trade
+        start = default_timer()
+        stats = BacktestEngine(algorithm).Run()
+        elapsed = default_timer() - start
+    finally:
+        devnull.close()
+    return {"events": stats.events, "slices": stats.slices, "events_per_sec": stats.EventsPerSecond(),
+            "wall_s": elapsed}
+
+
+############## Startup
+
+IMPORT_TIME_MODULES = ("qc_utils", "qc_interface", "position_tracker", "leg_selection",
+                       "iron_condor", "basic_template_algorithm", "data_sources", "bar_store",
+                       "data_ingest")
+
+
+@benchmark("import_time")
+def bench_import_time():
+    # each module imported first thing in a fresh interpreter, as a sweep worker would
+    script = ("import sys, timeit; start = timeit.default_timer(); import {}; "
+              "print(timeit.default_timer() - start); print('numpy' in sys.modules)")
+    root = os.path.dirname(os.path.abspath(__file__))
+    ret = {}
+    for module in IMPORT_TIME_MODULES:
+        out = subprocess.check_output([sys.executable, "-c", script.format(module)], cwd=root)
+        elapsed, loads_numpy = out.decode().split()
+        ret[module + "_ms"] = float(elapsed) * 1e3
+        ret[module + "_loads_numpy"] = loads_numpy == "True"
+    return ret
+
+
+############## Runner
+
+WORKER_POLL_SECONDS = 1.0 # how often run checks a silent worker is still alive
+
+
+def _run_in_worker(fn, results):
+    # a benchmark that raises still reports, run would otherwise wait on it forever
+    try:
+        result = fn()
+    except Exception:
+        result = {"error": traceback.format_exc()}
+    results.put(result)
+
+
+def _wait_for_result(worker, results):
+    """
+    :return: the result dict the worker put, an error record if it died without one
+    """
+    while True:
+        try:
+            return results.get(timeout=WORKER_POLL_SECONDS)
+        except Empty:
+            if worker.is_alive():
+                continue
+        # a result put just before exiting is in the queue by now
+        try:
+            return results.get_nowait()
+        except Empty:
+            return {"error": "worker exited with code {} without a result".format(worker.exitcode)}
+
+
+def run(names=None):
+    """
+    :param names: benchmark names to run, all when None
+    :return: list of result dicts
+    """
+    ret = []
+    commit = git_commit()
+    for name, fn in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_run_in_worker, args=(fn, results))
+        worker.start()
+        result = _wait_for_result(worker, results)
+        worker.join()
+        result["benchmark"] = name
+        result["commit"] = commit
+        result["python"] = sys.version.split()[0]
+        result["timestamp"] = datetime.utcnow().isoformat()
+        ret.append(result)
+    return ret
+
+
+def git_commit():
+    """
+    :return: short hash of HEAD, None outside of a git checkout
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                          cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks of the harness and strategy hot paths")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all when none are given")
+    parser.add_argument("--output", default=None, help="file to append the JSON lines to")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return
+    unknown = set(args.names) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+    results = run(args.names)
+    lines = [json.dumps(r, sort_keys=True) for r in results]
+    for line in lines:
+        print(line)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write("\n".join(lines) + "\n")
+    failed = [r["benchmark"] for r in results if "error" in r]
+    if failed:
+        sys.exit("failed benchmarks: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,198 @@
+from lazy_import import lazy_import
+from qc_interface import OptionRight, PortfolioClass
+from option_pricing import black_scholes_price, norm_cdf, years_to_expiry
+
+np = lazy_import("numpy", globals(), "np")
+
+
+# Enumerates every iron condor a chain allows and ranks them. Candidates are
+# built with index arithmetic on the ascending strike runs of a
+# ColumnarOptionChain: each side's vertical spreads are the (short, long)
+# index pairs within max_width of each other, and the condors of an expiry
+# are the cross product of its call and put spreads. Every candidate is a row
+# of arrays, so an objective scores all of them in one vectorized call.
+
+
+class CondorCandidates(object):
+    """
+    Iron condors as arrays with one row per candidate. Legs is (n, 4) chain
+    indices ordered (short call, long call, short put, long put), the
+    select_iron_condor_legs order. Prices are per unit, MaxLoss is per contract.
+    Breakevens are NaN on a side that cannot lose
+    """
+
+    __slots__ = ('Legs', 'Expiry', 'Years', 'Credit', 'Width', 'MaxLoss', 'LowerBreakeven',
+                 'UpperBreakeven', 'Strikes', 'Spot', 'Vol')
+
+    def __len__(self):
+        return len(self.Legs)
+
+    def Take(self, rows):
+        """
+        :return: CondorCandidates of the given rows
+        """
+        taken = CondorCandidates()
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(taken, name, value if np.ndim(value) == 0 else value[rows])
+        return taken
+
+
+def _short_long_pairs(strikes, shorts, max_width, above):
+    """
+    Vertical spreads of one strike run
+    :param strikes: ascending strikes of one (right, expiry)
+    :param shorts: indices into strikes that may be sold
+    :param above: the long leg is at a higher strike (calls) or a lower one (puts)
+    :return: (short, long) int arrays of indices into strikes
+    """
+    if above:
+        first = shorts + 1
+        stop = np.searchsorted(strikes, strikes[shorts] + max_width, side='right')
+    else:
+        first = np.searchsorted(strikes, strikes[shorts] - max_width, side='left')
+        stop = shorts
+    counts = np.maximum(stop - first, 0)
+    short = np.repeat(shorts, counts)
+    # position of every pair within its short's range of longs
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return short, np.repeat(first, counts) + offsets
+
+
+def enumerate_condors(chain, time, min_expiry=None, max_expiry=None, max_width=10.0, min_credit=0.0, vol=0.2):
+    """
+    Every iron condor of chain whose short legs are out of the money, whose
+    wings are at most max_width wide and which opens for more than min_credit
+    :param chain: ColumnarOptionChain
+    :param time: datetime the chain was quoted at
+    :param min_expiry, max_expiry: optional datetimes, only expiries strictly
+                                   after min_expiry and at or before max_expiry are used
+    :param vol: volatility the objectives assume, a float or an array aligned
+                with the chain (E.g ImpliedVolSurface.Update). A candidate then
+                takes the mean vol of its short legs
+    :return: CondorCandidates, premiums at the bid for sold legs and the ask for bought legs
+    """
+    spot = float(chain.UnderlyingLastPrice)
+    expiries = np.intersect1d(chain.Expiries(OptionRight.CALL), chain.Expiries(OptionRight.PUT))
+    if min_expiry is not None:
+        expiries = expiries[expiries > np.datetime64(min_expiry, 's')]
+    if max_expiry is not None:
+        expiries = expiries[expiries <= np.datetime64(max_expiry, 's')]
+    blocks = []
+    for expiry in expiries:
+        call_start, call_stop = chain.StrikeRun(OptionRight.CALL, expiry)
+        put_start, put_stop = chain.StrikeRun(OptionRight.PUT, expiry)
+        calls = chain.Strike[call_start:call_stop]
+        puts = chain.Strike[put_start:put_stop]
+        call_shorts = np.arange(np.searchsorted(calls, spot, side='left'), len(calls))
+        put_shorts = np.arange(0, np.searchsorted(puts, spot, side='right'))
+        sc, lc = _short_long_pairs(calls, call_shorts, max_width, True)
+        sp, lp = _short_long_pairs(puts, put_shorts, max_width, False)
+        if not len(sc) or not len(sp):
+            continue
+        # cross product of the call and put spreads of this expiry
+        calls_i = np.repeat(np.arange(len(sc)), len(sp))
+        puts_i = np.tile(np.arange(len(sp)), len(sc))
+        blocks.append(np.stack((sc[calls_i] + call_start, lc[calls_i] + call_start,
+                                sp[puts_i] + put_start, lp[puts_i] + put_start), axis=1))
+    legs = np.concatenate(blocks) if blocks else np.zeros((0, 4), dtype=np.int64)
+
+    bid, ask, strike = chain.BidPrice, chain.AskPrice, chain.Strike
+    credit = bid[legs[:, 0]] - ask[legs[:, 1]] + bid[legs[:, 2]] - ask[legs[:, 3]]
+    keep = credit > min_credit
+    legs, credit = legs[keep], credit[keep]
+    strikes = strike[legs]
+    width = np.maximum(strikes[:, 1] - strikes[:, 0], strikes[:, 2] - strikes[:, 3])
+
+    candidates = CondorCandidates()
+    candidates.Legs = legs
+    candidates.Strikes = strikes
+    candidates.Expiry = chain.Expiry[legs[:, 0]]
+    candidates.Years = years_to_expiry(candidates.Expiry, time)
+    candidates.Credit = credit
+    candidates.Width = width
+    # a condor loses on one side at most, the wider one
+    candidates.MaxLoss = (width - credit) * PortfolioClass.OPTION_MULTIPLIER
+    # a side whose width the credit covers never loses and has no breakeven
+    candidates.LowerBreakeven = np.where(credit < strikes[:, 2] - strikes[:, 3], strikes[:, 2] - credit, np.nan)
+    candidates.UpperBreakeven = np.where(credit < strikes[:, 1] - strikes[:, 0], strikes[:, 0] + credit, np.nan)
+    candidates.Spot = spot
+    if np.ndim(vol):
+        vol = np.asarray(vol, dtype=np.float64)
+        candidates.Vol = 0.5 * (vol[legs[:, 0]] + vol[legs[:, 2]])
+    else:
+        candidates.Vol = np.full(len(legs), float(vol))
+    return candidates
+
+
+############## Objectives, higher is better
+
+def credit_to_width(candidates):
+    """
+    Credit received per unit of wing width
+    """
+    return candidates.Credit / candidates.Width
+
+
+def _below(candidates, level):
+    # probability the underlying ends below level, lognormal at the candidate vols
+    vol_t = candidates.Vol * np.sqrt(candidates.Years)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d2 = (np.log(candidates.Spot / np.maximum(level, 1e-12)) - 0.5 * vol_t * vol_t) / vol_t
+    return norm_cdf(-d2)
+
+
+def probability_of_profit(candidates):
+    """
+    Probability the underlying ends between the breakevens
+    """
+    upper, lower = candidates.UpperBreakeven, candidates.LowerBreakeven
+    below_upper = np.where(np.isnan(upper), 1.0, _below(candidates, np.nan_to_num(upper)))
+    below_lower = np.where(np.isnan(lower), 0.0, _below(candidates, np.nan_to_num(lower)))
+    return below_upper - below_lower
+
+
+def expected_value(candidates):
+    """
+    Expected PnL per contract held to expiry, the legs valued at the candidate vols
+    """
+    strikes, years, vol = candidates.Strikes, candidates.Years[:, None], candidates.Vol[:, None]
+    rights = np.array([OptionRight.CALL, OptionRight.CALL, OptionRight.PUT, OptionRight.PUT])
+    value = black_scholes_price(rights, candidates.Spot, strikes, years, vol)
+    payout = value[:, 1] - value[:, 0] + value[:, 3] - value[:, 2]
+    return (candidates.Credit + payout) * PortfolioClass.OPTION_MULTIPLIER
+
+
+def return_on_risk(candidates):
+    """
+    Expected value per unit of max loss
+    """
+    return expected_value(candidates) / candidates.MaxLoss
+
+
+OBJECTIVES = {
+    "credit_to_width": credit_to_width,
+    "probability_of_profit": probability_of_profit,
+    "expected_value": expected_value,
+    "return_on_risk": return_on_risk,
+}
+
+
+def rank_condors(candidates, objective=credit_to_width, top=None):
+    """
+    :param candidates: CondorCandidates
+    :param objective: fn(CondorCandidates) -> array of scores, or a name in OBJECTIVES
+    :param top: number of candidates to return, all when None
+    :return: (CondorCandidates best first, their scores)
+    """
+    if not callable(objective):
+        objective = OBJECTIVES[objective]
+    scores = np.asarray(objective(candidates), dtype=np.float64)
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if top is not None and top < len(scores):
+        # only the top rows need sorting
+        rows = np.argpartition(-scores, top)[:top]
+        rows = rows[np.argsort(-scores[rows], kind='mergesort')]
+    else:
+        rows = np.argsort(-scores, kind='mergesort')
+    return candidates.Take(rows), scores[rows]
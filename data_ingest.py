@@ -0,0 +1,369 @@
+"""
+CSV market data for the BacktestEngine. One file per symbol per kind under a
+root directory, with a header row naming the columns:
+
+    <root>/<SYMBOL>_bars.csv    Time,Open,High,Low,Close,Volume
+    <root>/<SYMBOL>_quotes.csv  Time,Right,Strike,Expiry,BidPrice,AskPrice,UnderlyingLastPrice
+
+Times are "YYYY-MM-DD HH:MM:SS" (bar end / snapshot time) and files are sorted
+by time. Right is C or P. Each run of quote rows sharing a time is one option
+chain snapshot. Column names match bar_store.BAR_FIELDS and QUOTE_FIELDS.
+Fields are plain, unquoted values.
+
+Files are not parsed row by row, nor split into a Python string per field.
+They are read as bytes in blocks of chunk_bytes, fields are located from the
+offsets of the separators and each column is converted at once by NumPy,
+times and decimals included. read_batches yields the blocks as
+record arrays in time order, so memory is bounded by the block size however
+large the file. Parquet files (<SYMBOL>_bars.parquet, ...) with the same
+columns are read in batches through pyarrow when it is installed.
+"""
+from bisect import bisect_left
+from datetime import datetime
+import csv
+import os
+
+from lazy_import import lazy_import
+from qc_interface import ColumnarOptionChain, OptionRight, OptionSecurityObject
+from data_sources import DataSource, EventKind, RepeatedChainSource
+from bar_store import StoredOptionChain, record_dtype, time_bounds, snapshot_runs
+
+np = lazy_import("numpy", globals(), "np")
+
+BARS = "bars"
+QUOTES = "quotes"
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+CHUNK_BYTES = 1 << 22 # 4MB, roughly 60k bars or 40k quotes per block
+
+
+def csv_path(root, symbol, kind):
+    return os.path.join(root, "{}_{}.csv".format(symbol, kind))
+
+
+def data_path(root, symbol, kind):
+    """
+    :return: the CSV file of symbol and kind, or the Parquet file when there is no CSV
+    """
+    path = csv_path(root, symbol, kind)
+    parquet = path[:-len(".csv")] + ".parquet"
+    if not os.path.exists(path) and os.path.exists(parquet):
+        return parquet
+    return path
+
+
+def _lines(path, chunk_bytes):
+    # blocks of whole lines as bytes, the partial line at the end of a read is carried over
+    with open(path, "rb") as f:
+        header = f.readline()
+        yield header
+        rest = b""
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            if cut == 0:
+                rest = data
+                continue
+            rest = data[cut:]
+            yield data[:cut]
+        if rest.strip():
+            yield rest + b"\n"
+
+
+def _right_column(values):
+    return np.where((values == b"C") | (values == b"c") | (values == b"1"),
+                    OptionRight.CALL, OptionRight.PUT).astype(np.int8)
+
+
+def _trim(buf, starts, stops):
+    # moves field bounds past leading and trailing blanks, a pass per blank
+    while True:
+        lead = (starts < stops) & (buf[starts] == ord(" "))
+        if not lead.any():
+            break
+        starts[lead] += 1
+    while True:
+        trail = (stops > starts) & (buf[stops - 1] == ord(" "))
+        if not trail.any():
+            break
+        stops[trail] -= 1
+
+
+def _field_chars(buf, starts, stops):
+    """
+    Fields of one column copied out of the block, one row of bytes per field
+    :param buf: uint8 array of the block, padded with at least the widest field of zeros
+    :param starts, stops: byte offsets of the column's fields
+    :return: (fields, widest field) uint8 array zero padded past each field
+    """
+    lengths = stops - starts
+    width = max(1, int(lengths.max()))
+    chars = np.empty((len(starts), width), dtype=np.uint8)
+    # a gather per character position rather than per field
+    for j in range(width):
+        chars[:, j] = buf.take(starts + j)
+    chars[np.arange(width) >= lengths[:, None]] = 0
+    return chars
+
+
+def _as_bytes(chars):
+    return chars.view("S{}".format(chars.shape[1])).ravel()
+
+
+def _decimal_column(chars):
+    """
+    Plain decimals ([-]digits[.digits], at most 15 digits) are parsed from their
+    digits. Their mantissa and power of ten are exact doubles, so the quotient
+    is the correctly rounded value float() gives. Anything else (exponents,
+    longer mantissas) is left to NumPy's conversion
+    :param chars: fields as from _field_chars
+    :return: float64 array
+    """
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+    is_dot = chars == ord(".")
+    lengths = (chars != 0).sum(axis=1)
+    num_digits = is_digit.sum(axis=1)
+    num_dots = is_dot.sum(axis=1)
+    signed = (chars[:, 0] == ord("-")) | (chars[:, 0] == ord("+"))
+    plain = (num_digits + num_dots + signed == lengths) & (num_dots <= 1) & \
+        (num_digits > 0) & (num_digits <= 15)
+    values = np.empty(len(chars), dtype=np.float64)
+    if not plain.all():
+        values[~plain] = _as_bytes(chars[~plain]).astype(np.float64)
+        chars, is_digit, is_dot = chars[plain], is_digit[plain], is_dot[plain]
+        lengths, num_dots = lengths[plain], num_dots[plain]
+    # Horner's rule over the character positions, non digits leave the mantissa as is
+    digits = np.where(is_digit, chars - ord("0"), 0).astype(np.int64).T
+    scale = np.where(is_digit, 10, 1).astype(np.int64).T
+    mantissa = np.zeros(len(chars), dtype=np.int64)
+    for j in range(chars.shape[1]):
+        mantissa *= scale[j]
+        mantissa += digits[j]
+    decimals = np.where(num_dots > 0, lengths - 1 - is_dot.argmax(axis=1), 0)
+    parsed = mantissa / np.power(10.0, decimals)
+    parsed[chars[:, 0] == ord("-")] *= -1.0
+    values[plain] = parsed
+    return values
+
+
+def parse_block(block, header, dtype):
+    """
+    Parses a block of complete CSV lines without splitting it into Python strings
+    :param block: bytes of lines, each with len(header) fields
+    :param header: list of column names
+    :param dtype: record_dtype(BARS) or record_dtype(QUOTES)
+    :return: record array of dtype
+    """
+    # fields are located from the offsets of the separators in the block's bytes
+    buf = np.frombuffer(block, dtype=np.uint8)
+    stops = np.flatnonzero((buf == ord(",")) | (buf == ord("\n")))
+    if len(stops) % len(header):
+        raise ValueError("Malformed block, {} fields for {} columns".format(len(stops), len(header)))
+    starts = np.empty_like(stops)
+    starts[0] = 0
+    starts[1:] = stops[:-1] + 1
+    # zeros past the end, so gathers beyond the last field stay in bounds
+    buf = np.concatenate((buf, np.zeros(int((stops - starts).max()) + 1, dtype=np.uint8)))
+    starts = starts.reshape(-1, len(header))
+    stops = stops.reshape(-1, len(header))
+    records = np.zeros(len(starts), dtype=dtype)
+    for i, name in enumerate(header):
+        if name not in dtype.names:
+            continue
+        column_starts, column_stops = starts[:, i].copy(), stops[:, i].copy()
+        _trim(buf, column_starts, column_stops)
+        chars = _field_chars(buf, column_starts, column_stops)
+        if name == "Right":
+            records[name] = _right_column(_as_bytes(chars))
+        elif dtype[name].kind == "f":
+            records[name] = _decimal_column(chars)
+        else:
+            # datetime64 parses "YYYY-MM-DD HH:MM:SS"
+            records[name] = _as_bytes(chars).astype(dtype[name])
+    return records.view(np.recarray)
+
+
+def _read_csv_batches(path, dtype, chunk_bytes):
+    lines = _lines(path, chunk_bytes)
+    header = [name.strip() for name in next(lines).decode("ascii").strip().split(",")]
+    missing = [name for name in dtype.names if name not in header and name != "Volume"]
+    if missing:
+        raise ValueError("{} is missing columns {}".format(path, missing))
+    for block in lines:
+        # drop carriage returns and blank lines without splitting into lines
+        block = block.replace(b"\r", b"")
+        while b"\n\n" in block:
+            block = block.replace(b"\n\n", b"\n")
+        block = block.lstrip(b"\n")
+        if block:
+            yield parse_block(block, header, dtype)
+
+
+def _read_parquet_batches(path, dtype, chunk_bytes):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Reading {} needs pyarrow".format(path))
+    parquet = pq.ParquetFile(path)
+    batch_size = max(1, chunk_bytes // dtype.itemsize)
+    for batch in parquet.iter_batches(batch_size=batch_size):
+        columns = dict(zip(batch.schema.names, batch.columns))
+        records = np.zeros(batch.num_rows, dtype=dtype)
+        for name in dtype.names:
+            if name not in columns:
+                continue
+            values = columns[name].to_numpy(zero_copy_only=False)
+            if name == "Right" and values.dtype.kind in "OSU":
+                values = _right_column(values.astype(bytes))
+            records[name] = values.astype(dtype[name])
+        yield records.view(np.recarray)
+
+
+def read_batches(path, kind, chunk_bytes=CHUNK_BYTES):
+    """
+    :param path: CSV or Parquet file in the layout above
+    :param kind: BARS or QUOTES
+    :return: generator of record arrays of record_dtype(kind) in time order
+    """
+    read = _read_parquet_batches if path.endswith(".parquet") else _read_csv_batches
+    return read(path, record_dtype(kind), chunk_bytes)
+
+
+class CsvBarSource(DataSource):
+    """
+    Streams the bars of one symbol from <root>/<SYMBOL>_bars.csv. Each event's
+    data is a row of a parsed block, which exposes Open, High, Low, Close and
+    Volume as attributes like qc_interface.Bar
+    """
+
+    def __init__(self, root, symbol, chunk_bytes=CHUNK_BYTES):
+        self.path = data_path(root, symbol, BARS)
+        self.symbol = symbol
+        self.chunk_bytes = chunk_bytes
+
+    def Events(self, start, end):
+        # seeks when sent a time, see DataSource
+        for records in read_batches(self.path, BARS, self.chunk_bytes):
+            lo, hi = time_bounds(records, start, end)
+            times = records.Time[lo:hi].tolist()
+            i = 0
+            while i < len(times):
+                skip_to = yield times[i], EventKind.BAR, self.symbol, records[lo + i]
+                if skip_to is None:
+                    i += 1
+                else:
+                    start = max(start, skip_to)
+                    i = max(i + 1, bisect_left(times, skip_to))
+            if hi < len(records):
+                return # reached end
+
+
+class CsvOptionChainSource(DataSource):
+    """
+    Streams option chain snapshots of one symbol from <root>/<SYMBOL>_quotes.csv.
+    A snapshot split across two blocks is held back and joined with the next
+    """
+
+    def __init__(self, root, symbol, chunk_bytes=CHUNK_BYTES):
+        self.path = data_path(root, symbol, QUOTES)
+        self.symbol = symbol
+        self.chunk_bytes = chunk_bytes
+
+    def _Blocks(self):
+        carry = None
+        for records in read_batches(self.path, QUOTES, self.chunk_bytes):
+            if carry is not None:
+                records = np.concatenate((carry, records)).view(np.recarray)
+            # the last snapshot may continue in the next block
+            last = int(np.searchsorted(records.Time, records.Time[-1], side='left'))
+            carry = records[last:]
+            if last:
+                yield records[:last]
+        if carry is not None and len(carry):
+            yield carry
+
+    def Events(self, start, end):
+        for records in self._Blocks():
+            lo, hi = time_bounds(records, start, end)
+            starts, stops, snapshot_times = snapshot_runs(records, lo, hi)
+            i = 0
+            while i < len(starts):
+                chain = StoredOptionChain.FromRecords(self.symbol, records[starts[i]:stops[i]],
+                                                      presorted=False)
+                skip_to = yield snapshot_times[i], EventKind.OPTION_CHAIN, self.symbol, chain
+                if skip_to is None:
+                    i += 1
+                else:
+                    start = max(start, skip_to)
+                    i = max(i + 1, bisect_left(snapshot_times, skip_to))
+            if hi < len(records):
+                return
+
+
+def csv_sources(root):
+    """
+    Source factory for BacktestEngine reading every security of the algorithm
+    from CSV files under root
+    :return: fn(algorithm, start, end) -> list of DataSource
+    """
+    def make_sources(algorithm, start, end):
+        sources = []
+        for security in algorithm.Securities:
+            if isinstance(security, OptionSecurityObject):
+                sources.append(RepeatedChainSource(CsvOptionChainSource(root, security.symbol),
+                                                   security.Resolution))
+            else:
+                sources.append(CsvBarSource(root, security.symbol))
+        return sources
+    return make_sources
+
+
+def write_csv(root, sources, start, end):
+    """
+    Writes the events of other sources (E.g synthetic ones) in the CSV layout
+    above. Like bar_store.write_events a chain object reused across bars is
+    written once, and csv_sources repeats it at every bar time
+    :return: number of rows written
+    """
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    written = 0
+    for source in sources:
+        files = {}  # (symbol, kind) -> csv writer
+        handles = []
+        last_chain = None
+        try:
+            for t, kind, symbol, data in source.Events(start, end):
+                if kind == EventKind.OPTION_CHAIN and data is last_chain:
+                    continue
+                key = (symbol, BARS if kind == EventKind.BAR else QUOTES)
+                writer = files.get(key)
+                if writer is None:
+                    f = open(csv_path(root, symbol, key[1]), "w")
+                    handles.append(f)
+                    writer = files[key] = csv.writer(f, lineterminator="\n")
+                    writer.writerow(["Time", "Open", "High", "Low", "Close", "Volume"] if key[1] == BARS else
+                                    ["Time", "Right", "Strike", "Expiry", "BidPrice", "AskPrice",
+                                     "UnderlyingLastPrice"])
+                time_text = t.strftime(TIME_FORMAT)
+                if kind == EventKind.BAR:
+                    writer.writerow([time_text] + [repr(float(v)) for v in (
+                        data.Open, data.High, data.Low, data.Close, getattr(data, 'Volume', 0.0))])
+                    written += 1
+                    continue
+                last_chain = data
+                chain = ColumnarOptionChain.FromContracts(data.Value)
+                expiries = chain.Expiry.astype(datetime).tolist()
+                for i in range(len(chain)):
+                    writer.writerow([time_text, "C" if chain.Right[i] == OptionRight.CALL else "P",
+                                     repr(float(chain.Strike[i])), expiries[i].strftime(TIME_FORMAT),
+                                     repr(float(chain.BidPrice[i])), repr(float(chain.AskPrice[i])),
+                                     repr(float(chain.UnderlyingLastPrice))])
+                written += len(chain)
+        finally:
+            for f in handles:
+                f.close()
+    return written
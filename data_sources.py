@@ -0,0 +1,264 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+from lazy_import import lazy_import
+from qc_interface import Resolution, Bar, OptionChain, SecurityObject, OptionSecurityObject
+
+np = lazy_import("numpy", globals(), "np")
+
+
+class EventKind:
+    # ordering matters, at equal times bars are dispatched before chains
+    BAR = 0
+    OPTION_CHAIN = 1
+
+
+# offsets from midnight of the regular session
+SESSION_OPEN = timedelta(hours=9, minutes=30)
+SESSION_CLOSE = timedelta(hours=16)
+
+# bar period per resolution. Tick and Second are treated as Minute locally
+RESOLUTION_PERIOD = {
+    Resolution.Tick: timedelta(minutes=1),
+    Resolution.Second: timedelta(minutes=1),
+    Resolution.Minute: timedelta(minutes=1),
+    Resolution.Hourly: timedelta(hours=1),
+    Resolution.Daily: SESSION_CLOSE - SESSION_OPEN,
+}
+
+
+def session_times(start, end, resolution):
+    """
+    End times of the bars of every weekday session in [start, end)
+    :param start: datetime
+    :param end: datetime
+    :param resolution: Resolution enum
+    :return: list of datetimes in ascending order
+    """
+    period = RESOLUTION_PERIOD[resolution]
+    bars_per_session = int((SESSION_CLOSE - SESSION_OPEN).total_seconds() // period.total_seconds())
+    times = []
+    day = datetime(start.year, start.month, start.day)
+    while day < end:
+        if day.weekday() < 5:
+            open_time = day + SESSION_OPEN
+            for i in range(1, bars_per_session + 1):
+                t = open_time + i * period
+                if start <= t < end:
+                    times.append(t)
+        day += timedelta(days=1)
+    return times
+
+
+class DataSource(object):
+    """
+    A stream of time ordered market events for the BacktestEngine.
+    Subclasses implement Events, which yields (time, kind, symbol, data)
+    tuples with non decreasing time. kind is an EventKind and data is a Bar
+    for BAR events and an OptionChain for OPTION_CHAIN events.
+    Events may also be a generator that seeks: a time sent to it makes it resume
+    at its first event at or after that time, skipping the ones in between
+    without building them. The engine uses this to skip slices the algorithm
+    does not consume, sources that ignore sent values are read through instead.
+    """
+
+    def Events(self, start, end):
+        raise NotImplementedError("Events not overriden")
+
+
+class SyntheticPricePath(object):
+    """
+    Geometric random walk of an underlying sampled at the bar times of a
+    resolution. Shared by the bar and chain sources of one symbol so quotes
+    and bars agree.
+    """
+
+    def __init__(self, start, end, resolution, price=2000.0, volatility=0.05, seed=0):
+        """
+        :param price: price at start
+        :param volatility: annualised volatility of the walk
+        :param seed: random seed, equal seeds give equal paths
+        """
+        self.times = session_times(start, end, resolution)
+        self.volatility = volatility
+        period = RESOLUTION_PERIOD[resolution]
+        periods_per_year = 252.0 * (SESSION_CLOSE - SESSION_OPEN).total_seconds() / period.total_seconds()
+        rng = np.random.RandomState(seed)
+        sigma = volatility / np.sqrt(periods_per_year)
+        log_returns = rng.normal(-0.5 * sigma * sigma, sigma, len(self.times))
+        self.closes = price * np.exp(np.cumsum(log_returns))
+        self.opens = np.concatenate(([price], self.closes[:-1]))
+        self.index = dict((t, i) for i, t in enumerate(self.times))
+
+    def PriceAt(self, time):
+        return float(self.closes[self.index[time]])
+
+    def PriceAsOf(self, time):
+        """
+        :return: last close at or before time, the starting price before the first bar
+        """
+        i = bisect_right(self.times, time)
+        return float(self.closes[i - 1]) if i else float(self.opens[0])
+
+    def PriceRange(self, start, end):
+        """
+        :return: (lowest, highest) price from the one as of start to the last close at or before end
+        """
+        first = self.PriceAsOf(start)
+        closes = self.closes[bisect_right(self.times, start):bisect_right(self.times, end)]
+        if not len(closes):
+            return first, first
+        return min(first, float(closes.min())), max(first, float(closes.max()))
+
+
+class SyntheticBarSource(DataSource):
+    """
+    Bars at resolution aggregated from a price path of the same or a finer resolution
+    """
+
+    def __init__(self, symbol, path, resolution):
+        self.symbol = symbol
+        self.path = path
+        self.resolution = resolution
+
+    def Events(self, start, end):
+        path = self.path
+        period = RESOLUTION_PERIOD[self.resolution]
+        times = session_times(start, end, self.resolution)
+        i = 0
+        while i < len(times):
+            t = times[i]
+            last = path.index[t]
+            first = last
+            while first > 0 and path.times[first - 1] > t - period:
+                first -= 1
+            bar = Bar(self.symbol)
+            bar.Open = float(path.opens[first])
+            bar.Close = float(path.closes[last])
+            bar.High = max(bar.Open, float(path.closes[first:last + 1].max()))
+            bar.Low = min(bar.Open, float(path.closes[first:last + 1].min()))
+            skip_to = yield t, EventKind.BAR, self.symbol, bar
+            i = i + 1 if skip_to is None else max(i + 1, bisect_left(times, skip_to))
+
+
+class SyntheticOptionChainSource(DataSource):
+    """
+    One chain per bar time. The listed contracts only change once per day, so
+    the chain built at the first bar of a day is reused for the rest of it.
+    Chains are lazy and only list what option_filter lets through.
+    An expiry is listed max_expiry days before it, and like exchange listed
+    strikes its strikes are only ever added: it lists the filter's strike
+    window around every price the underlying has traded at since then, so a
+    contract stays in the chain until it expires however far the underlying moves.
+    """
+
+    def __init__(self, symbol, path, resolution, option_filter=None):
+        """
+        :param option_filter: OptionSecurityObject.Filter, defaults to +-20 strikes and 30 days
+        """
+        self.symbol = symbol
+        self.path = path
+        self.resolution = resolution
+        self.option_filter = option_filter or (-20, 20, timedelta(0), timedelta(30))
+
+    def StrikeBounds(self, expiry, time):
+        """
+        :return: (lowest, highest) underlying price since expiry was listed, up to time
+        """
+        listed = datetime(expiry.year, expiry.month, expiry.day) - self.option_filter[3] + SESSION_OPEN
+        return self.path.PriceRange(min(listed, time), time)
+
+    def Events(self, start, end):
+        chain = None
+        chain_date = None
+        times = session_times(start, end, self.resolution)
+        first_bar = SESSION_OPEN + RESOLUTION_PERIOD[self.resolution]
+        i = 0
+        while i < len(times):
+            t = times[i]
+            if t.date() != chain_date:
+                chain_date = t.date()
+                # built as of the first bar of the day even when start or a seek is later in it,
+                # so every run sees the same quotes
+                listed = datetime(t.year, t.month, t.day) + first_bar
+                chain = OptionChain.FromFilter(self.symbol, listed, self.option_filter,
+                                               underlying_price=self.path.PriceAsOf(listed),
+                                               volatility=self.path.volatility,
+                                               strike_bounds=lambda expiry, t=listed: self.StrikeBounds(expiry, t))
+            skip_to = yield t, EventKind.OPTION_CHAIN, self.symbol, chain
+            i = i + 1 if skip_to is None else max(i + 1, bisect_left(times, skip_to))
+
+
+class RepeatedChainSource(DataSource):
+    """
+    The chain snapshots of another source repeated at every bar time of a
+    resolution, from the snapshot's time until the next snapshot or the end of
+    its day, like the synthetic chains. Stores written by bar_store.write_events
+    and data_ingest.write_csv hold a chain once however many bars it was
+    reused for, so without this a strategy trading after the first bar of a
+    session would see no chain. A snapshot between two bar times is first
+    dispatched at the next one
+    """
+
+    def __init__(self, source, resolution):
+        """
+        :param source: DataSource of OPTION_CHAIN events
+        """
+        self.source = source
+        self.resolution = resolution
+
+    def Events(self, start, end):
+        # seeks when sent a time, the wrapped source is seeked to the day of it
+        times = session_times(start, end, self.resolution)
+        events = iter(self.source.Events(start, end))
+        send = getattr(events, 'send', None)
+        pending = next(events, None) # next snapshot not dispatched yet
+        current = None
+        i = 0 if pending is None else bisect_left(times, pending[0])
+        while i < len(times):
+            t = times[i]
+            while pending is not None and pending[0] <= t:
+                current = pending
+                pending = next(events, None)
+            if current is None or current[0].date() != t.date():
+                # nothing quoted yet today, resume at the next snapshot
+                if pending is None:
+                    return
+                i = bisect_left(times, pending[0])
+                continue
+            skip_to = yield t, EventKind.OPTION_CHAIN, current[2], current[3]
+            if skip_to is None:
+                i += 1
+                continue
+            i = max(i + 1, bisect_left(times, skip_to))
+            day = datetime(skip_to.year, skip_to.month, skip_to.day)
+            if send is not None and pending is not None and pending[0] < day:
+                # snapshots of the days in between are never dispatched
+                try:
+                    pending = send(day)
+                except StopIteration:
+                    pending = None
+
+
+def synthetic_sources(algorithm, start, end, seed=0):
+    """
+    Synthetic sources for every security added to algorithm. Securities of the
+    same symbol share one price path at the finest resolution requested.
+    :return: list of DataSource
+    """
+    resolutions = {}
+    for security in algorithm.Securities:
+        resolutions[security.symbol] = min(resolutions.get(security.symbol, Resolution.Daily),
+                                           security.Resolution)
+    paths = {}
+    for i, symbol in enumerate(sorted(resolutions)):
+        paths[symbol] = SyntheticPricePath(start, end, resolutions[symbol], seed=seed + i)
+    sources = []
+    for security in algorithm.Securities:
+        if isinstance(security, OptionSecurityObject):
+            sources.append(SyntheticOptionChainSource(security.symbol, paths[security.symbol],
+                                                      security.Resolution, security.Filter))
+        elif isinstance(security, SecurityObject):
+            sources.append(SyntheticBarSource(security.symbol, paths[security.symbol],
+                                              security.Resolution))
+    return sources
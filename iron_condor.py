@@ -1,6 +1,12 @@
 # My imports
-from qc_utils import SlidingWindow
-from qc_interface import QCAlgorithm, Resolution
+from qc_utils import RollingStatsBank, TradingCalendar, SessionExecutor, AlgorithmLogger, LogLevel
+from qc_interface import QCAlgorithm, Resolution, ColumnarOptionChain, OptionRight
+from leg_selection import first_common_expiry, select_iron_condor_legs, select_by_delta, delta_range
+from option_pricing import chain_greeks
+from vol_surface import ImpliedVolSurface
+from payoff import Legs, risk_summary
+from condor_search import enumerate_condors, rank_condors
+from position_tracker import PositionTracker, PositionScheduler
 
 # Std lib imports
 from datetime import datetime, timedelta
@@ -27,142 +33,145 @@ class IronCondorAlgorithm(QCAlgorithm):
         def GetQty(cls, qty, position):
             return qty if position == cls.LONG else -qty
 
-    class PositionTracker:
-
-        def __init__(self):
-            self.positions = dict() # a map of contract symbol to positions held
-
-
-        def UpdatePositon(self, symbol, total_added):
-            """
-            Update symbol with the total added
-            :param symbol: Symbol of the instrument
-            :param total_added: int. Can be positive or negative
-            :return: new total
-            """
-            if not (symbol in self.positions):
-                self.positions[symbol] = 0
-            self.positions[symbol] += total_added
-            return self.positions[symbol]
-
-        def GetCurrPosition(self, symbol):
-            return 0 if not (symbol in self.positions) else self.positions[symbol]
-
-        # returns a [(symbol, qty)] array required to close out current position
-        # empty array if isFlat
-        def ToCloseOrders(self):
-            ret = []
-            for symbol in self.positions.keys():
-                if self.positions[symbol] != 0:
-                    ret.append((symbol, -self.positions[symbol]))
-            return ret
-
-        def IsFlat(self):
-            """
-            Returns True if no positions held
-            :return: boolean
-            """
-            for v in self.positions.values():
-                if v != 0:
-                    return False
-            return True
-
-    def ConvertDailyResolution(self, data_handler):
+    LOG_RATE_LIMIT = (200, 24 * 60 * 60) # (messages, seconds)
+
+    # kept as a class attribute so subclasses can swap the tracker
+    PositionTracker = PositionTracker
+
+    def ConvertDailyResolution(self, data_handler, offset=timedelta(0)):
         """
         Options can only execute at minute intervals This function converts the
-        data_handler to exectue at daily intervals
+        data_handler to execute once per trading session, on the first slice at
+        or after the session open plus offset. Sessions span the warm up period
         :param data_handler: Type = fn(slice)
+        :param offset: timedelta after the session open
         :return: Type = fn(slice)
         """
+        calendar = TradingCalendar.covering(self.StartDate, self.EndDate, self.lookback)
+        executor = SessionExecutor(self, data_handler, calendar, offset)
+        # local harness only, lets the backtest feed skip the minutes in between
+        if hasattr(self, "SetDataSchedule"):
+            self.SetDataSchedule(executor)
+        return executor
+
+
+    def GetColumnarChain(self, option_chain):
+        """
+        Columnar view of option_chain. The last conversion is cached so a chain
+        object seen again (E.g across rebalances in the same slice) is only
+        split and sorted once
+        :param option_chain: OptionChain value or ColumnarOptionChain
+        :return: ColumnarOptionChain
+        """
+        cached_chain, columnar = self.columnar_cache
+        if cached_chain is not option_chain:
+            columnar = ColumnarOptionChain.FromContracts(option_chain)
+            self.columnar_cache = (option_chain, columnar)
+        return columnar
+
+    def GetChainGreeks(self, chain):
+        """
+        Implied volatilities and greeks of every contract of chain, cached like
+        GetColumnarChain. Volatilities come from vol_surface, which carries them
+        across chains and only re-solves the quotes that moved
+        :param chain: ColumnarOptionChain
+        :return: option_pricing.ChainGreeks
+        """
+        cached_chain, greeks = self.greeks_cache
+        if cached_chain is not chain:
+            greeks = chain_greeks(chain, self.Time, rate=self.risk_free_rate, surface=self.vol_surface)
+            self.greeks_cache = (chain, greeks)
+        return greeks
 
-        class DailyExecutor(object):
-            # qc_instance in the instanceof qc_algorithm
-            def __init__(self, qc_instance, handler):
-                self.last_date = None # last date handler was called
-                self.handler = handler
-                self.first_call = True # flag to check first time __call__ is called
-                self.qc = qc_instance
-
-            def __call__(self, slice):
-                if self.first_call:
-                    self.handler(slice)
-                    self.last_date = self.qc.Time
-                    self.first_call = False
-                time_diff = self.qc.Time - self.last_date
-                if time_diff.days >= 1:
-                    # need >= 1 as may be weekend gap
-                    self.handler(slice)
-                    assert self.last_date is not self.qc.Time, "Time object is mutated"
-                    self.last_date = self.qc.Time
-
-        return DailyExecutor(self, data_handler)
+    def ShortStrikes(self, chain, expiry):
+        """
+        Strikes targeted by the short legs. The contracts nearest short_delta when
+        it is set, otherwise scale_std standard deviations either side of the price
+        :return: (short call strike, short put strike), None if short_delta can not be
+                 met, the reason is logged
+        """
+        if self.short_delta > 0:
+            greeks = self.GetChainGreeks(chain)
+            strikes = []
+            for right, name in ((OptionRight.CALL, "call"), (OptionRight.PUT, "put")):
+                deltas = delta_range(chain, right, expiry, greeks.Delta)
+                if deltas is None:
+                    self.logger.warning("Cannot create Iron Condor. No implied volatilities in Chain")
+                    return None
+                if not deltas[0] <= self.short_delta <= deltas[1]:
+                    # the option filter does not list strikes far enough out
+                    self.logger.warning("Cannot create Iron Condor. short_delta %.2f outside the %s deltas "
+                                        "%.3f to %.3f of the chain, widen the option filter",
+                                        self.short_delta, name, deltas[0], deltas[1])
+                    return None
+                index = select_by_delta(chain, right, expiry, greeks.Delta, self.short_delta)[0]
+                strikes.append(float(chain.Strike[index]))
+            return tuple(strikes)
+        stock_price = float(chain.UnderlyingLastPrice)
+        std = self.rolling_stats.get_std(self.symbol)  # float
+        # ensure does not go below 0
+        return stock_price + (self.scale_std * std), max(0.0, stock_price - (self.scale_std * std))
 
+    def SearchCondorLegs(self, chain):
+        """
+        Best iron condor of the chain by objective, over every expiry after the
+        holding period and wings up to spread_width wide
+        :param chain: ColumnarOptionChain
+        :return: (4,) chain indices as select_iron_condor_legs, None if no condor qualifies
+        """
+        candidates = enumerate_condors(chain, self.Time, min_expiry=self.Time + self.holding_period,
+                                       max_width=self.spread_width, vol=self.GetChainGreeks(chain).ImpliedVol)
+        best, scores = rank_condors(candidates, self.objective, top=1)
+        if not len(best):
+            return None
+        self.logger.debug("Best of %d condors by %s scores %.4f", len(candidates), self.objective, scores[0])
+        return best.Legs[0]
 
     def IronCondor(self, trade_position, option_chain, qty=1):
         """
         Obtains the contracts to open an iron condor in direction of trade_position
         :param trade_position: Short or Long using TradePosition enum
-        :param option_chain: OptionChain object
+        :param option_chain: OptionChain object or ColumnarOptionChain
         :return: [(Option, qty)]
         """
-        calls = []
-        puts = []
-        for o in option_chain:
-            if o.Right == self.OptionType.CALL:
-                calls.append(o)
-            elif o.Right == self.OptionType.PUT:
-                puts.append(o)
-
-        # filter out valid expiry dates
-        min_date = self.Time + self.holding_period
-
-        def filter_fn(x):
-            return x.Expiry > min_date  # expires after min_date
-
-        calls = filter(filter_fn, calls)
-        puts = filter(filter_fn, puts)
-        # sort the calls and puts by (expiry, strike)
-        calls = sorted(calls, key=lambda x: (x.Expiry, x.Strike))
-        puts = sorted(puts, key=lambda x: (x.Expiry, x.Strike))
-        if not calls or not puts:
-            self.Debug("Cannot create Iron Condor. Not enough options in Chain")
+        chain = self.GetColumnarChain(option_chain)
+        if self.objective:
+            legs = self.SearchCondorLegs(chain)
+            if legs is None:
+                self.logger.warning("Cannot create Iron Condor. No candidate in Chain")
+                return []
+            return self.CondorOrders(chain, legs, trade_position, qty)
+        # all four legs share the earliest expiry after the holding period
+        expiry = first_common_expiry(chain, self.Time + self.holding_period)
+        if expiry is None:
+            self.logger.warning("Cannot create Iron Condor. Not enough options in Chain")
             return []
         # Open the iron condor positions
-        stock_price = float(calls[0].UnderlyingLastPrice)
-        std = self.sliding_window.get_std()  # float
-        short_call_strike = stock_price + (self.scale_std * std)
+        short_strikes = self.ShortStrikes(chain, expiry)
+        if short_strikes is None:
+            return []
+        short_call_strike, short_put_strike = short_strikes
         long_call_strike = short_call_strike + self.spread_width
-        # ensure does not go below 0
-        short_put_strike = max(0.0, stock_price - (self.scale_std * std))
         long_put_strike = max(0.0, short_put_strike - self.spread_width)
-        orders = []  # tuples of (symbol, qty)
-        short_added = False
+        legs = select_iron_condor_legs(chain, expiry, short_call_strike, long_call_strike,
+                                       short_put_strike, long_put_strike)[0]
+        if legs[0] < 0:
+            self.logger.warning("Cannot create a full iron condor, no strikes listed for %.1f/%.1f/%.1f/%.1f",
+                                short_call_strike, long_call_strike, short_put_strike, long_put_strike)
+            return []
+        return self.CondorOrders(chain, legs, trade_position, qty)
+
+    def CondorOrders(self, chain, legs, trade_position, qty):
+        """
+        :param legs: chain indices ordered short call, long call, short put, long put
+        :return: [(Option, qty)]
+        """
         inv_trade_position = self.TradePosition.LONG if trade_position == self.TradePosition.SHORT else\
             self.TradePosition.SHORT
-        for call in calls:
-            if not short_added and float(call.Strike) >= short_call_strike:
-                # only happens once
-                orders.append((call,
-                               self.TradePosition.GetQty(qty, trade_position)))
-                short_added = True
-            elif short_added and float(call.Strike) >= long_call_strike:
-                orders.append((call, self.TradePosition.GetQty(qty, inv_trade_position)))
-                break
-        short_added = False
-        for put in puts:
-            if not short_added and float(put.Strike) <= short_put_strike:
-                # only happens once
-                orders.append((put, self.TradePosition.GetQty(qty, trade_position)))
-                short_added = True
-            elif short_added and float(put.Strike) <= long_put_strike:
-                orders.append((put, self.TradePosition.GetQty(qty, inv_trade_position)))
-                break
-        if len(orders) == 0:
-            self.Debug("Cannot create a full iron condor")
-            return []
-        elif orders and len(orders) != 4:
-            self.Debug("Iron Condor must have multiple of 4 contracts")
-            return []
+        # tuples of (Option, qty) ordered short call, long call, short put, long put
+        positions = [trade_position, inv_trade_position, trade_position, inv_trade_position]
+        orders = [(chain.Contract(i), self.TradePosition.GetQty(qty, position))
+                  for i, position in zip(legs, positions)]
         return orders
 
 
@@ -173,8 +182,9 @@ class IronCondorAlgorithm(QCAlgorithm):
         :param curr_positions: PositionTracker object
         :param signal: signal return value from GetSignal
         """
-        # do nothing if position held or singal is not open
-        if not (signal == self.SignalType.OPEN) or not curr_positions.IsFlat():
+        # do nothing if singal is not open or the structure limit is reached
+        if not (signal == self.SignalType.OPEN) or \
+                curr_positions.NumOpenStructures() >= self.max_open_structures:
             return
         chain = None
         for o in slice.OptionChains:
@@ -182,18 +192,29 @@ class IronCondorAlgorithm(QCAlgorithm):
                 chain = o.Value
                 break
         if not chain:
-            self.Debug("Option Chain should not be None in OpenPosition")
+            self.logger.warning("Option Chain should not be None in OpenPosition")
             return
         orders = self.IronCondor(self.TradePosition.SHORT, chain, qty=1)
-        # make the orders and update position tracker
-        self.Debug("Making Market Orders to Open {}".format(orders))
-        for option, qty in orders:
-            self.MarketOrder(option.Symbol, qty)
-            self.position_tracker.UpdatePositon(option.Symbol, qty)
-        # set the current expiry date of position held. Assumes all positions have same expiry
         if orders:
-            self.curr_expiry = orders[0][0].Expiry
-            self.Debug("Opened on {}, To Close on {}".format(self.Time, self.curr_expiry))
+            # expiry risk of the structure at the prices it would fill at
+            risk = risk_summary(Legs.FromOrders(orders))
+            max_loss, breakevens = float(risk.MaxLoss[0]), risk.Breakevens[0]
+            self.logger.debug("Max loss %.2f, max profit %.2f, breakevens %s", max_loss,
+                              float(risk.MaxProfit[0]), breakevens[breakevens == breakevens].tolist())
+            if self.max_loss and -max_loss > self.max_loss:
+                self.logger.warning("Not opening, max loss %.2f exceeds %.2f", -max_loss, self.max_loss)
+                return
+        # make the orders and update position tracker with the legs that filled
+        self.logger.debug("Making Market Orders to Open %s", orders)
+        filled = [(option.Symbol, qty) for option, qty in orders if self.MarketOrder(option.Symbol, qty) is not None]
+        if len(filled) < len(orders):
+            self.logger.warning("Only %d of %d legs filled", len(filled), len(orders))
+        # schedule the structure to close at expiry. All legs have the same expiry
+        if filled:
+            expiry = orders[0][0].Expiry
+            structure_id = curr_positions.OpenStructure(filled, expiry)
+            self.scheduler.Schedule(structure_id, expiry)
+            self.logger.info("Opened on %s, To Close on %s", self.Time, expiry)
         return
 
 
@@ -203,8 +224,8 @@ class IronCondorAlgorithm(QCAlgorithm):
         :param slice: slice object from onData
         :param signal: signal return value from GetSignal
         """
-        # do nothing if no positions or not correct signal
-        if not (signal == self.SignalType.CLOSE) or curr_position.IsFlat():
+        # do nothing if not correct signal
+        if not (signal == self.SignalType.CLOSE):
             return
         chain = None
         for o in slice.OptionChains:
@@ -212,17 +233,23 @@ class IronCondorAlgorithm(QCAlgorithm):
                 chain = o.Value
                 break
         if not chain:
-            self.Debug("Option Chain should not be None in OpenPosition")
+            self.logger.warning("Option Chain should not be None in OpenPosition")
             return
         # orders = self.IronCondor(self.TradePosition.LONG, chain, qty=1)
-        orders = curr_position.ToCloseOrders()
-        self.Debug("Making Market Orders to Close {}".format(orders))
-        # update position tracker and close current positions
-        for symbol, qty in orders:
-            self.MarketOrder(symbol, qty)
-            self.position_tracker.UpdatePositon(symbol, qty)
-        assert self.position_tracker.IsFlat(), "Should be flat after closing"
-        self.curr_expiry = None
+        # close the structures that are due and update position tracker with the legs that closed
+        retry = []
+        for structure_id in self.scheduler.PopDue(self.Time):
+            orders = [(symbol, -qty) for symbol, qty in curr_position.GetStructure(structure_id).legs]
+            self.logger.debug("Making Market Orders to Close %s", orders)
+            # legs the portfolio no longer holds were settled when they expired
+            closed = [(symbol, qty) for symbol, qty in orders
+                      if not self.Portfolio[symbol].Invested or self.MarketOrder(symbol, qty) is not None]
+            if curr_position.CloseLegs(structure_id, closed):
+                retry.append(structure_id)
+        # structures with unfilled legs stay due, they are closed on the next session
+        for structure_id in retry:
+            self.logger.warning("Structure %d not fully closed, retrying", structure_id)
+            self.scheduler.Schedule(structure_id, self.Time)
         return
 
 
@@ -230,20 +257,46 @@ class IronCondorAlgorithm(QCAlgorithm):
     # configure algorithm, setup positions/instruments
     # only called once in Initialize
     def InitPreWarmUp(self):
-        self.curr_expiry = None
+        # at most LOG_RATE_LIMIT messages per day of algorithm time, QC caps the log size
+        self.logger = AlgorithmLogger(lambda msg: self.Debug(msg),
+                                      LogLevel.from_name(self.GetTypedParameter("log_level", "info", str)),
+                                      rate_limit=self.LOG_RATE_LIMIT, clock=lambda: self.Time)
         self.position_tracker = self.PositionTracker()
+        self.scheduler = PositionScheduler() # close times of the open structures
+        self.columnar_cache = (None, None)
+        self.greeks_cache = (None, None)
         self.symbol = "SPY"
         self.option = self.AddOption(self.symbol, Resolution.Minute)
         self.option.SetFilter(-20, 20, timedelta(0), timedelta(30))
         self.equity = self.AddEquity(self.symbol, Resolution.Minute)
-        self.lookback = 14 # 14 day lookback period
-        self.sliding_window = SlidingWindow(self.lookback)
-        self.scale_std = 1.0
-        self.spread_width = 4.0
-        self.holding_period = timedelta(days=14)
+        # tuning knobs, can be overriden by algorithm parameters
+        self.lookback = self.GetTypedParameter("lookback", 14, int) # 14 day lookback period
+        self.rolling_stats = RollingStatsBank([self.symbol], self.lookback)
+        self.scale_std = self.GetTypedParameter("scale_std", 1.0, float)
+        self.spread_width = self.GetTypedParameter("spread_width", 4.0, float)
+        self.holding_period = timedelta(days=self.GetTypedParameter("holding_period", 14, int))
+        # absolute delta of the short legs, 0 keeps the scale_std rule
+        self.short_delta = self.GetTypedParameter("short_delta", 0.0, float)
+        self.risk_free_rate = self.GetTypedParameter("risk_free_rate", 0.0, float)
+        self.vol_surface = ImpliedVolSurface(rate=self.risk_free_rate)
+        # largest loss at expiry accepted for a new structure, 0 for no limit
+        self.max_loss = self.GetTypedParameter("max_loss", 0.0, float)
+        # condor_search objective picking the condor to open, empty keeps the fixed strike rule
+        self.objective = self.GetTypedParameter("objective", "", str)
+        self.max_open_structures = self.GetTypedParameter("max_open_structures", 1, int)
+        self.session_offset = timedelta(minutes=self.GetTypedParameter("session_offset", 0, int))
         self.SetWarmUp(self.lookback)
         return
 
+    def GetTypedParameter(self, name, default, cast):
+        """
+        :param name: parameter name
+        :param default: value used when the parameter is not set
+        :param cast: type to convert to, Quant connect parameters are strings
+        """
+        value = self.GetParameter(name)
+        return default if value is None else cast(value)
+
     # additional setup after warm up period
     # only called once
     def InitPostWarmUp(self):
@@ -252,32 +305,32 @@ class IronCondorAlgorithm(QCAlgorithm):
     def GetSignal(self, slice):
         '''
         Function to generate the entry signal.
-        OPEN signal when no positions held
-        CLOSE signal when expiry date reached
+        CLOSE signal when a structure's expiry date is reached
+        OPEN signal when fewer than max_open_structures are held
         NONE in all other cases
         slice: slice object from OnData
         :return: Returns a value which is used by Position object
         '''
         signal = self.SignalType.NONE
-        if self.position_tracker.IsFlat():
-            self.Debug("Open signal generated")
-            signal = self.SignalType.OPEN
-        elif self.curr_expiry and (not self.position_tracker.IsFlat()) and\
-                self.curr_expiry.date() <= self.Time.date():
-            self.Debug("Close signal generated")
+        # expiries are at midnight, so due by Time is the same as expiry date <= Time date
+        if self.scheduler.HasDue(self.Time):
+            self.logger.debug("Close signal generated")
             signal = self.SignalType.CLOSE
+        elif self.position_tracker.NumOpenStructures() < self.max_open_structures:
+            self.logger.debug("Open signal generated")
+            signal = self.SignalType.OPEN
         return signal
 
     # function to be converted by ConvertDailyResolution
     def DataHandler(self, slice):
         bar = slice[self.symbol]
         mid = Decimal(bar.Open + bar.Close) / Decimal(2.0)
-        self.sliding_window.update(float(mid))
+        self.rolling_stats.update([float(mid)])
         if not self.warmed_up and not self.IsWarmingUp:
             # just finished warming up
             self.warmed_up = True
             self.InitPostWarmUp()
-        if self.warmed_up and self.sliding_window.get_std():
+        if self.warmed_up and self.rolling_stats.get_std(self.symbol):
             signal = self.GetSignal(slice)
             self.OpenPosition(slice, self.position_tracker, signal)
             self.ClosePosition(slice, self.position_tracker, signal)
@@ -295,7 +348,27 @@ class IronCondorAlgorithm(QCAlgorithm):
         self.warmed_up = False
 
         # datetime obj must be the same as the StartDate in SetStartDate
-        self.OnDataHandler = self.ConvertDailyResolution(self.DataHandler)
+        self.session_executor = self.ConvertDailyResolution(self.DataHandler, self.session_offset)
+        self.OnDataHandler = self.session_executor
+
+    def GetState(self):
+        """
+        Snapshot of everything derived from past data, see QCAlgorithm.SaveState
+        """
+        return {
+            "warmed_up": self.warmed_up,
+            "rolling_stats": self.rolling_stats.get_state(),
+            "position_tracker": self.position_tracker.GetState(),
+            "scheduler": self.scheduler.GetState(),
+            "session_executor": self.session_executor.get_state(),
+        }
+
+    def SetState(self, state):
+        self.warmed_up = state["warmed_up"]
+        self.rolling_stats.set_state(state["rolling_stats"])
+        self.position_tracker.SetState(state["position_tracker"])
+        self.scheduler.SetState(state["scheduler"])
+        self.session_executor.set_state(state["session_executor"])
 
     def OnData(self, slice):
         '''OnData event is the primary entry point for your algorithm. Each new data point will be pumped in here.
@@ -307,7 +380,5 @@ class IronCondorAlgorithm(QCAlgorithm):
 
 
 
-
-
-ic = IronCondorAlgorithm()
-ic.TestRun()
\ No newline at end of file
+if __name__ == "__main__":
+    IronCondorAlgorithm().TestRun()
@@ -0,0 +1,33 @@
+"""
+Deferred imports, so importing a module does not load a heavy dependency
+(E.g NumPy) until something is actually computed with it.
+
+    np = lazy_import("numpy", globals(), "np")
+"""
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stands in for a module until an attribute is read from it. The module is
+    then imported and rebinds the name the stand in was bound to, so later
+    lookups go straight to the module
+    """
+
+    def __init__(self, name, namespace, alias):
+        self.__dict__.update(_name=name, _namespace=namespace, _alias=alias)
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        self._namespace[self._alias] = module
+        return getattr(module, attr)
+
+
+def lazy_import(name, namespace, alias=None):
+    """
+    :param name: module to import on first use
+    :param namespace: globals() of the importing module
+    :param alias: name bound in namespace, defaults to name
+    :return: LazyModule to bind to alias
+    """
+    return LazyModule(name, namespace, alias or name)
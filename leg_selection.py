@@ -0,0 +1,117 @@
+from lazy_import import lazy_import
+from qc_interface import OptionRight
+
+np = lazy_import("numpy", globals(), "np")
+
+
+# Strike selection for multi leg option positions on a ColumnarOptionChain.
+# Every lookup is a bisection over the ascending strikes listed for one
+# (right, expiry), and targets can be passed as arrays so the legs of many
+# positions resolve in one searchsorted call.
+
+
+class Side:
+    AT_OR_ABOVE = 0 # lowest listed strike >= target
+    AT_OR_BELOW = 1 # highest listed strike <= target
+
+
+def first_common_expiry(chain, min_date, rights=(OptionRight.PUT, OptionRight.CALL)):
+    """
+    Earliest expiry strictly after min_date listed for every right in rights
+    :param chain: ColumnarOptionChain
+    :param min_date: datetime
+    :param rights: rights that must all be listed on the expiry
+    :return: datetime64 or None if there is no such expiry
+    """
+    min_date = np.datetime64(min_date, 's')
+    common = None
+    for right in rights:
+        expiries = chain.Expiries(right)
+        expiries = expiries[np.searchsorted(expiries, min_date, side='right'):]
+        common = expiries if common is None else np.intersect1d(common, expiries, assume_unique=True)
+    if common is None or len(common) == 0:
+        return None
+    return common[0]
+
+
+def select_strikes(chain, right, expiry, targets, side):
+    """
+    Nearest listed strike at or beyond each target for a single (right, expiry)
+    :param chain: ColumnarOptionChain
+    :param right: OptionRight
+    :param expiry: datetime or datetime64 of the contracts to pick from
+    :param targets: float or array of target strikes
+    :param side: Side.AT_OR_ABOVE or Side.AT_OR_BELOW
+    :return: int64 array of chain indices, -1 where no strike qualifies
+    """
+    start, stop = chain.StrikeRun(right, expiry)
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    strikes = chain.Strike[start:stop]
+    if side == Side.AT_OR_ABOVE:
+        idx = np.searchsorted(strikes, targets, side='left') + start
+        valid = idx < stop
+    else:
+        idx = np.searchsorted(strikes, targets, side='right') + start - 1
+        valid = idx >= start
+    return np.where(valid, idx, -1).astype(np.int64)
+
+
+def select_iron_condor_legs(chain, expiry, short_call, long_call, short_put, long_put):
+    """
+    Resolves the four legs of one or many iron condors on a single expiry.
+    Calls take the nearest strike at or above their target and puts the nearest
+    at or below. Long legs are always strictly further out than their short leg,
+    so a spread narrower than the strike spacing still gives a valid wing.
+    :param chain: ColumnarOptionChain
+    :param expiry: datetime or datetime64 shared by every leg
+    :param short_call, long_call, short_put, long_put: floats or equal length arrays of target strikes
+    :return: (n, 4) int64 array of chain indices ordered
+             (short call, long call, short put, long put). Rows with a missing leg are all -1
+    """
+    call_stop = chain.StrikeRun(OptionRight.CALL, expiry)[1]
+    put_start = chain.StrikeRun(OptionRight.PUT, expiry)[0]
+    sc = select_strikes(chain, OptionRight.CALL, expiry, short_call, Side.AT_OR_ABOVE)
+    lc = select_strikes(chain, OptionRight.CALL, expiry, long_call, Side.AT_OR_ABOVE)
+    sp = select_strikes(chain, OptionRight.PUT, expiry, short_put, Side.AT_OR_BELOW)
+    lp = select_strikes(chain, OptionRight.PUT, expiry, long_put, Side.AT_OR_BELOW)
+    sc, lc, sp, lp = np.broadcast_arrays(sc, lc, sp, lp)
+    # -1 on the call side means no strike far enough out
+    lc = np.maximum(np.where(lc < 0, call_stop, lc), sc + 1)
+    lp = np.minimum(lp, sp - 1)
+    legs = np.stack((sc, lc, sp, lp), axis=1)
+    valid = (sc >= 0) & (lc < call_stop) & (sp >= 0) & (lp >= put_start)
+    legs[~valid] = -1
+    return legs
+
+
+def select_by_delta(chain, right, expiry, delta, targets):
+    """
+    Contract whose absolute delta is nearest each target for a single (right, expiry)
+    :param chain: ColumnarOptionChain
+    :param delta: array of deltas aligned with the chain, E.g option_pricing.chain_greeks(...).Delta
+    :param targets: float or array of absolute deltas, E.g 0.16
+    :return: int64 array of chain indices, -1 where no contract has a delta
+    """
+    start, stop = chain.StrikeRun(right, expiry)
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    run = np.abs(np.asarray(delta[start:stop], dtype=np.float64))
+    if not len(run) or np.isnan(run).all():
+        return np.full(len(targets), -1, dtype=np.int64)
+    # NaN deltas (unsolved volatilities) never win
+    distance = np.abs(np.where(np.isnan(run), np.inf, run)[None, :] - targets[:, None])
+    return (np.argmin(distance, axis=1) + start).astype(np.int64)
+
+
+def delta_range(chain, right, expiry, delta):
+    """
+    Absolute deltas the listed strikes of a single (right, expiry) span. A target
+    outside it is beyond the strikes of the chain, select_by_delta then returns
+    the outermost contract
+    :param delta: array of deltas aligned with the chain
+    :return: (lowest, highest) absolute delta, None if no contract has a delta
+    """
+    start, stop = chain.StrikeRun(right, expiry)
+    run = np.abs(np.asarray(delta[start:stop], dtype=np.float64))
+    if not len(run) or np.isnan(run).all():
+        return None
+    return float(np.nanmin(run)), float(np.nanmax(run))
@@ -0,0 +1,28 @@
+"""
+Entry point of the live data adapter, see live_feed for the feed format and
+the adapter itself.
+
+    python3 -m live_adapter iron_condor:IronCondorAlgorithm \
+        [--connect tcp:HOST:PORT | unix:PATH | pipe:PATH] \
+        [--data synthetic | csv:DIR | store:DIR] [--speed N] [--parameter name=value ...] [--json]
+
+The adapter is built on asyncio and needs Python 3.5 or later. live_feed uses
+async / await syntax, so it is the one module of the tree Python 2 can not
+compile (python2 -m compileall -x live_feed .). This module stays importable
+there and main exits with an error naming the interpreter required.
+"""
+import sys
+
+REQUIRES = (3, 5)
+
+if sys.version_info >= REQUIRES:
+    from live_feed import (BarCoalescer, ChainCoalescer, LiveAdapter, LiveOptionChain, LiveStatistics,
+                           ReplayServer, main, replay)
+else:
+    def main(argv):
+        sys.exit("live_adapter requires Python {}.{} or later (asyncio), this is Python {}".format(
+            REQUIRES[0], REQUIRES[1], sys.version.split()[0]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
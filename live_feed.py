@@ -0,0 +1,603 @@
+"""
+Live data for a QCAlgorithm: ticks pushed over a socket or pipe are coalesced
+into the Slice / OnData API the backtest engine drives. Python 3 only, built on
+asyncio. Use it through live_adapter, which can be imported on Python 2 and
+fails with a clear message there.
+
+    python3 -m live_adapter iron_condor:IronCondorAlgorithm \
+        [--connect tcp:HOST:PORT | unix:PATH | pipe:PATH] \
+        [--data synthetic | csv:DIR | store:DIR] [--speed N] [--parameter name=value ...]
+
+Without --connect a ReplayServer streams the chosen data on a local port, as a
+stand in for a quote feed, and the adapter trades against it.
+
+The feed is newline delimited JSON, one tick per line, in time order. Times are
+seconds since 1970-01-01 in exchange local time:
+
+    {"kind": "trade", "time": t, "symbol": "SPY", "price": p}
+    {"kind": "quote", "time": t, "symbol": "SPY", "right": "C", "strike": k,
+     "expiry": t, "bid": b, "ask": a, "underlying": u}
+
+Trades are aggregated into bars at the resolution each equity was added with,
+aligned to the session open. Quotes update the latest bid/ask of a contract and
+every slice carries a snapshot of each option chain filtered by its SetFilter
+expiry window, rebuilt only when a quote has changed. A slice is closed as soon as a
+tick of a later period arrives, then queued. OnData runs on a worker thread so
+ingestion never waits for the algorithm, and for every tick the time from its
+arrival to the return of the OnData call that consumed it is recorded.
+"""
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import heapq
+import json
+import sys
+
+from lazy_import import lazy_import
+from qc_interface import Bar, ColumnarOptionChain, OptionRight, OptionSecurityObject, Resolution, Slice
+from data_sources import EventKind, RESOLUTION_PERIOD, SESSION_OPEN, synthetic_sources
+from backtest_engine import BacktestEngine, RunStatistics
+from profiling import StageHistogram, perf_counter_ns
+
+np = lazy_import("numpy", globals(), "np")
+
+EPOCH = datetime(1970, 1, 1)
+READ_BYTES = 1 << 16
+
+# feed lines as the ReplayServer writes them, formatted directly rather than
+# through json.dumps. Floats are written with repr so they round trip exactly
+TRADE_LINE = '{{"kind": "trade", "time": {!r}, "symbol": "{}", "price": {!r}}}\n'
+QUOTE_LINE = '{{"kind": "quote", "time": {!r}, "symbol": "{}", "right": "{}", "strike": {!r}, ' \
+             '"expiry": {}, "bid": {!r}, "ask": {!r}, "underlying": {!r}}}\n'
+
+
+def to_seconds(time):
+    return (time - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(microseconds=round(seconds * 1e6))
+
+
+def period_end(time, period):
+    """
+    End of the bar of length period containing time. Bars are aligned to the
+    session open of time's date, so daily bars end at the close
+    """
+    open_time = datetime(time.year, time.month, time.day) + SESSION_OPEN
+    return open_time + ((time - open_time) // period + 1) * period
+
+
+class BarCoalescer(object):
+    """
+    Open, high, low and close of the trades of one symbol in the current period
+    """
+
+    __slots__ = ('symbol', 'period', 'end', 'bar')
+
+    def __init__(self, symbol, period):
+        self.symbol = symbol
+        self.period = period
+        self.end = None # end time of the open bar
+        self.bar = None
+
+    def Add(self, time, price):
+        """
+        :return: (end, Bar) of the bar the trade closed, None if it went into the open bar.
+                 Late trades, from before the open bar, are folded into it
+        """
+        closed = None
+        end = period_end(time, self.period)
+        if self.bar is not None and end > self.end:
+            closed = self.Close()
+        bar = self.bar
+        if bar is None:
+            bar = self.bar = Bar(self.symbol)
+            bar.Open = bar.High = bar.Low = bar.Close = price
+            self.end = end
+        else:
+            bar.High = max(bar.High, price)
+            bar.Low = min(bar.Low, price)
+            bar.Close = price
+        return closed
+
+    def Close(self):
+        closed = (self.end, self.bar)
+        self.bar = None
+        return closed
+
+
+class LiveOptionChain(object):
+    """
+    OptionChain of one underlying at a slice, Value is a ColumnarOptionChain
+    """
+
+    def __init__(self, symbol, value):
+        self.Key = symbol
+        self.Value = value
+
+
+class ChainCoalescer(object):
+    """
+    Latest quote of every contract of one underlying. Snapshot lists the
+    quoted contracts whose expiry is in the SetFilter window, in days from the
+    slice's date. Strikes are the ones the feed quotes: listed strikes are only
+    ever added, so an expiry keeps the strikes of contracts already held
+    """
+
+    def __init__(self, symbol, option_filter=None):
+        self.symbol = symbol
+        self.option_filter = option_filter
+        self.quotes = {} # (right, expiry seconds, strike) -> (bid, ask)
+        self.underlying = None
+        self.chain = None
+        self.chain_date = None
+        self.dirty = False
+
+    def Add(self, right, expiry, strike, bid, ask, underlying):
+        self.quotes[(right, expiry, strike)] = (bid, ask)
+        self.underlying = underlying
+        self.dirty = True
+
+    def Snapshot(self, time):
+        """
+        :return: LiveOptionChain, the same object as the last call while no quote
+                 changed on the same date. None when nothing is listed
+        """
+        if not self.dirty and time.date() == self.chain_date:
+            return self.chain
+        day = datetime(time.year, time.month, time.day)
+        # drop expired contracts for good
+        today = to_seconds(day)
+        for key in [key for key in self.quotes if key[1] < today]:
+            del self.quotes[key]
+        self.dirty = False
+        self.chain_date = time.date()
+        self.chain = None
+        if not self.quotes:
+            return None
+        keys = list(self.quotes)
+        right = np.array([key[0] for key in keys], dtype=np.int8)
+        expiry = np.array([key[1] for key in keys], dtype=np.int64).astype('datetime64[s]')
+        strike = np.array([key[2] for key in keys], dtype=np.float64)
+        quotes = np.array([self.quotes[key] for key in keys], dtype=np.float64)
+        listed = np.ones(len(keys), dtype=bool)
+        if self.option_filter is not None:
+            _, _, min_exp, max_exp = self.option_filter
+            day64 = np.datetime64(day, 's')
+            listed &= (expiry >= day64 + np.timedelta64(min_exp)) & (expiry <= day64 + np.timedelta64(max_exp))
+        if not listed.any():
+            return None
+        self.chain = LiveOptionChain(self.symbol, ColumnarOptionChain(
+            right[listed], strike[listed], expiry[listed], quotes[listed, 0], quotes[listed, 1],
+            underlying_price=self.underlying, symbol=self.symbol))
+        return self.chain
+
+
+class LiveStatistics(RunStatistics):
+
+    def __init__(self):
+        super(LiveStatistics, self).__init__()
+        self.max_queued = 0 # most slices waiting for OnData at once
+        self.skipped = 0 # slices the algorithm's data schedule did not want
+        self.latency = StageHistogram("ingest_to_return") # per tick, arrival to OnData return
+        self.queue_wait = StageHistogram("queue_wait") # per slice, closed to dispatched
+        self.handler = StageHistogram("handler") # per slice, MarkPortfolio and OnData
+
+    def Summary(self):
+        """
+        :return: list of dicts, see StageHistogram.Summary
+        """
+        histograms = (self.latency, self.queue_wait, self.handler)
+        for h in histograms:
+            h.calls = h.count # nothing is sampled
+        return [h.Summary() for h in histograms]
+
+    def __str__(self):
+        latency = self.latency.Summary()
+        return "{}, {} slices skipped, latency p50 {:.0f}us p99 {:.0f}us max {:.0f}us, " \
+               "{} slices queued at most".format(super(LiveStatistics, self).__str__(), self.skipped,
+                                                 latency["p50_us"], latency["p99_us"], latency["max_us"],
+                                                 self.max_queued)
+
+
+class LiveAdapter(object):
+    """
+    Feeds a QCAlgorithm from a stream of ticks, see the module docstring.
+    Everything the algorithm runs, Initialize included, runs on one worker
+    thread in slice order, while the event loop keeps reading the feed.
+    """
+
+    def __init__(self, algorithm):
+        """
+        :param algorithm: QCAlgorithm instance, Initialize is called by Run
+        """
+        self.algorithm = algorithm
+        self.statistics = LiveStatistics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.bars = {} # symbol -> BarCoalescer
+        self.chains = {} # symbol -> ChainCoalescer
+        self.slice_period = None # of the finest resolution subscribed
+        self.slice_end = None # end of the slice ticks are going into
+        self.closed_bars = {} # end time -> {symbol: Bar}, bars complete but not dispatched
+        self.arrivals = [] # arrival ns of the ticks of the open slice
+        self.curr_date = None
+        self.equity_symbols = []
+
+    def Start(self):
+        """
+        Initializes the algorithm and subscribes to the securities it added
+        """
+        algorithm = self.algorithm
+        algorithm.Initialize()
+        algorithm.WrapProfiledStages()
+        for security in algorithm.Securities:
+            period = RESOLUTION_PERIOD[security.Resolution]
+            if self.slice_period is None or period < self.slice_period:
+                self.slice_period = period
+            if isinstance(security, OptionSecurityObject):
+                self.chains[security.symbol] = ChainCoalescer(security.symbol, security.Filter)
+            elif security.symbol not in self.bars:
+                self.bars[security.symbol] = BarCoalescer(security.symbol, period)
+                self.equity_symbols.append(security.symbol)
+            else:
+                # the finest resolution a symbol was added with
+                self.bars[security.symbol].period = min(self.bars[security.symbol].period, period)
+        if self.slice_period is None:
+            self.slice_period = RESOLUTION_PERIOD[Resolution.Minute]
+
+    def _CloseSlices(self, time, queue):
+        # every period ending at or before time is complete, the feed is in time order
+        for coalescer in self.bars.values():
+            if coalescer.bar is not None and coalescer.end <= time:
+                end, bar = coalescer.Close()
+                self.closed_bars.setdefault(end, {})[coalescer.symbol] = bar
+        ends = set(end for end in self.closed_bars if end <= time)
+        if self.slice_end is not None:
+            ends.add(self.slice_end)
+        closed_ns = perf_counter_ns()
+        for end in sorted(ends):
+            slice = Slice()
+            slice.Time = end
+            slice.Bars = self.closed_bars.pop(end, {})
+            for coalescer in self.chains.values():
+                chain = coalescer.Snapshot(end)
+                if chain is not None:
+                    slice.OptionChains.append(chain)
+            # ticks are attributed to the slice of the period they arrived in
+            arrivals = self.arrivals if end == self.slice_end else []
+            queue.put_nowait((slice, arrivals, closed_ns))
+        self.arrivals = []
+        self.statistics.max_queued = max(self.statistics.max_queued, queue.qsize())
+
+    def Ingest(self, lines, arrived_ns, queue):
+        """
+        Applies complete feed lines to the coalescers, queueing the slices they close
+        :param lines: list of bytes, one tick each, blank lines are ignored
+        :param arrived_ns: perf_counter_ns when the lines were read
+        """
+        stats = self.statistics
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return
+        # one decode per read rather than one per tick
+        ticks = json.loads(b"[" + b",".join(lines) + b"]")
+        seconds = time = None
+        for tick in ticks:
+            if tick["time"] != seconds:
+                # ticks come in runs sharing a timestamp
+                seconds = tick["time"]
+                time = from_seconds(seconds)
+            if self.slice_end is None or time >= self.slice_end:
+                self._CloseSlices(time, queue)
+                self.slice_end = period_end(time, self.slice_period)
+            symbol = tick["symbol"]
+            if tick["kind"] == "trade":
+                coalescer = self.bars.get(symbol)
+                if coalescer is None:
+                    continue
+                closed = coalescer.Add(time, float(tick["price"]))
+                if closed is not None:
+                    self.closed_bars.setdefault(closed[0], {})[symbol] = closed[1]
+            else:
+                coalescer = self.chains.get(symbol)
+                if coalescer is None:
+                    continue
+                right = OptionRight.CALL if tick["right"] == "C" else OptionRight.PUT
+                coalescer.Add(right, int(tick["expiry"]), float(tick["strike"]), float(tick["bid"]),
+                              float(tick["ask"]), float(tick["underlying"]))
+            stats.events += 1
+            self.arrivals.append(arrived_ns)
+
+    def _Dispatch(self, slice, arrivals, closed_ns):
+        # worker thread, the same steps as BacktestEngine.Run for one slice
+        start = perf_counter_ns()
+        stats = self.statistics
+        stats.queue_wait.Record(start - closed_ns)
+        algorithm = self.algorithm
+        slice_time = slice.Time
+        schedule = algorithm.data_schedule
+        if schedule is not None and schedule.next_time(slice_time) != slice_time:
+            # a slice the engine would have skipped, its ticks are consumed unseen
+            done = perf_counter_ns()
+            for arrived in arrivals:
+                stats.latency.Record(done - arrived)
+            stats.skipped += 1
+            return
+        if self.curr_date is not None and slice_time.date() != self.curr_date and not algorithm.IsWarmingUp:
+            for symbol in self.equity_symbols:
+                algorithm.OnEndOfDay(symbol)
+        self.curr_date = slice_time.date()
+        if algorithm.IsWarmingUp and slice_time >= algorithm.start_date:
+            algorithm.IsWarmingUp = False
+        algorithm.Time = slice_time
+        algorithm.CurrentSlice = slice
+        algorithm.MarkPortfolio(slice)
+        algorithm.OnData(slice)
+        done = perf_counter_ns()
+        stats.handler.Record(done - start)
+        for arrived in arrivals:
+            stats.latency.Record(done - arrived)
+        stats.slices += 1
+        if algorithm.IsWarmingUp:
+            stats.warm_up_slices += 1
+
+    def _Finish(self):
+        algorithm = self.algorithm
+        if self.curr_date is not None and not algorithm.IsWarmingUp:
+            for symbol in self.equity_symbols:
+                algorithm.OnEndOfDay(symbol)
+        algorithm.IsWarmingUp = False
+        algorithm.OnEndOfAlgorithm()
+
+    def _DispatchBatch(self, batch):
+        for item in batch:
+            self._Dispatch(*item)
+
+    async def _DispatchLoop(self, queue):
+        loop = asyncio.get_event_loop()
+        done = False
+        while not done:
+            # everything queued while the worker was busy goes over in one hand off
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            await loop.run_in_executor(self.executor, self._DispatchBatch, batch)
+
+    async def Run(self, reader):
+        """
+        Trades the feed read from reader until it ends
+        :param reader: asyncio.StreamReader
+        :return: LiveStatistics
+        """
+        loop = asyncio.get_event_loop()
+        stats = self.statistics
+        await loop.run_in_executor(self.executor, self.Start)
+        queue = asyncio.Queue()
+        dispatcher = asyncio.ensure_future(self._DispatchLoop(queue))
+        wall_start = loop.time()
+        rest = b""
+        while True:
+            data = await reader.read(READ_BYTES)
+            arrived_ns = perf_counter_ns()
+            if not data:
+                break
+            lines = (rest + data).split(b"\n")
+            rest = lines.pop()
+            self.Ingest(lines, arrived_ns, queue)
+            # let the dispatcher hand the next slice to the worker between reads
+            await asyncio.sleep(0)
+        self.Ingest([rest], perf_counter_ns(), queue)
+        # the feed ended, every open bar and slice is complete
+        self._CloseSlices(datetime.max, queue)
+        queue.put_nowait(None)
+        await dispatcher
+        await loop.run_in_executor(self.executor, self._Finish)
+        stats.elapsed = loop.time() - wall_start
+        algorithm = self.algorithm
+        algorithm.Debug("Live run finished: {}".format(stats))
+        algorithm.Debug("Portfolio value {:.2f}, realized profit {:.2f}".format(
+            algorithm.Portfolio.TotalPortfolioValue, algorithm.Portfolio.TotalProfit))
+        algorithm.CloseLogs()
+        self.executor.shutdown()
+        return stats
+
+    async def Connect(self, address):
+        """
+        :param address: "tcp:HOST:PORT", "unix:PATH" or "pipe:PATH", a FIFO or "-" for stdin piped
+                        from another process. Regular files are not supported
+        :return: LiveStatistics
+        """
+        kind, _, where = address.partition(":")
+        if kind == "tcp":
+            host, _, port = where.rpartition(":")
+            reader, writer = await asyncio.open_connection(host or "127.0.0.1", int(port))
+        elif kind == "unix":
+            reader, writer = await asyncio.open_unix_connection(where)
+        elif kind == "pipe":
+            loop = asyncio.get_event_loop()
+            reader = asyncio.StreamReader()
+            pipe = sys.stdin.buffer if where == "-" else open(where, "rb")
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+            writer = None
+        else:
+            raise ValueError("Unknown address {}, expected tcp:HOST:PORT, unix:PATH or pipe:PATH".format(address))
+        try:
+            return await self.Run(reader)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+class ReplayServer(object):
+    """
+    Serves the events of DataSources as a tick feed, each client gets the whole
+    replay. Each bar is sent as four trades, open, high, low and close, inside
+    its period, and each chain as the quotes that changed since the last one
+    sent, a second before its time. An adapter fed by it builds the slices a
+    BacktestEngine run on the same sources dispatches.
+    """
+
+    def __init__(self, sources, start, end, speed=None):
+        """
+        :param sources: list of DataSource
+        :param speed: replay speed relative to event time, E.g 60 plays a minute a
+                      second. As fast as the client reads when None
+        """
+        self.sources = sources
+        self.start = start
+        self.end = end
+        self.speed = speed
+        self.server = None
+
+    def _Events(self):
+        # the BacktestEngine order, by time, then kind, then source
+        def keyed(i, source):
+            for event in source.Events(self.start, self.end):
+                yield (event[0], event[1], i), event
+        return heapq.merge(*[keyed(i, source) for i, source in enumerate(self.sources)])
+
+    def _BarTicks(self, time, symbol, bar, period):
+        opened = time - period
+        ticks = [(opened, bar.Open), (opened + period // 4, bar.High), (opened + period // 2, bar.Low),
+                 (time - timedelta(seconds=1), bar.Close)]
+        return [TRADE_LINE.format(to_seconds(t), symbol, float(price)) for t, price in ticks]
+
+    def _QuoteTicks(self, time, symbol, chain, sent):
+        columnar = ColumnarOptionChain.FromContracts(chain.Value)
+        underlying = float(columnar.UnderlyingLastPrice)
+        stamp = to_seconds(time - timedelta(seconds=1))
+        expiries = columnar.Expiry.astype(np.int64).tolist()
+        ticks = []
+        for right, expiry, strike, bid, ask in zip(columnar.Right.tolist(), expiries, columnar.Strike.tolist(),
+                                                  columnar.BidPrice.tolist(), columnar.AskPrice.tolist()):
+            key = (symbol, right, expiry, strike)
+            if sent.get(key) == (bid, ask, underlying):
+                continue
+            sent[key] = (bid, ask, underlying)
+            ticks.append(QUOTE_LINE.format(stamp, symbol, "C" if right == OptionRight.CALL else "P", strike,
+                                           expiry, bid, ask, underlying))
+        return ticks
+
+    async def _Serve(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        sent = {} # last quote sent per contract
+        last_chain = {} # symbol -> chain object last replayed
+        periods = {} # symbol -> bar period, from the spacing of its bars
+        last_bar = {}
+        replay_start = loop.time()
+        first_time = None
+        try:
+            for (time, kind, _), (_, _, symbol, data) in self._Events():
+                if first_time is None:
+                    first_time = time
+                if self.speed:
+                    delay = (time - first_time).total_seconds() / self.speed - (loop.time() - replay_start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if kind == EventKind.BAR:
+                    previous = last_bar.get(symbol)
+                    if previous is not None and previous.date() == time.date():
+                        periods[symbol] = min(periods.get(symbol, time - previous), time - previous)
+                    last_bar[symbol] = time
+                    ticks = self._BarTicks(time, symbol, data, periods.get(symbol, timedelta(minutes=1)))
+                elif data is last_chain.get(symbol):
+                    continue
+                else:
+                    last_chain[symbol] = data
+                    ticks = self._QuoteTicks(time, symbol, data, sent)
+                writer.write("".join(ticks).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def Serve(self, address="tcp:127.0.0.1:0"):
+        """
+        :param address: "tcp:HOST:PORT", port 0 picks a free one, or "unix:PATH"
+        :return: the address actually listened on
+        """
+        kind, _, where = address.partition(":")
+        if kind == "unix":
+            self.server = await asyncio.start_unix_server(self._Serve, where)
+            return address
+        host, _, port = where.rpartition(":")
+        self.server = await asyncio.start_server(self._Serve, host or "127.0.0.1", int(port))
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return "tcp:{}:{}".format(host, port)
+
+    def Close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+async def replay(algorithm, data="synthetic", seed=0, speed=None):
+    """
+    Trades algorithm against a ReplayServer of data, see backtest_runner.make_sources
+    :return: LiveStatistics
+    """
+    from backtest_runner import make_sources
+    # a throwaway initialized copy lists the securities and dates to replay
+    probe = type(algorithm)()
+    probe.SetParameters(dict(algorithm.parameters))
+    probe.OverrideDates(*algorithm.date_overrides)
+    probe.Initialize()
+    start, end = BacktestEngine(probe).WarmUpStart(), probe.end_date
+    sources = make_sources(data)
+    if sources is None:
+        sources = synthetic_sources(probe, start, end, seed=seed)
+    else:
+        sources = sources(probe, start, end)
+    server = ReplayServer(sources, start, end, speed)
+    address = await server.Serve()
+    try:
+        return await LiveAdapter(algorithm).Connect(address)
+    finally:
+        server.Close()
+
+
+def _parse_parameter(text):
+    name, _, value = text.partition("=")
+    return name, value
+
+
+def main(argv):
+    from backtest_runner import load_algorithm
+    parser = argparse.ArgumentParser(description="Run a QCAlgorithm on a live tick feed")
+    parser.add_argument("algorithm", help="module:ClassName of the algorithm")
+    parser.add_argument("--connect", default=None, help="tcp:HOST:PORT, unix:PATH or pipe:PATH of the feed. "
+                                                        "Replays --data locally when not given")
+    parser.add_argument("--data", default="synthetic", help="replayed data, synthetic, csv:DIR or store:DIR")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--speed", type=float, default=None, help="replay speed, as fast as possible when not given")
+    parser.add_argument("--parameter", type=_parse_parameter, action="append", default=[],
+                        help="name=value algorithm parameter, repeatable")
+    parser.add_argument("--json", action="store_true",
+                        help="print the latency summary as one JSON line, the algorithm's messages go to stderr")
+    args = parser.parse_args(argv)
+
+    algorithm = load_algorithm(args.algorithm)()
+    if args.json:
+        # stdout only holds the JSON line, as backtest_runner --json
+        algorithm.SetLogStream(sys.stderr)
+    if args.parameter:
+        algorithm.SetParameters(dict(args.parameter))
+    loop = asyncio.new_event_loop()
+    try:
+        if args.connect:
+            stats = loop.run_until_complete(LiveAdapter(algorithm).Connect(args.connect))
+        else:
+            stats = loop.run_until_complete(replay(algorithm, args.data, args.seed, args.speed))
+    finally:
+        loop.close()
+    if args.json:
+        print(json.dumps(stats.Summary(), sort_keys=True))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,193 @@
+from lazy_import import lazy_import
+from qc_interface import OptionRight
+
+np = lazy_import("numpy", globals(), "np")
+
+
+# Black Scholes prices, implied volatilities and greeks for whole chain
+# snapshots. Every function takes NumPy arrays (or scalars) that broadcast
+# against each other, so a chain is priced in a handful of array operations
+# instead of a Python loop over its contracts. Volatilities, rates and
+# dividend yields are annualised and continuously compounded.
+
+SECONDS_PER_YEAR = 365.0 * 86400
+# contracts expire at the close of their expiry date
+EXPIRY_OFFSET_SECONDS = 16 * 3600
+# time to expiry floor, keeps d1 finite for contracts expiring this instant
+MIN_YEARS = 1.0 / SECONDS_PER_YEAR
+
+IV_MIN = 1e-4
+IV_MAX = 5.0
+
+
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def norm_cdf(x):
+    # Abramowitz and Stegun 26.2.17, absolute error below 7.5e-8
+    x = np.asarray(x, dtype=np.float64)
+    t = 1.0 / (1.0 + 0.2316419 * np.abs(x))
+    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
+    upper = norm_pdf(x) * poly # P(Z > |x|)
+    # 1 - upper for x >= 0 and upper below, without a comparison that warns on NaN
+    return 0.5 + np.copysign(0.5 - upper, x)
+
+
+def years_to_expiry(expiry, time):
+    """
+    :param expiry: datetime64 array (E.g ColumnarOptionChain.Expiry) or datetime
+    :param time: datetime the chain is priced at
+    :return: float64 array of years until the close of each expiry date, at least MIN_YEARS
+    """
+    seconds = (np.asarray(expiry, dtype='datetime64[s]') - np.datetime64(time, 's')) / np.timedelta64(1, 's')
+    return np.maximum((seconds + EXPIRY_OFFSET_SECONDS) / SECONDS_PER_YEAR, MIN_YEARS)
+
+
+def _d1_d2(spot, strike, years, vol, rate, dividend):
+    vol_t = vol * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate - dividend + 0.5 * vol * vol) * years) / vol_t
+    return d1, d1 - vol_t
+
+
+def black_scholes_price(right, spot, strike, years, vol, rate=0.0, dividend=0.0):
+    """
+    :param right: OptionRight or array of them
+    :param spot: underlying price
+    :param strike, years, vol: arrays or scalars, years as from years_to_expiry
+    :return: float64 array of option prices
+    """
+    d1, d2 = _d1_d2(spot, strike, years, vol, rate, dividend)
+    spot_pv = spot * np.exp(-dividend * years)
+    strike_pv = strike * np.exp(-rate * years)
+    call = spot_pv * norm_cdf(d1) - strike_pv * norm_cdf(d2)
+    # put by parity
+    return np.where(np.asarray(right) == OptionRight.CALL, call, call - spot_pv + strike_pv)
+
+
+def _vega(spot, years, d1, dividend):
+    return spot * np.exp(-dividend * years) * norm_pdf(d1) * np.sqrt(years)
+
+
+def implied_vol(right, price, spot, strike, years, rate=0.0, dividend=0.0, tol=1e-6, max_iter=50):
+    """
+    Batched Newton iteration, safeguarded by bisection. Every contract keeps a
+    bracket [low, high] around its root and a Newton step that would leave it
+    is replaced by the midpoint, so each iteration is a few array operations
+    over the contracts that have not converged yet.
+    :param price: option prices, E.g the mid of bid and ask
+    :param tol: price error accepted. Far from the money, where the price hardly
+                moves with volatility, any volatility repricing within tol is returned
+    :return: float64 array of volatilities, NaN where the price is outside the
+             no arbitrage bounds or is not solved within max_iter iterations
+    """
+    right, price, spot, strike, years = np.broadcast_arrays(np.asarray(right), np.asarray(price, dtype=np.float64),
+                                                            np.asarray(spot, dtype=np.float64),
+                                                            np.asarray(strike, dtype=np.float64),
+                                                            np.asarray(years, dtype=np.float64))
+    is_call = (right == OptionRight.CALL).ravel()
+    price, spot, strike, years = price.ravel(), spot.ravel(), strike.ravel(), years.ravel()
+    spot_pv = spot * np.exp(-dividend * years)
+    strike_pv = strike * np.exp(-rate * years)
+    lower = np.maximum(np.where(is_call, spot_pv - strike_pv, strike_pv - spot_pv), 0.0)
+    upper = np.where(is_call, spot_pv, strike_pv)
+    vol = np.full(len(price), np.nan)
+    active = np.flatnonzero((price > lower) & (price < upper))
+
+    low = np.full(len(active), IV_MIN)
+    high = np.full(len(active), IV_MAX)
+    # Brenner Subrahmanyam at the money estimate as the starting point
+    sigma = np.clip(price[active] / spot[active] * np.sqrt(2.0 * np.pi / years[active]), 0.05, 1.0)
+    for _ in range(max_iter):
+        if not len(active):
+            break
+        s, k, t = spot[active], strike[active], years[active]
+        d1, d2 = _d1_d2(s, k, t, sigma, rate, dividend)
+        call = spot_pv[active] * norm_cdf(d1) - strike_pv[active] * norm_cdf(d2)
+        model = np.where(is_call[active], call, call - spot_pv[active] + strike_pv[active])
+        error = model - price[active]
+        done = np.abs(error) < tol
+        vol[active[done]] = sigma[done]
+        # price rises with vol, so the sign of the error says which side the root is on
+        high = np.where(error > 0, sigma, high)
+        low = np.where(error > 0, low, sigma)
+        vega = _vega(s, t, d1, dividend)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = sigma - error / vega
+        step = np.where((vega > 1e-12) & (step > low) & (step < high), step, 0.5 * (low + high))
+        keep = ~done
+        active, sigma, low, high = active[keep], step[keep], low[keep], high[keep]
+    return vol.reshape(right.shape)
+
+
+class Greeks(object):
+    """
+    Price sensitivities as arrays aligned with the inputs. Theta is per year and
+    vega per unit of volatility (divide by 365 and 100 for per day and per vol point)
+    """
+
+    __slots__ = ('Delta', 'Gamma', 'Theta', 'Vega')
+
+    def __init__(self, delta, gamma, theta, vega):
+        self.Delta = delta
+        self.Gamma = gamma
+        self.Theta = theta
+        self.Vega = vega
+
+
+def greeks(right, spot, strike, years, vol, rate=0.0, dividend=0.0):
+    """
+    :return: Greeks, NaN wherever vol is NaN
+    """
+    is_call = np.asarray(right) == OptionRight.CALL
+    d1, d2 = _d1_d2(spot, strike, years, vol, rate, dividend)
+    spot_discount = np.exp(-dividend * years)
+    strike_pv = strike * np.exp(-rate * years)
+    pdf = norm_pdf(d1)
+    cdf_d1 = norm_cdf(d1)
+    cdf_d2 = norm_cdf(d2)
+    sqrt_t = np.sqrt(years)
+    delta = np.where(is_call, spot_discount * cdf_d1, spot_discount * (cdf_d1 - 1.0))
+    gamma = spot_discount * pdf / (spot * vol * sqrt_t)
+    decay = -spot * spot_discount * pdf * vol / (2.0 * sqrt_t)
+    theta = np.where(is_call,
+                     decay - rate * strike_pv * cdf_d2 + dividend * spot * spot_discount * cdf_d1,
+                     decay + rate * strike_pv * (1.0 - cdf_d2) - dividend * spot * spot_discount * (1.0 - cdf_d1))
+    vega = spot * spot_discount * pdf * sqrt_t
+    return Greeks(delta, gamma, theta, vega)
+
+
+class ChainGreeks(Greeks):
+    """
+    Implied volatility and greeks of every contract of a ColumnarOptionChain,
+    index i of each array is chain.Contract(i)
+    """
+
+    __slots__ = ('Mid', 'Years', 'ImpliedVol')
+
+    def __init__(self, mid, years, vol, sensitivities):
+        super(ChainGreeks, self).__init__(sensitivities.Delta, sensitivities.Gamma, sensitivities.Theta,
+                                          sensitivities.Vega)
+        self.Mid = mid
+        self.Years = years
+        self.ImpliedVol = vol
+
+
+def chain_greeks(chain, time, rate=0.0, dividend=0.0, surface=None):
+    """
+    Solves the implied volatility of every contract from its mid quote and
+    computes its greeks at that volatility
+    :param chain: ColumnarOptionChain
+    :param time: datetime the chain was quoted at
+    :param surface: optional vol_surface.ImpliedVolSurface. Volatilities then come
+                    from the surface, which only re-solves the quotes that moved
+    :return: ChainGreeks
+    """
+    spot = float(chain.UnderlyingLastPrice)
+    mid = 0.5 * (chain.BidPrice + chain.AskPrice)
+    years = years_to_expiry(chain.Expiry, time)
+    if surface is None:
+        vol = implied_vol(chain.Right, mid, spot, chain.Strike, years, rate, dividend)
+    else:
+        vol = surface.Update(chain, time)
+    return ChainGreeks(mid, years, vol, greeks(chain.Right, spot, chain.Strike, years, vol, rate, dividend))
@@ -3,7 +3,7 @@ from qc_interface import QCAlgorithm, Resolution
 
 
 # My Package imports
-from qc_utils import SlidingWindow
+from qc_utils import SlidingWindow, TradingCalendar, SessionExecutor, AlgorithmLogger, LogLevel
 from position_tracker import PositionTracker
 # Std lib imports
 from datetime import datetime, timedelta
@@ -32,35 +32,21 @@ class OptionsTemplateAlgorithm(QCAlgorithm):
 
     ############## Helper/Util methods
 
-    def ConvertDailyResolution(self, data_handler):
+    def ConvertDailyResolution(self, data_handler, offset=timedelta(0)):
         """
         Options can only execute at minute intervals This function converts the
-        data_handler to exectue at daily intervals
+        data_handler to execute once per trading session, on the first slice at
+        or after the session open plus offset. Sessions span the warm up period
         :param data_handler: Type = fn(slice)
+        :param offset: timedelta after the session open
         :return: Type = fn(slice)
         """
-
-        class DailyExecutor(object):
-            # qc_instance in the instanceof qc_algorithm
-            def __init__(self, qc_instance, handler):
-                self.last_date = None # last date handler was called
-                self.handler = handler
-                self.first_call = True # flag to check first time __call__ is called
-                self.qc = qc_instance
-
-            def __call__(self, slice):
-                if self.first_call:
-                    self.handler(slice)
-                    self.last_date = self.qc.Time
-                    self.first_call = False
-                time_diff = self.qc.Time - self.last_date
-                if time_diff.days >= 1:
-                    # need >= 1 as may be weekend gap
-                    self.handler(slice)
-                    assert self.last_date is not self.qc.Time, "Time object is mutated"
-                    self.last_date = self.qc.Time
-
-        return DailyExecutor(self, data_handler)
+        calendar = TradingCalendar.covering(self.StartDate, self.EndDate, self.lookback)
+        executor = SessionExecutor(self, data_handler, calendar, offset)
+        # local harness only, lets the backtest feed skip the minutes in between
+        if hasattr(self, "SetDataSchedule"):
+            self.SetDataSchedule(executor)
+        return executor
 
     ########## Order Contruction/ Trade Execution
 
@@ -105,19 +91,19 @@ class OptionsTemplateAlgorithm(QCAlgorithm):
                 chain = o.Value
                 break
         if not chain:
-            self.Debug("Option Chain should not be None in OpenPosition")
+            self.logger.warning("Option Chain should not be None in OpenPosition")
             return
 
         orders = self.ConstructPosition(chain, signal, self.position_tracker, qty=1)
         # make the orders and update position tracker
-        self.Debug("Making Market Orders to Open {}".format(orders))
+        self.logger.debug("Making Market Orders to Open %s", orders)
         for option, qty in orders:
             self.MarketOrder(option.Symbol, qty)
             self.position_tracker.UpdatePositon(option.Symbol, qty)
         # set the current expiry date of position held. Assumes all positions have same expiry
         if orders:
             self.curr_expiry = orders[0][0].Expiry
-            self.Debug("Opened on {}, To Close on {}".format(self.Time, self.curr_expiry))
+            self.logger.info("Opened on %s, To Close on %s", self.Time, self.curr_expiry)
         return
 
     ############ Signal Generation
@@ -142,6 +128,7 @@ class OptionsTemplateAlgorithm(QCAlgorithm):
     # configure algorithm, setup positions/instruments
     # only called once in Initialize
     def InitPreWarmUp(self):
+        self.logger = AlgorithmLogger(lambda msg: self.Debug(msg), LogLevel.INFO)
         self.position_tracker = PositionTracker()
         self.symbol = "SPY"
         self.option = self.AddOption(self.symbol, Resolution.Minute)
@@ -0,0 +1,158 @@
+"""
+Parallel parameter sweeps of a QCAlgorithm over local data.
+
+    python parameter_sweep.py iron_condor:IronCondorAlgorithm \
+        --grid scale_std=0.5,1.0,1.5 --grid spread_width=2,4,8 \
+        [--workers N] [--store DIR] [--output results.csv]
+
+The market data is generated once, written to a BarStore and shared by every
+worker through numpy.memmap, so the OS page cache holds a single read only copy
+however many runs are in flight. Each grid point runs in its own process of a
+ProcessPoolExecutor with its parameters injected through SetParameters.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from backtest_engine import BacktestEngine
+from backtest_runner import load_algorithm
+from bar_store import BarStore, store_sources, write_events
+from data_sources import synthetic_sources
+
+
+def parameter_grid(axes):
+    """
+    :param axes: list of (name, [values])
+    :return: list of dicts, the cartesian product of the axes
+    """
+    names = [name for name, _ in axes]
+    return [dict(zip(names, values)) for values in itertools.product(*[v for _, v in axes])]
+
+
+def prepare_store(algorithm_cls, root, seed=0):
+    """
+    Writes synthetic data covering the algorithm's warm up and date range to a BarStore
+    :return: BarStore
+    """
+    probe = algorithm_cls()
+    probe.Initialize()
+    start = BacktestEngine(probe).WarmUpStart()
+    store = BarStore(root)
+    write_events(store, synthetic_sources(probe, start, probe.end_date, seed=seed), start, probe.end_date)
+    return store
+
+
+def run_one(algorithm_spec, store_root, parameters):
+    """
+    Runs a single grid point. Executed in a worker process
+    :return: dict of the parameters and the run's results
+    """
+    devnull = open(os.devnull, "w")
+    try:
+        algorithm = load_algorithm(algorithm_spec)()
+        algorithm.SetLogStream(devnull) # strategies log every trading day
+        algorithm.SetParameters(parameters)
+        start = time.time()
+        stats = BacktestEngine(algorithm, store_sources(BarStore(store_root))).Run()
+        wall = time.time() - start
+    finally:
+        devnull.close()
+    result = dict(parameters)
+    result.update({
+        "pnl": run_pnl(algorithm),
+        "wall_s": wall,
+        "events": stats.events,
+        "events_per_sec": stats.EventsPerSecond(),
+    })
+    return result
+
+
+def run_pnl(algorithm):
+    return algorithm.Portfolio.TotalPortfolioValue - algorithm.starting_cash
+
+
+def sweep(algorithm_spec, grid, store_root=None, workers=None):
+    """
+    :param algorithm_spec: "module:ClassName"
+    :param grid: list of parameter dicts
+    :param store_root: existing BarStore directory, synthetic data is generated when None
+    :param workers: process count, defaults to every core
+    :return: list of result dicts in grid order
+    """
+    workers = workers or multiprocessing.cpu_count()
+    tmp_root = None
+    if store_root is None:
+        tmp_root = store_root = tempfile.mkdtemp(prefix="sweep_store_")
+        prepare_store(load_algorithm(algorithm_spec), store_root)
+    try:
+        results = [None] * len(grid)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = dict((pool.submit(run_one, algorithm_spec, store_root, params), i)
+                           for i, params in enumerate(grid))
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+    finally:
+        if tmp_root:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+def write_results(path, results):
+    fields = sorted(set(itertools.chain.from_iterable(r.keys() for r in results)))
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def format_results(results):
+    if not results:
+        return ""
+    fields = sorted(results[0].keys())
+    rows = [fields] + [["{:.6g}".format(r[k]) if isinstance(r[k], float) else str(r[k]) for k in fields]
+                       for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(fields))]
+    return "\n".join("  ".join(c.rjust(w) for c, w in zip(row, widths)) for row in rows)
+
+
+def _parse_value(text):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _parse_axis(text):
+    name, values = text.split("=")
+    return name, [_parse_value(v) for v in values.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Parallel parameter sweep of a QCAlgorithm")
+    parser.add_argument("algorithm", help="module:ClassName of the algorithm")
+    parser.add_argument("--grid", type=_parse_axis, action="append", default=[],
+                        help="name=v1,v2,... one per swept parameter")
+    parser.add_argument("--workers", type=int, default=None, help="defaults to every core")
+    parser.add_argument("--store", default=None, help="BarStore directory to read data from")
+    parser.add_argument("--output", default=None, help="CSV file to write the results table to")
+    args = parser.parse_args(argv)
+    grid = parameter_grid(args.grid)
+    start = time.time()
+    results = sweep(args.algorithm, grid, args.store, args.workers)
+    print(format_results(results))
+    print("{} runs in {:.2f}s".format(len(results), time.time() - start))
+    if args.output:
+        write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
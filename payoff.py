@@ -0,0 +1,235 @@
+from lazy_import import lazy_import
+from qc_interface import OptionChain, OptionRight, PortfolioClass
+from option_pricing import EXPIRY_OFFSET_SECONDS, black_scholes_price, years_to_expiry
+
+np = lazy_import("numpy", globals(), "np")
+
+try:
+    STRING_TYPES = basestring # py2 symbols restored from JSON state are unicode
+except NameError:
+    STRING_TYPES = str
+
+
+# Payoff and risk of multi leg positions evaluated in NumPy broadcasts. Legs of
+# many positions are held as (positions, legs) arrays, so thousands of
+# candidate structures are scored over a price grid, or a price x time grid,
+# in one pass. PnL is in account currency and includes the premium paid or
+# received for each leg.
+
+UNDERLYING = -1 # Right of a leg holding the underlying itself
+
+
+class Legs(object):
+    """
+    Legs of one or many positions as (positions, legs) arrays. Positions with
+    fewer legs than others are padded with zero quantity legs
+    """
+
+    __slots__ = ('Right', 'Strike', 'Expiry', 'Quantity', 'Premium', 'Multiplier')
+
+    def __init__(self, right, strike, expiry, quantity, premium=None, multiplier=None):
+        """
+        :param right: OptionRight or UNDERLYING per leg
+        :param strike: float per leg, ignored for the underlying
+        :param expiry: datetime64 per leg, ignored for the underlying
+        :param quantity: signed quantity per leg
+        :param premium: price paid per unit when the leg was opened, 0 when None
+        :param multiplier: units per contract, PortfolioClass.OPTION_MULTIPLIER
+                           for options and 1 for the underlying when None
+        """
+        self.Right = np.atleast_2d(np.asarray(right, dtype=np.int8))
+        shape = self.Right.shape
+        self.Strike = np.broadcast_to(np.asarray(strike, dtype=np.float64), shape)
+        self.Expiry = np.broadcast_to(np.asarray(expiry, dtype='datetime64[s]'), shape)
+        self.Quantity = np.broadcast_to(np.asarray(quantity, dtype=np.float64), shape)
+        self.Premium = np.zeros(shape) if premium is None else \
+            np.broadcast_to(np.asarray(premium, dtype=np.float64), shape)
+        if multiplier is None:
+            multiplier = np.where(self.Right == UNDERLYING, 1.0, PortfolioClass.OPTION_MULTIPLIER)
+        self.Multiplier = np.broadcast_to(np.asarray(multiplier, dtype=np.float64), shape)
+
+    def __len__(self):
+        return len(self.Right)
+
+    @classmethod
+    def FromOrders(cls, orders, prices=None):
+        """
+        A single position from an order list or the positions held
+        :param orders: [(Option, qty)] as from IronCondor or ConstructPosition,
+                       [(symbol, qty)] or a {symbol: qty} dict as PositionTracker.positions.
+                       Symbols that are not contracts are taken to be the underlying
+        :param prices: optional {symbol: price} premiums. Option objects default
+                       to the side of their quote an order fills at
+        :return: Legs of one position
+        """
+        if hasattr(orders, 'items'):
+            orders = list(orders.items())
+        prices = prices or {}
+        parse = OptionChain.OptionChainValue.Option.ParseSymbol
+        columns = []
+        for leg, qty in orders:
+            symbol = getattr(leg, 'Symbol', leg)
+            parsed = parse(symbol) if isinstance(symbol, STRING_TYPES) else None
+            if hasattr(leg, 'Strike'):
+                right, strike, expiry = leg.Right, float(leg.Strike), leg.Expiry
+                premium = prices.get(symbol, float(leg.AskPrice if qty > 0 else leg.BidPrice))
+            elif parsed is not None:
+                _, right, expiry, strike = parsed
+                premium = prices.get(symbol, 0.0)
+            else:
+                right, strike, expiry = UNDERLYING, 0.0, None
+                premium = prices.get(symbol, 0.0)
+            columns.append((right, strike, expiry, qty, premium))
+        if not columns:
+            return cls(np.zeros((1, 0)), 0.0, None, 0.0)
+        right, strike, expiry, qty, premium = zip(*columns)
+        return cls([right], [strike], [[np.datetime64(e, 's') if e is not None else np.datetime64('NaT')
+                                        for e in expiry]], [qty], [premium])
+
+    @classmethod
+    def FromChain(cls, chain, indices, quantity):
+        """
+        Many positions picked from one chain, E.g the rows of select_iron_condor_legs
+        :param chain: ColumnarOptionChain
+        :param indices: (positions, legs) int array of chain indices
+        :param quantity: (legs,) or (positions, legs) signed quantities
+        :return: Legs, premiums at the ask for bought legs and the bid for sold legs
+        """
+        indices = np.atleast_2d(indices)
+        quantity = np.broadcast_to(np.asarray(quantity, dtype=np.float64), indices.shape)
+        premium = np.where(quantity > 0, chain.AskPrice[indices], chain.BidPrice[indices])
+        return cls(chain.Right[indices], chain.Strike[indices], chain.Expiry[indices], quantity, premium)
+
+    def _Cost(self):
+        # (positions,) premium paid to open, negative for a credit
+        return (self.Quantity * self.Premium * self.Multiplier).sum(axis=-1)
+
+
+def intrinsic(right, strike, prices):
+    """
+    :return: value per unit at expiry of legs for every underlying price, broadcast
+    """
+    return np.where(right == OptionRight.CALL, np.maximum(prices - strike, 0.0),
+                    np.where(right == OptionRight.PUT, np.maximum(strike - prices, 0.0), prices))
+
+
+def _distinct_legs(legs):
+    """
+    Candidate positions drawn from one chain share most of their contracts, so
+    values are computed once per distinct (right, strike, expiry) and gathered
+    :return: (first, ids) where legs.X.ravel()[first] are the distinct legs and
+             ids (positions, legs) maps every leg to its distinct leg
+    """
+    right, strike = legs.Right.ravel(), legs.Strike.ravel()
+    # the underlying has no expiry, keep NaT out of the comparisons
+    expiry = np.where(right == UNDERLYING, np.datetime64(0, 's'), legs.Expiry.ravel())
+    order = np.lexsort((strike, expiry, right))
+    right, strike, expiry = right[order], strike[order], expiry[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (right[1:] != right[:-1]) | (strike[1:] != strike[:-1]) | (expiry[1:] != expiry[:-1])
+    ids = np.empty(len(order), dtype=np.int64)
+    ids[order] = np.cumsum(new) - 1
+    return order[new], ids.reshape(legs.Right.shape)
+
+
+def _position_pnl(legs, ids, values):
+    """
+    :param values: (distinct legs, ...) value per unit of each distinct leg
+    :return: (positions, ...) PnL, premiums included
+    """
+    scale = legs.Quantity * legs.Multiplier
+    extra = (slice(None),) + (None,) * (values.ndim - 1)
+    pnl = -legs._Cost().reshape((-1,) + (1,) * (values.ndim - 1))
+    for leg in range(legs.Right.shape[1]):
+        pnl = pnl + scale[:, leg][extra] * values[ids[:, leg]]
+    return pnl
+
+
+def expiry_payoff(legs, prices):
+    """
+    PnL of every position if all legs are held to expiry
+    :param legs: Legs
+    :param prices: (m,) underlying prices at expiry
+    :return: (positions, m) array
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    first, ids = _distinct_legs(legs)
+    values = intrinsic(legs.Right.ravel()[first, None], legs.Strike.ravel()[first, None], prices)
+    return _position_pnl(legs, ids, values)
+
+
+def model_value(legs, prices, times, vol, rate=0.0, dividend=0.0):
+    """
+    Mark to model PnL of every position over a price x time grid. Legs are
+    valued with Black Scholes at vol until they expire and at intrinsic after
+    :param prices: (m,) underlying prices
+    :param times: (t,) datetimes or datetime64 to value at
+    :param vol: float, or (positions, legs) array E.g from ImpliedVolSurface.Lookup.
+                A contract held by several positions is valued at the vol of its first
+    :return: (positions, t, m) array
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    times = np.asarray(times, dtype='datetime64[s]')
+    first, ids = _distinct_legs(legs)
+    right = legs.Right.ravel()[first, None, None]
+    strike = legs.Strike.ravel()[first, None, None]
+    expiry = legs.Expiry.ravel()[first]
+    vol = np.broadcast_to(np.asarray(vol, dtype=np.float64), legs.Right.shape).ravel()[first, None, None]
+    # (distinct legs, t, 1) x (m,) -> (distinct legs, t, m)
+    years = np.stack([years_to_expiry(expiry, t) for t in times.tolist()], axis=-1)[..., None]
+    option = right != UNDERLYING
+    with np.errstate(invalid='ignore'):  # the underlying has no strike or expiry
+        model = black_scholes_price(right, prices, np.where(option, strike, 1.0), years, vol, rate, dividend)
+        # expired legs are worth their intrinsic value
+        expired = (expiry[:, None] + np.timedelta64(EXPIRY_OFFSET_SECONDS, 's') <= times)[..., None]
+    values = np.where(option, np.where(expired, intrinsic(right, strike, prices), model), prices)
+    return _position_pnl(legs, ids, values)
+
+
+class RiskSummary(object):
+    """
+    Expiry risk of each position, arrays of length positions. MaxLoss is the
+    worst PnL as a negative number, -inf when the loss is unbounded, and
+    MaxProfit is inf when the profit is unbounded. Breakevens is
+    (positions, legs + 1), padded with NaN
+    """
+
+    __slots__ = ('MaxLoss', 'MaxProfit', 'Breakevens')
+
+    def __init__(self, max_loss, max_profit, breakevens):
+        self.MaxLoss = max_loss
+        self.MaxProfit = max_profit
+        self.Breakevens = breakevens
+
+
+def risk_summary(legs):
+    """
+    The expiry payoff is piecewise linear with kinks at the strikes, so it is
+    evaluated exactly at each position's own strikes, at 0 and past the highest
+    strike, instead of on a fine grid
+    :return: RiskSummary
+    """
+    n = len(legs)
+    options = legs.Right != UNDERLYING
+    strikes = np.where(options, legs.Strike, 0.0)
+    top = strikes.max(axis=1, initial=0.0) * 2.0 + 1.0
+    # (positions, legs + 2) sorted kink points per position
+    points = np.sort(np.concatenate((np.zeros((n, 1)), strikes, top[:, None]), axis=1), axis=1)
+    value = intrinsic(legs.Right[:, :, None], legs.Strike[:, :, None], points[:, None, :])
+    scale = (legs.Quantity * legs.Multiplier)[:, :, None]
+    pnl = (value * scale).sum(axis=1) - legs._Cost()[:, None]
+    # slope beyond the last point: calls and the underlying keep their delta
+    upper_slope = (np.where((legs.Right == OptionRight.CALL) | (legs.Right == UNDERLYING), 1.0, 0.0) *
+                   legs.Quantity * legs.Multiplier).sum(axis=1)
+    max_loss = np.where(upper_slope < 0, -np.inf, pnl.min(axis=1))
+    max_profit = np.where(upper_slope > 0, np.inf, pnl.max(axis=1))
+
+    # breakevens where the PnL changes sign between consecutive points
+    left, right = pnl[:, :-1], pnl[:, 1:]
+    crosses = ((left < 0) & (right >= 0)) | ((left > 0) & (right <= 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = points[:, :-1] + (points[:, 1:] - points[:, :-1]) * left / (left - right)
+    at = np.where(crosses, at, np.nan)
+    # NaN last, so each row lists its breakevens in ascending order first
+    breakevens = np.sort(at, axis=1)
+    return RiskSummary(max_loss, max_profit, breakevens)
@@ -1,8 +1,27 @@
+import heapq
+
 
 class PositionTracker:
+    """
+    Tracks the quantity held of every contract. Only non zero positions are kept,
+    legs that go flat are removed, so flat checks are O(1) and close orders are
+    O(open legs) however many contracts have been traded. Positions opened as a
+    multi leg structure (E.g an iron condor) are also tracked as one unit with
+    their expiry.
+    """
+
+    class Structure(object):
+        __slots__ = ('id', 'legs', 'expiry')
+
+        def __init__(self, structure_id, legs, expiry):
+            self.id = structure_id
+            self.legs = legs  # [(symbol, qty)] as opened
+            self.expiry = expiry
 
     def __init__(self):
-        self.positions = dict() # a map of contract symbol to positions held
+        self.positions = dict() # a map of contract symbol to non zero positions held
+        self.structures = dict() # a map of structure id to open Structure
+        self.next_structure_id = 0
 
 
     def UpdatePositon(self, symbol, total_added):
@@ -12,29 +31,157 @@ class PositionTracker:
         :param total_added: int. Can be positive or negative
         :return: new total
         """
-        if not (symbol in self.positions):
-            self.positions[symbol] = 0
-        self.positions[symbol] += total_added
-        return self.positions[symbol]
+        total = self.positions.get(symbol, 0) + total_added
+        if total == 0:
+            self.positions.pop(symbol, None)
+        else:
+            self.positions[symbol] = total
+        return total
 
     def GetCurrPosition(self, symbol):
-        return 0 if not (symbol in self.positions) else self.positions[symbol]
+        return self.positions.get(symbol, 0)
+
+    def NumOpenLegs(self):
+        return len(self.positions)
 
     # returns a [(symbol, qty)] array required to close out current position
     # empty array if isFlat
     def ToCloseOrders(self):
-        ret = []
-        for symbol in self.positions.keys():
-            if self.positions[symbol] != 0:
-                ret.append((symbol, -self.positions[symbol]))
-        return ret
+        return [(symbol, -qty) for symbol, qty in self.positions.items()]
 
     def IsFlat(self):
         """
         Returns True if no positions held
         :return: boolean
         """
-        for v in self.positions.values():
-            if v != 0:
-                return False
-        return True
+        return not self.positions
+
+    def OpenStructure(self, legs, expiry):
+        """
+        Records a multi leg position and adds its legs to the positions held
+        :param legs: [(symbol, qty)]
+        :param expiry: datetime the structure expires
+        :return: structure id
+        """
+        structure_id = self.next_structure_id
+        self.next_structure_id += 1
+        self.structures[structure_id] = self.Structure(structure_id, list(legs), expiry)
+        for symbol, qty in legs:
+            self.UpdatePositon(symbol, qty)
+        return structure_id
+
+    def CloseStructure(self, structure_id):
+        """
+        Removes a structure and its legs from the positions held
+        :return: [(symbol, qty)] orders required to close it
+        """
+        structure = self.structures.pop(structure_id)
+        orders = [(symbol, -qty) for symbol, qty in structure.legs]
+        for symbol, qty in orders:
+            self.UpdatePositon(symbol, qty)
+        return orders
+
+    def CloseLegs(self, structure_id, orders):
+        """
+        Removes the legs of a structure that were closed from the positions held.
+        The structure is removed once none of its legs are left
+        :param orders: [(symbol, qty)] close orders that filled, as from CloseStructure
+        :return: [(symbol, qty)] legs of the structure still open
+        """
+        structure = self.structures[structure_id]
+        legs = list(structure.legs)
+        for symbol, qty in orders:
+            legs.remove((symbol, -qty))
+            self.UpdatePositon(symbol, qty)
+        if legs:
+            structure.legs = legs
+        else:
+            del self.structures[structure_id]
+        return legs
+
+    def GetStructure(self, structure_id):
+        return self.structures.get(structure_id)
+
+    def NumOpenStructures(self):
+        return len(self.structures)
+
+    def GetState(self):
+        """
+        :return: dict of plain values, the positions and open structures
+        """
+        return {
+            "positions": [[symbol, qty] for symbol, qty in self.positions.items()],
+            "structures": [[s.id, [list(leg) for leg in s.legs], s.expiry]
+                           for s in self.structures.values()],
+            "next_structure_id": self.next_structure_id,
+        }
+
+    def SetState(self, state):
+        self.positions = dict((symbol, qty) for symbol, qty in state["positions"])
+        self.structures = dict((structure_id, self.Structure(structure_id, [tuple(leg) for leg in legs], expiry))
+                               for structure_id, legs, expiry in state["structures"])
+        self.next_structure_id = state["next_structure_id"]
+
+
+class PositionScheduler:
+    """
+    Lifecycle scheduler for open structures. A min heap of (close time, structure id)
+    so the structures due to close are popped in O(log n) each, without scanning
+    the positions held, however many staggered structures are open.
+    """
+
+    def __init__(self):
+        self.heap = [] # (close time, structure id)
+        self.scheduled = set() # ids in the heap that are still live
+        self.cancelled = set() # ids removed before they were due, dropped lazily
+
+    def Schedule(self, structure_id, close_time):
+        heapq.heappush(self.heap, (close_time, structure_id))
+        self.scheduled.add(structure_id)
+
+    def Cancel(self, structure_id):
+        if structure_id in self.scheduled:
+            self.scheduled.discard(structure_id)
+            self.cancelled.add(structure_id)
+
+    def _DropCancelled(self):
+        while self.heap and self.heap[0][1] in self.cancelled:
+            self.cancelled.discard(heapq.heappop(self.heap)[1])
+
+    def NextCloseTime(self):
+        """
+        :return: earliest scheduled close time, None if nothing is scheduled
+        """
+        self._DropCancelled()
+        return self.heap[0][0] if self.heap else None
+
+    def HasDue(self, time):
+        next_close = self.NextCloseTime()
+        return next_close is not None and next_close <= time
+
+    def PopDue(self, time):
+        """
+        :return: ids of the structures with a close time <= time, earliest first
+        """
+        due = []
+        while self.HasDue(time):
+            structure_id = heapq.heappop(self.heap)[1]
+            self.scheduled.discard(structure_id)
+            due.append(structure_id)
+        return due
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def GetState(self):
+        """
+        :return: dict of plain values, the live (close time, structure id) entries
+        """
+        return {"scheduled": [[close_time, structure_id] for close_time, structure_id in sorted(self.heap)
+                              if structure_id in self.scheduled]}
+
+    def SetState(self, state):
+        self.heap = [(close_time, structure_id) for close_time, structure_id in state["scheduled"]]
+        heapq.heapify(self.heap)
+        self.scheduled = set(structure_id for _, structure_id in self.heap)
+        self.cancelled = set()
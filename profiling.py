@@ -0,0 +1,185 @@
+"""
+Low overhead timing of algorithm stages, see QCAlgorithm.EnableProfiling.
+
+Stages are methods of the algorithm wrapped on the instance, so nothing is
+timed, and nothing costs anything, unless profiling was enabled. Durations go
+into fixed size histograms, so memory does not grow with the length of a run.
+Times are inclusive, a stage that calls another (E.g OnData calling the daily
+handler) includes the time spent in it.
+"""
+import json
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    # python < 3.7
+    from timeit import default_timer
+
+    def perf_counter_ns():
+        return int(default_timer() * 1e9)
+
+
+# methods of QCAlgorithm and the strategies timed when no stages are given.
+# Names an algorithm does not have are ignored
+DEFAULT_STAGES = (
+    "OnData",
+    "OnDataHandler",  # ConvertDailyResolution's session executor
+    "DataHandler",
+    "GetSignal",
+    "OpenPosition",
+    "ClosePosition",
+    "IronCondor",
+    "MarketOrder",
+    "MarkPortfolio",
+    "Debug",
+    "Log",
+)
+
+
+def _bucket(ns):
+    # 4 buckets per power of 2, so any duration is within 25% of its bucket
+    if ns < 4:
+        return max(ns, 0)
+    bits = ns.bit_length()
+    return (bits - 2) * 4 + ((ns >> (bits - 3)) & 3)
+
+
+def _bucket_floor(bucket):
+    if bucket < 4:
+        return bucket
+    return (4 + bucket % 4) << (bucket // 4 - 1)
+
+
+class StageHistogram(object):
+    """
+    Durations of one stage in nanoseconds. A fixed list of log linear buckets
+    plus count, total, min and max
+    """
+
+    NUM_BUCKETS = 256 # covers every 64 bit duration
+
+    __slots__ = ('name', 'calls', 'count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0 # calls seen, sampled or not
+        self.count = 0 # calls timed
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.buckets = [0] * self.NUM_BUCKETS
+
+    def Record(self, ns):
+        self.count += 1
+        self.total += ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+        if ns > self.max:
+            self.max = ns
+        self.buckets[_bucket(ns)] += 1
+
+    def Percentile(self, q):
+        """
+        :param q: float in [0, 1]
+        :return: estimated duration in ns, None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                low, high = _bucket_floor(bucket), _bucket_floor(bucket + 1)
+                return min(max((low + high) // 2, self.min), self.max)
+        return self.max
+
+    def Summary(self):
+        """
+        :return: dict of the stage's statistics, durations in microseconds
+        """
+        count = self.count
+        scale = self.calls / float(count) if count else 0.0
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "timed": count,
+            # total extrapolated from the timed calls when sampling
+            "total_ms": self.total * scale / 1e6,
+            "mean_us": self.total / float(count) / 1e3 if count else 0.0,
+            "p50_us": (self.Percentile(0.5) or 0) / 1e3,
+            "p99_us": (self.Percentile(0.99) or 0) / 1e3,
+            "max_us": self.max / 1e3,
+        }
+
+
+class Profiler(object):
+    """
+    Wraps callables so their durations are recorded per stage. With sample_every
+    N > 1 only every Nth call of a stage is timed, the others only pay for a
+    counter increment.
+    """
+
+    def __init__(self, stages=DEFAULT_STAGES, sample_every=1):
+        self.stage_names = list(stages)
+        self.sample_every = max(1, int(sample_every))
+        self.stages = {} # name -> StageHistogram, in first use order below
+        self.order = []
+
+    def Stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageHistogram(name)
+            self.order.append(name)
+        return stage
+
+    def Wrap(self, name, fn):
+        """
+        :return: fn timed as stage name
+        """
+        stage = self.Stage(name)
+        clock = perf_counter_ns
+        every = self.sample_every
+
+        if every == 1:
+            def timed(*args, **kwargs):
+                stage.calls += 1
+                start = clock()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    stage.Record(clock() - start)
+        else:
+            def timed(*args, **kwargs):
+                stage.calls += 1
+                if stage.calls % every:
+                    return fn(*args, **kwargs)
+                start = clock()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    stage.Record(clock() - start)
+        timed.__name__ = getattr(fn, '__name__', name)
+        timed.wrapped = fn
+        return timed
+
+    def Summary(self):
+        """
+        :return: list of dicts, slowest stage in total first
+        """
+        rows = [self.stages[name].Summary() for name in self.order if self.stages[name].calls]
+        return sorted(rows, key=lambda r: -r["total_ms"])
+
+    def Table(self):
+        columns = ("stage", "calls", "timed", "total_ms", "mean_us", "p50_us", "p99_us", "max_us")
+        rows = [columns] + [[r[c] if c == "stage" else "{:.6g}".format(r[c]) for c in columns]
+                            for r in self.Summary()]
+        widths = [max(len(str(row[i])) for row in rows) for i in range(len(columns))]
+        return "\n".join("  ".join(str(c).rjust(w) for c, w in zip(row, widths)) for row in rows)
+
+    def Dump(self, path):
+        """
+        Writes the summary as JSON, one object per stage
+        """
+        with open(path, "w") as f:
+            json.dump(self.Summary(), f, indent=2, sort_keys=True)
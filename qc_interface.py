@@ -1,4 +1,10 @@
+from bisect import bisect_right
 from datetime import datetime, timedelta
+import sys
+
+from lazy_import import lazy_import
+
+np = lazy_import("numpy", globals(), "np")
 
 
 class Resolution:
@@ -9,6 +15,21 @@ class Resolution:
     Hourly = 3
     Daily = 4
 
+def _synthetic_quotes(right, spot, strike, expiry, time, volatility):
+    """
+    Bid/ask around a zero rate Black Scholes price, used to quote the synthetic
+    chains. Contracts expire at the close of their expiry date, see option_pricing.
+    :param right, strike: arrays of OptionRight and strikes
+    :param expiry: datetime64 array
+    :return: (bid array, ask array)
+    """
+    # imported here as option_pricing imports OptionRight from this module
+    from option_pricing import black_scholes_price, years_to_expiry
+    mid = np.maximum(0.0, black_scholes_price(right, spot, strike, years_to_expiry(expiry, time), volatility))
+    half_spread = np.maximum(0.05, 0.01 * mid)
+    return np.maximum(0.0, mid - half_spread), mid + half_spread
+
+
 class TimeSpan:
 
     @classmethod
@@ -16,74 +37,366 @@ class TimeSpan:
         return timedelta(days=days)
 
 
+# not actually defined in actual Quant connect (which has OptionRight.Call/Put)
+class OptionRight:
+    PUT = 0
+    CALL = 1
+
+
 class OptionChain:
 
     # class holding the actual option chain data
     class OptionChainValue:
 
         class Stock(object):
-            Price = 2000.0
+            __slots__ = ('symbol', 'Price')
 
-            def __init__(self, symbol):
+            def __init__(self, symbol, price=None):
                 self.symbol = symbol
+                self.Price = 2000.0 if price is None else price
 
         class Option(object):
+            # slotted as the harness makes tens of thousands of them
+            __slots__ = ('Right', 'Symbol', 'Strike', 'BidPrice', 'AskPrice',
+                         'UnderlyingLastPrice', 'Expiry')
 
-            # not actually defined in actual Quant connect
-            class Right:
-                PUT = 0
-                CALL = 1
-
-            # right = call/put
+            # right = call/put, an OptionRight
             def __init__(self, right):
-                self.right = right
+                self.Right = right
+                self.Symbol = None
                 self.Strike = 0.0
                 self.BidPrice = 0.0
                 self.AskPrice = 0.0
+                self.UnderlyingLastPrice = 0.0
                 self.Expiry = datetime(year=2018, month=1, day=1)
 
+            @classmethod
+            def MakeSymbol(cls, underlying, right, expiry, strike):
+                # OSI style contract symbol E.g SPY 180119C02000000
+                return "{} {}{}{:08d}".format(underlying, expiry.strftime("%y%m%d"),
+                                               "C" if right == OptionRight.CALL else "P",
+                                               int(round(strike * 1000)))
+
+            @classmethod
+            def ParseSymbol(cls, symbol):
+                """
+                Inverse of MakeSymbol
+                :return: (underlying, right, expiry, strike), None if symbol is not a contract
+                """
+                parts = symbol.split(" ")
+                if len(parts) != 2 or len(parts[1]) != 15 or parts[1][6] not in "CP":
+                    return None
+                code = parts[1]
+                right = OptionRight.CALL if code[6] == "C" else OptionRight.PUT
+                expiry = datetime(2000 + int(code[0:2]), int(code[2:4]), int(code[4:6]))
+                return parts[0], right, expiry, int(code[7:]) / 1000.0
 
-        def __init__(self, symbol, date_range=None, price_range=None):
+
+        def __init__(self, symbol, date_range=None, price_range=None, underlying_price=None,
+                     time=None, volatility=None, strike_bounds=None):
             """
+            Contracts are not built up front. The chain is the grid of
+            expiry days x rights x strikes described by the arguments and an
+            Option is only made when it is iterated over or looked up by index.
+            Index order is (right, expiry, strike), the ColumnarOptionChain order.
             :param symbol: a string all CAPS of the ticker symbol
             :param date_range: (start datetime, end datetime)
             :param price_range: expreseed as change in price E.g (-20.00, 20.00)
+            :param underlying_price: last price of the underlying, strikes are centred on it
+            :param time: time the chain is quoted at
+            :param volatility: annualised volatility to price bid/ask with. Quotes are 0 when None
+            :param strike_bounds: optional fn(expiry datetime) -> (low, high) underlying prices.
+                                  The expiry then lists price_range around every price
+                                  between them rather than around underlying_price only
             """
-            self.Underlying = self.Stock(symbol)
+            self.Underlying = self.Stock(symbol, underlying_price)
+            self.time = time
+            self.volatility = volatility
             self.Key = symbol
-            self.Value = []  # an array of options
             if date_range is None:
                 # arbitrary date range
                 date_range = (datetime(2018, 1, 1), datetime(2018, 12, 31))
-            start, end = date_range
-            num_days = (end - start).days
-            for i in xrange(num_days):
-                curr_date = start + timedelta(days=i)
-                rights = [self.Option.Right.PUT, self.Option.Right.CALL]
-                for right in rights:
-                    if price_range is None:
-                        price_range = (-20, 20)
-                    ps,pe = price_range
-                    price_deltas = [float(i) for i in xrange(int(ps), int(pe), 1)]
-                    for price_delta in price_deltas:
-                        o = self.Option(right=right)
-                        o.Expiry = curr_date
-                        o.Strike = self.Underlying.Price + price_delta
-                        o.BidPrice = 0.0
-                        o.AskPrice = 0.0
-                        self.Value.append(o)
+            if price_range is None:
+                price_range = (-20, 20)
+            self.start = date_range[0]
+            self.num_days = max(0, (date_range[1] - date_range[0]).days)
+            ps, pe = int(price_range[0]), int(price_range[1])
+            # lowest strike and number of strikes of every expiry day
+            self.first_strikes = []
+            self.num_strikes = []
+            for day in range(self.num_days):
+                if strike_bounds is None:
+                    low = high = round(self.Underlying.Price)
+                else:
+                    low, high = strike_bounds(self.start + timedelta(days=day))
+                    low, high = round(low), round(high)
+                self.first_strikes.append(float(low + ps))
+                self.num_strikes.append(max(0, int(high - low) + pe - ps))
+            # index of the first strike of every day within a right
+            self.day_starts = [0]
+            for count in self.num_strikes:
+                self.day_starts.append(self.day_starts[-1] + count)
+            self.rights = [OptionRight.PUT, OptionRight.CALL]
+            self.materialized = {}  # index -> Option, contracts built so far
+
+        def __len__(self):
+            return len(self.rights) * self.day_starts[-1]
+
+        def __getitem__(self, i):
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError("OptionChainValue index out of range")
+            o = self.materialized.get(i)
+            if o is None:
+                right_index, rest = divmod(i, self.day_starts[-1])
+                day = bisect_right(self.day_starts, rest) - 1
+                right = self.rights[right_index]
+                o = self.Option(right=right)
+                o.Expiry = self.start + timedelta(days=day)
+                o.Strike = self.first_strikes[day] + float(rest - self.day_starts[day])
+                if self.volatility is not None:
+                    bid, ask = _synthetic_quotes(right, self.Underlying.Price, o.Strike,
+                                                 np.datetime64(o.Expiry, 's'), self.time, self.volatility)
+                    o.BidPrice, o.AskPrice = float(bid), float(ask)
+                else:
+                    o.BidPrice = 0.0
+                    o.AskPrice = 0.0
+                o.UnderlyingLastPrice = self.Underlying.Price
+                o.Symbol = self.Option.MakeSymbol(self.Key, right, o.Expiry, o.Strike)
+                self.materialized[i] = o
+            return o
 
         def __iter__(self):
-            for o in self.Value:
-                yield o
+            for i in range(len(self)):
+                yield self[i]
+
+        def ToColumnar(self):
+            """
+            Columns of the whole grid computed directly, without making any Option
+            :return: ColumnarOptionChain
+            """
+            per_right = self.day_starts[-1]
+            counts = np.asarray(self.num_strikes, dtype=np.int64)
+            expiries = np.datetime64(self.start, 's') + \
+                np.arange(self.num_days).astype('timedelta64[D]').astype('timedelta64[s]')
+            # position of every strike within its day
+            offsets = np.arange(per_right) - np.repeat(np.asarray(self.day_starts[:-1], dtype=np.int64), counts)
+            strikes = np.repeat(np.asarray(self.first_strikes, dtype=np.float64), counts) + offsets
+            rights = np.repeat(self.rights, per_right)
+            strike_col = np.tile(strikes, len(self.rights))
+            expiry_col = np.tile(np.repeat(expiries, counts), len(self.rights))
+            if self.volatility is not None:
+                bid, ask = _synthetic_quotes(rights, self.Underlying.Price, strike_col, expiry_col,
+                                             self.time, self.volatility)
+            else:
+                bid = ask = np.zeros(len(self))
+            return ColumnarOptionChain(rights, strike_col, expiry_col, bid, ask,
+                                       underlying_price=self.Underlying.Price,
+                                       symbol=self.Key, presorted=True)
 
 
-    def __init__(self, symbol, date_range=None):
+    def __init__(self, symbol, date_range=None, underlying_price=None, price_range=None,
+                 time=None, volatility=None, strike_bounds=None):
         self.Key = symbol
-        self.Value = self.OptionChainValue(symbol, date_range)
+        self.Value = self.OptionChainValue(symbol, date_range, price_range=price_range,
+                                           underlying_price=underlying_price,
+                                           time=time, volatility=volatility, strike_bounds=strike_bounds)
+
+    @classmethod
+    def FromFilter(cls, symbol, time, option_filter, underlying_price=None, volatility=None, strike_bounds=None):
+        """
+        Chain listing only the contracts an OptionSecurityObject filter lets through
+        :param time: current time, expiries are relative to its date
+        :param option_filter: (min_strike, max_strike, min_expiry, max_expiry) as passed to SetFilter
+        :param volatility: annualised volatility the quotes are priced with
+        :param strike_bounds: see OptionChainValue, strikes listed earlier in an
+                              expiry's life then stay listed as the underlying moves
+        :return: OptionChain
+        """
+        min_strike, max_strike, min_exp, max_exp = option_filter
+        day = datetime(time.year, time.month, time.day)
+        return cls(symbol, (day + min_exp, day + max_exp + timedelta(days=1)),
+                   underlying_price=underlying_price, price_range=(min_strike, max_strike + 1),
+                   time=time, volatility=volatility, strike_bounds=strike_bounds)
+
+
+class ColumnarOptionChain(object):
+    """
+    Column oriented option chain. Right, strike, expiry, bid and ask are held in
+    NumPy arrays sorted once at construction by (right, expiry, strike), so each
+    right is one contiguous block and each (right, expiry) pair is a contiguous
+    run of ascending strikes within it. Strike and expiry lookups are
+    searchsorted calls on those runs instead of scans over the contracts.
+    Index i of every array refers to the same contract, Contract(i).
+    """
+
+    def __init__(self, right, strike, expiry, bid, ask, contracts=None, underlying_price=None,
+                 symbol=None, presorted=False):
+        """
+        :param right: array like of OptionRight values
+        :param strike: array like of floats
+        :param expiry: array like of datetimes or datetime64
+        :param bid: array like of floats
+        :param ask: array like of floats
+        :param contracts: optional array like of the contract objects the columns came from
+        :param underlying_price: last price of the underlying
+        :param symbol: underlying symbol, used to name contracts built on demand
+        :param presorted: columns are already in (right, expiry, strike) order. They
+                          are then used as is, so views (E.g over a memmap) are not copied
+        """
+        right = np.asarray(right, dtype=np.int8)
+        strike = np.asarray(strike, dtype=np.float64)
+        expiry = np.asarray(expiry, dtype='datetime64[s]')
+        bid = np.asarray(bid, dtype=np.float64)
+        ask = np.asarray(ask, dtype=np.float64)
+        if contracts is not None:
+            contracts = np.asarray(contracts, dtype=object)
+        if not presorted:
+            order = np.lexsort((strike, expiry, right))
+            right, strike, expiry, bid, ask = right[order], strike[order], expiry[order], bid[order], ask[order]
+            if contracts is not None:
+                contracts = contracts[order]
+        self.Right = right
+        self.Strike = strike
+        self.Expiry = expiry
+        self.BidPrice = bid
+        self.AskPrice = ask
+        self.Contracts = contracts
+        self.UnderlyingLastPrice = underlying_price
+        self.Symbol = symbol
+        self._build_index()
+
+    def _build_index(self):
+        n = len(self.Right)
+        # starts of each (right, expiry) run
+        if n:
+            change = (self.Right[1:] != self.Right[:-1]) | (self.Expiry[1:] != self.Expiry[:-1])
+            starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+        else:
+            starts = np.zeros(0, dtype=np.int64)
+        stops = np.append(starts[1:], n)
+        self._runs = {}  # (right, expiry) -> (start, stop)
+        self._right_bounds = {}  # right -> (start, stop)
+        self._expiries = {}  # right -> sorted unique expiries
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            right = int(self.Right[start])
+            self._runs[(right, self.Expiry[start])] = (start, stop)
+            if right in self._right_bounds:
+                self._right_bounds[right] = (self._right_bounds[right][0], stop)
+            else:
+                self._right_bounds[right] = (start, stop)
+        for right, (start, stop) in self._right_bounds.items():
+            self._expiries[right] = np.unique(self.Expiry[start:stop])
+
+    @classmethod
+    def FromContracts(cls, option_chain):
+        """
+        Builds the columns from any iterable of Option contracts in one pass
+        :param option_chain: OptionChain value, iterable of Option objects
+        :return: ColumnarOptionChain
+        """
+        if isinstance(option_chain, cls):
+            return option_chain
+        if hasattr(option_chain, 'ToColumnar'):
+            return option_chain.ToColumnar()
+        contracts = list(option_chain)
+        underlying_price = contracts[0].UnderlyingLastPrice if contracts else None
+        return cls([o.Right for o in contracts],
+                   [float(o.Strike) for o in contracts],
+                   [o.Expiry for o in contracts],
+                   [float(o.BidPrice) for o in contracts],
+                   [float(o.AskPrice) for o in contracts],
+                   contracts=contracts,
+                   underlying_price=underlying_price)
+
+    def __len__(self):
+        return len(self.Right)
+
+    # contracts in (right, expiry, strike) order
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.Contract(i)
+
+    def Contract(self, i):
+        """
+        Contract object for index i. Built from the columns when the chain was
+        not constructed from contract objects
+        :return: Option
+        """
+        if self.Contracts is not None:
+            return self.Contracts[i]
+        Option = OptionChain.OptionChainValue.Option
+        o = Option(int(self.Right[i]))
+        o.Strike = float(self.Strike[i])
+        o.Expiry = self.Expiry[i].item()
+        o.BidPrice = float(self.BidPrice[i])
+        o.AskPrice = float(self.AskPrice[i])
+        o.UnderlyingLastPrice = self.UnderlyingLastPrice
+        o.Symbol = Option.MakeSymbol(self.Symbol, o.Right, o.Expiry, o.Strike)
+        return o
+
+    def Expiries(self, right):
+        """
+        :return: sorted datetime64 array of the expiries listed for right
+        """
+        return self._expiries.get(right, np.zeros(0, dtype='datetime64[s]'))
+
+    def RightBounds(self, right):
+        """
+        :return: (start, stop) of the block of contracts with this right
+        """
+        return self._right_bounds.get(right, (0, 0))
+
+    def ExpiringAfter(self, right, min_date):
+        """
+        Contracts of right that expire strictly after min_date, sorted by (expiry, strike)
+        :return: (start, stop) index range
+        """
+        start, stop = self.RightBounds(right)
+        offset = np.searchsorted(self.Expiry[start:stop], np.datetime64(min_date, 's'), side='right')
+        return start + int(offset), stop
 
+    def StrikeRun(self, right, expiry):
+        """
+        :return: (start, stop) of the ascending strikes listed for (right, expiry)
+        """
+        return self._runs.get((right, np.datetime64(expiry, 's')), (0, 0))
 
-class Bar:
+    def IndexAtOrAbove(self, right, expiry, target):
+        """
+        :return: index of the lowest strike >= target for (right, expiry), -1 if none
+        """
+        start, stop = self.StrikeRun(right, expiry)
+        i = start + int(np.searchsorted(self.Strike[start:stop], target, side='left'))
+        return i if i < stop else -1
+
+    def IndexAtOrBelow(self, right, expiry, target):
+        """
+        :return: index of the highest strike <= target for (right, expiry), -1 if none
+        """
+        start, stop = self.StrikeRun(right, expiry)
+        i = start + int(np.searchsorted(self.Strike[start:stop], target, side='right')) - 1
+        return i if i >= start else -1
+
+    def Find(self, right, expiry, strike):
+        """
+        :return: index of the contract (right, expiry, strike), -1 if not listed
+        """
+        i = self.IndexAtOrAbove(right, expiry, strike)
+        return i if i >= 0 and self.Strike[i] == strike else -1
+
+    def ContractsIn(self, start, stop):
+        """
+        :return: contract objects for an index range
+        """
+        if self.Contracts is not None:
+            return self.Contracts[start:stop].tolist()
+        return [self.Contract(i) for i in range(start, stop)]
+
+
+class Bar(object):
+    __slots__ = ('Open', 'Close', 'High', 'Low', 'symbol')
 
     def __init__(self, symbol):
         self.Open = 2000.0
@@ -91,7 +404,6 @@ class Bar:
         self.High = 2000.0
         self.Low = 2000.0
         self.symbol = symbol
-        pass
 
 class Slice:
 
@@ -108,36 +420,336 @@ class Slice:
             return self.Bars[symbol]
 
 
-class SecurityObject:
+class SecurityObject(object):
+    __slots__ = ('symbol', 'Resolution', 'IsLong', 'IsShort', 'Invested')
 
-    def __init__(self, symbol):
+    def __init__(self, symbol, resolution=Resolution.Daily):
         self.symbol = symbol
+        self.Resolution = resolution
         self.IsLong = False
-        self.Isshort = False
+        self.IsShort = False
         self.Invested = False
 
 
 class OptionSecurityObject:
 
-    def __init__(self, symbol):
+    def __init__(self, symbol, resolution=Resolution.Minute):
         self.symbol = symbol
         self.Symbol = symbol # Quantconnect's attr
+        self.Resolution = resolution
+        self.Filter = None # (min_strike, max_strike, min_expiry, max_expiry)
 
     def SetFilter(self, min_strike, max_strike, min_exp, max_exp):
         assert type(min_strike) == int and type(max_strike) == int, "Args to SetFilter Type error"
-        pass
+        self.Filter = (min_strike, max_strike, min_exp, max_exp)
+
+
+
+
+class SecurityHolding(object):
+    """
+    Live view of one symbol's row in a PortfolioClass. The portfolio hands out
+    the same object for a symbol every time, so flags read from it stay current
+    """
+    __slots__ = ('portfolio', 'row', 'Symbol')
+
+    def __init__(self, portfolio, row, symbol):
+        self.portfolio = portfolio
+        self.row = row
+        self.Symbol = symbol
 
+    @property
+    def Quantity(self):
+        return float(self.portfolio.quantity[self.row])
 
+    @property
+    def AveragePrice(self):
+        return float(self.portfolio.average_price[self.row])
 
+    @property
+    def Price(self):
+        return float(self.portfolio.price[self.row])
 
-class PortfolioClass:
+    @property
+    def Invested(self):
+        return self.portfolio.quantity[self.row] != 0
+
+    @property
+    def IsLong(self):
+        return self.portfolio.quantity[self.row] > 0
+
+    @property
+    def IsShort(self):
+        return self.portfolio.quantity[self.row] < 0
+
+    @property
+    def HoldingsValue(self):
+        p = self.portfolio
+        return float(p.quantity[self.row] * p.price[self.row] * p.multiplier[self.row])
+
+    @property
+    def UnrealizedProfit(self):
+        p = self.portfolio
+        return float(p.quantity[self.row] * (p.price[self.row] - p.average_price[self.row]) *
+                     p.multiplier[self.row])
+
+
+class PortfolioClass(object):
+    """
+    Cash and holdings for the local harness. Holdings are kept as parallel
+    arrays (quantity, average price, mark price, multiplier) with one row per
+    symbol ever traded. Total holdings value and cost basis are running sums
+    adjusted by every fill and mark, so portfolio value is O(1) and marking a
+    slice only touches the rows that are held and quoted in it.
+    """
+
+    OPTION_MULTIPLIER = 100.0
+
+    def __init__(self):
+        self.Cash = 0.0
+        self.index = {}  # symbol -> row
+        self.symbols = []  # row -> symbol
+        self.contracts = []  # row -> (underlying, right, expiry, strike) or None for equities
+        self.holdings = []  # row -> SecurityHolding
+        capacity = 16
+        self.quantity = np.zeros(capacity)
+        self.average_price = np.zeros(capacity)
+        self.price = np.zeros(capacity)
+        self.multiplier = np.ones(capacity)
+        self.open_rows = set()  # rows with a non zero quantity
+        self.holdings_value = 0.0  # sum of quantity * price * multiplier
+        self.cost_basis = 0.0  # sum of quantity * average price * multiplier
+        self.realized_profit = 0.0
+        self.underlying_prices = {}  # last price of each equity symbol marked
+
+    def _Row(self, symbol):
+        row = self.index.get(symbol)
+        if row is None:
+            row = len(self.symbols)
+            if row == len(self.quantity):
+                for name in ('quantity', 'average_price', 'price'):
+                    setattr(self, name, np.concatenate((getattr(self, name), np.zeros(row))))
+                self.multiplier = np.concatenate((self.multiplier, np.ones(row)))
+            contract = OptionChain.OptionChainValue.Option.ParseSymbol(symbol)
+            if contract is not None:
+                self.multiplier[row] = self.OPTION_MULTIPLIER
+            self.index[symbol] = row
+            self.symbols.append(symbol)
+            self.contracts.append(contract)
+            self.holdings.append(SecurityHolding(self, row, symbol))
+        return row
 
     def __getitem__(self, symbol):
-        return SecurityObject(symbol)
+        return self.holdings[self._Row(symbol)]
+
+    def Contract(self, symbol):
+        """
+        :return: (underlying, right, expiry, strike) of an option symbol, None for equities
+        """
+        return self.contracts[self._Row(symbol)]
+
+    def __contains__(self, symbol):
+        return symbol in self.index
+
+    def SetCash(self, cash):
+        self.Cash = float(cash)
+
+    @property
+    def TotalPortfolioValue(self):
+        return self.Cash + self.holdings_value
+
+    @property
+    def TotalHoldingsValue(self):
+        return self.holdings_value
+
+    @property
+    def TotalUnrealizedProfit(self):
+        return self.holdings_value - self.cost_basis
+
+    @property
+    def TotalProfit(self):
+        return self.realized_profit
+
+    @property
+    def Invested(self):
+        return len(self.open_rows) > 0
+
+    def Fill(self, symbol, quantity, price):
+        """
+        Applies a fill to cash and holdings
+        :param quantity: signed quantity filled
+        :param price: fill price per unit
+        """
+        if quantity == 0:
+            return
+        row = self._Row(symbol)
+        m = self.multiplier[row]
+        old_qty = self.quantity[row]
+        old_avg = self.average_price[row]
+        new_qty = old_qty + quantity
+        self.Cash -= quantity * price * m
+        if old_qty == 0 or (old_qty > 0) == (quantity > 0):
+            # opening or adding
+            new_avg = (old_avg * abs(old_qty) + price * abs(quantity)) / abs(new_qty)
+        else:
+            closed = min(abs(quantity), abs(old_qty))
+            direction = 1.0 if old_qty > 0 else -1.0
+            self.realized_profit += (price - old_avg) * closed * direction * m
+            if new_qty == 0:
+                new_avg = 0.0
+            elif (new_qty > 0) == (old_qty > 0):
+                new_avg = old_avg
+            else:
+                new_avg = price  # flipped through zero
+        self.holdings_value += (new_qty * price - old_qty * self.price[row]) * m
+        self.cost_basis += (new_qty * new_avg - old_qty * old_avg) * m
+        self.quantity[row] = new_qty
+        self.average_price[row] = new_avg
+        self.price[row] = price
+        if new_qty != 0:
+            self.open_rows.add(row)
+        else:
+            self.open_rows.discard(row)
+
+    def Mark(self, symbol, price):
+        """
+        Updates the mark price of symbol, adjusting holdings value by the change
+        """
+        row = self.index.get(symbol)
+        if row is not None:
+            self.holdings_value += self.quantity[row] * (price - self.price[row]) * self.multiplier[row]
+            self.price[row] = price
+
+    def SettleExpired(self, time):
+        """
+        Cash settles held options that expired before time at intrinsic value
+        of the last underlying price
+        :return: list of (symbol, quantity) settled
+        """
+        settled = []
+        for row in list(self.open_rows):
+            contract = self.contracts[row]
+            if contract is None:
+                continue
+            underlying, right, expiry, strike = contract
+            if expiry.date() >= time.date() or underlying not in self.underlying_prices:
+                continue
+            spot = self.underlying_prices[underlying]
+            intrinsic = max(0.0, spot - strike) if right == OptionRight.CALL else max(0.0, strike - spot)
+            quantity = -self.quantity[row]
+            self.Fill(self.symbols[row], quantity, intrinsic)
+            settled.append((self.symbols[row], quantity))
+        return settled
+
+    def GetState(self):
+        """
+        :return: dict of plain values, cash and the open holdings
+        """
+        return {
+            "cash": self.Cash,
+            "realized_profit": self.realized_profit,
+            "underlying_prices": self.underlying_prices,
+            "holdings": [[self.symbols[row], float(self.quantity[row]), float(self.average_price[row]),
+                          float(self.price[row])] for row in sorted(self.open_rows)],
+        }
+
+    def SetState(self, state):
+        self.__init__()
+        self.Cash = state["cash"]
+        self.realized_profit = state["realized_profit"]
+        self.underlying_prices = dict(state["underlying_prices"])
+        for symbol, quantity, average_price, price in state["holdings"]:
+            row = self._Row(symbol)
+            m = self.multiplier[row]
+            self.quantity[row] = quantity
+            self.average_price[row] = average_price
+            self.price[row] = price
+            self.open_rows.add(row)
+            self.holdings_value += quantity * price * m
+            self.cost_basis += quantity * average_price * m
+
+
+class BufferedLogWriter(object):
+    """
+    Local only. Writes lines to a stream from a background thread so Debug and
+    Log never block on stdout. Lines queued while a write is in progress are
+    joined and written together in the next one
+    """
+
+    MAX_BATCH = 4096 # lines per write
+
+    # writers not closed yet, closed by one exit hook so none is torn down mid write
+    open_writers = set()
+    exit_hook = False
+
+    def __init__(self, stream):
+        # imported here so algorithms that never log do not load them
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        self.empty = queue.Empty
+        self.stream = stream
+        self.lines = queue.Queue()
+        self.thread = threading.Thread(target=self._Run, name="BufferedLogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+        if not BufferedLogWriter.exit_hook:
+            import atexit
+            atexit.register(BufferedLogWriter.CloseAll)
+            BufferedLogWriter.exit_hook = True
+        self.open_writers.add(self)
+
+    def Write(self, line):
+        self.lines.put(line)
+
+    def Flush(self):
+        """
+        Blocks until every line written so far is on the stream
+        """
+        if self.thread.is_alive():
+            self.lines.join()
+
+    def Close(self):
+        """
+        Writes the lines queued and stops the thread. Does nothing once closed
+        """
+        if self in self.open_writers:
+            self.open_writers.discard(self)
+            self.lines.put(None)
+            self.thread.join()
+
+    @classmethod
+    def CloseAll(cls):
+        for writer in list(cls.open_writers):
+            writer.Close()
+
+    def _Run(self):
+        while True:
+            batch = [self.lines.get()]
+            try:
+                while len(batch) < self.MAX_BATCH and batch[-1] is not None:
+                    batch.append(self.lines.get_nowait())
+            except self.empty:
+                pass
+            closing = batch[-1] is None
+            lines = batch[:-1] if closing else batch
+            try:
+                if lines:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+            finally:
+                for _ in batch:
+                    self.lines.task_done()
+            if closing:
+                return
 
 
 class QCAlgorithm:
 
+    STATE_VERSION = 1 # of SaveState snapshots
+
     def __init__(self):
             self.Securities = []  # Array of Security objects.
             self.Portfolio = PortfolioClass()    # Array of SecurityHolding objects
@@ -148,28 +760,127 @@ class QCAlgorithm:
             self.Time = None # current time in the backtest
 
             # Not attrs in Quant connect
-            self.cash = 0.0 # total cash in account
+            self.starting_cash = 0.0 # cash as set by SetCash
+            self.CurrentSlice = None # slice being dispatched, fills are priced from it
+            self.columnar_quotes = {} # chain symbol -> (chain value, ColumnarOptionChain, {symbol: index})
             self.start_date = None
             self.end_date = None
+            self.date_overrides = (None, None) # see OverrideDates
             self.IsWarmingUp = True
             self.warm_up_length = 0
+            self.parameters = {} # name -> value, see GetParameter
+            self.data_schedule = None # see SetDataSchedule
+            self.profiler = None # see EnableProfiling
+            self.profiled_stages = set() # method names wrapped by the profiler
+            self.profile_output = None
+            self.log_writer = None # BufferedLogWriter, created by the first message
+            self.log_stream = None # where Log and Debug write, sys.stdout when None
+
+    def _LogWriter(self):
+        if self.log_writer is None:
+            self.log_writer = BufferedLogWriter(self.log_stream or sys.stdout)
+        return self.log_writer
 
     def Log(self, msg):
-        print msg
+        self._LogWriter().Write(str(msg))
 
     def Debug(self, msg):
-        print msg
+        self._LogWriter().Write(str(msg))
+
+    # Algorithm specific state for SaveState, override together with SetState.
+    # A dict of plain values, see qc_utils.dump_state
+    def GetState(self):
+        return {}
+
+    def SetState(self, state):
+        pass
+
+    def SaveState(self, path):
+        """
+        Local only. Writes a snapshot of the clock, portfolio and GetState() to
+        path. Resuming from it with RestoreState needs no warm up
+        """
+        from qc_utils import dump_state
+        state = {
+            "version": self.STATE_VERSION,
+            "time": self.Time,
+            "portfolio": self.Portfolio.GetState(),
+            "algorithm": self.GetState(),
+        }
+        with open(path, "w") as f:
+            f.write(dump_state(state))
+
+    def RestoreState(self, path):
+        """
+        Local only. Restores a SaveState snapshot, call after Initialize
+        :return: time of the snapshot
+        """
+        from qc_utils import load_state
+        with open(path) as f:
+            state = load_state(f.read())
+        if state.get("version") != self.STATE_VERSION:
+            raise ValueError("Unsupported state snapshot version {}".format(state.get("version")))
+        self.Time = state["time"]
+        self.Portfolio.SetState(state["portfolio"])
+        self.SetState(state["algorithm"])
+        return self.Time
+
+    # local only. Blocks until every Debug and Log message has been written
+    def FlushLogs(self):
+        if self.log_writer is not None:
+            self.log_writer.Flush()
+
+    def SetLogStream(self, stream):
+        """
+        Local only. Sends later Log and Debug messages to stream, E.g sys.stderr
+        to keep stdout for results
+        """
+        self.CloseLogs()
+        self.log_stream = stream
+
+    def CloseLogs(self):
+        """
+        Local only. Writes the messages queued and stops the log writer thread.
+        A later message starts a new one
+        """
+        if self.log_writer is not None:
+            self.log_writer.Close()
+            self.log_writer = None
+
+    # value of an algorithm parameter, None if not set
+    def GetParameter(self, name):
+        return self.parameters.get(name)
+
+    # local only. Quant connect sets parameters from the project config
+    def SetParameters(self, parameters):
+        self.parameters = dict(parameters)
 
     def SetCash(self, cash):
-        self.cash = cash
+        self.Portfolio.SetCash(cash)
+        self.starting_cash = cash
 
     def SetStartDate(self, year, month, day):
-        self.start_date = datetime(year, month, day)
-        self.Time = datetime(year, month, day)
+        self.start_date = self.date_overrides[0] or datetime(year, month, day)
+        self.StartDate = self.start_date
+        self.Time = self.start_date
 
     def SetEndDate(self, year, month, day):
-        self.end_date = datetime(year, month, day)
+        self.end_date = self.date_overrides[1] or datetime(year, month, day)
+        self.EndDate = self.end_date
 
+    # local only. Dates that SetStartDate / SetEndDate use in place of the ones the
+    # algorithm passes, so a runner can pick the backtest period. None keeps the
+    # algorithm's own date
+    def OverrideDates(self, start=None, end=None):
+        self.date_overrides = (start, end)
+
+    # local only. schedule has next_time(time) returning the earliest time >= time
+    # OnData needs a slice, or None when it needs no more. The backtest feed skips
+    # the slices in between
+    def SetDataSchedule(self, schedule):
+        self.data_schedule = schedule
+
+    # num_periods counts trading days, the resolution DataHandlers run at
     def SetWarmUp(self, num_periods):
         if num_periods <= 0:
             self.IsWarmingUp = False
@@ -177,16 +888,161 @@ class QCAlgorithm:
             self.warm_up_length = num_periods
 
     def AddEquity(self, symbol, resolution):
-        equity = SecurityObject(symbol)
+        equity = SecurityObject(symbol, resolution)
         self.Securities.append(equity)
+        return equity
 
     def AddOption(self, symbol, resolution):
-        ret = OptionSecurityObject(symbol)
+        ret = OptionSecurityObject(symbol, resolution)
         self.Securities.append(ret)
         return ret
 
     def SetHoldings(self, symbol, fraction, liquidateExistingHoldings=False):
-        pass
+        if liquidateExistingHoldings:
+            for other in list(self.Portfolio.symbols):
+                if other != symbol:
+                    self.Liquidate(other)
+        quote = self.GetQuote(symbol)
+        if quote is None:
+            return
+        bid, ask, multiplier = quote
+        price = ask if fraction >= 0 else bid
+        if price <= 0:
+            return
+        target = int(fraction * self.Portfolio.TotalPortfolioValue / (price * multiplier))
+        delta = target - self.Portfolio[symbol].Quantity
+        if delta != 0:
+            self.MarketOrder(symbol, delta)
+
+    def Liquidate(self, symbol=None):
+        symbols = [symbol] if symbol is not None else list(self.Portfolio.symbols)
+        for s in symbols:
+            quantity = self.Portfolio[s].Quantity
+            if quantity != 0:
+                self.MarketOrder(s, -quantity)
+
+    def MarketOrder(self, symbol, quantity):
+        """
+        Fills immediately at the ask when buying and the bid when selling, from
+        the quotes in the slice being dispatched
+        :return: fill price, None if quantity is zero or symbol has no quote in the current slice
+        """
+        if quantity == 0:
+            # as QC, which rejects zero quantity orders
+            self.Debug("Unable to submit order with zero quantity for {}".format(symbol))
+            return None
+        quote = self.GetQuote(symbol)
+        if quote is None:
+            self.Debug("No quote for {} in current slice, order not filled".format(symbol))
+            return None
+        bid, ask, _ = quote
+        price = ask if quantity > 0 else bid
+        self.Portfolio.Fill(symbol, quantity, price)
+        return price
+
+    def _ChainQuotes(self, chain):
+        # chains are often reused across slices, convert each chain object once
+        # and remember the contracts already looked up in it
+        cached = self.columnar_quotes.get(chain.Key)
+        if cached is None or cached[0] is not chain.Value:
+            cached = (chain.Value, ColumnarOptionChain.FromContracts(chain.Value), {})
+            self.columnar_quotes[chain.Key] = cached
+        return cached[1], cached[2]
+
+    def GetQuote(self, symbol):
+        """
+        Local only. Quote for symbol in the current slice
+        :return: (bid, ask, multiplier), None when not quoted
+        """
+        slice = self.CurrentSlice
+        if slice is None:
+            return None
+        if symbol in slice.Bars:
+            price = float(slice.Bars[symbol].Close)
+            return price, price, 1.0
+        contract = self.Portfolio.Contract(symbol)
+        if contract is None:
+            return None
+        underlying, right, expiry, strike = contract
+        for chain in slice.OptionChains:
+            if chain.Key != underlying:
+                continue
+            columnar, found = self._ChainQuotes(chain)
+            i = found.get(symbol)
+            if i is None:
+                i = found[symbol] = columnar.Find(right, expiry, strike)
+            if i >= 0:
+                return float(columnar.BidPrice[i]), float(columnar.AskPrice[i]), PortfolioClass.OPTION_MULTIPLIER
+        return None
+
+    def MarkPortfolio(self, slice):
+        """
+        Local only. Marks the held symbols quoted in slice at their close or mid
+        and settles options that have expired
+        """
+        portfolio = self.Portfolio
+        for symbol, bar in slice.Bars.items():
+            close = float(bar.Close)
+            portfolio.underlying_prices[symbol] = close
+            portfolio.Mark(symbol, close)
+        if not portfolio.open_rows:
+            return
+        portfolio.SettleExpired(slice.Time)
+        for row in list(portfolio.open_rows):
+            if portfolio.contracts[row] is None:
+                continue
+            quote = self.GetQuote(portfolio.symbols[row])
+            if quote is not None:
+                portfolio.Mark(portfolio.symbols[row], 0.5 * (quote[0] + quote[1]))
+
+    def EnableProfiling(self, stages=None, sample_every=1, output=None):
+        """
+        Local only. Times the named methods of this algorithm, on every call or on
+        every sample_every calls, and reports them after OnEndOfAlgorithm, as a
+        table through Log or as JSON written to output. Methods are only wrapped
+        once this is called, so a run without profiling pays nothing for it.
+        Debug and Log are timed from the call, formatting their message happens
+        in the caller's stage
+        :param stages: method names, profiling.DEFAULT_STAGES when None
+        :return: profiling.Profiler
+        """
+        from profiling import Profiler, DEFAULT_STAGES
+        self.profiler = Profiler(DEFAULT_STAGES if stages is None else stages, sample_every)
+        self.profile_output = output
+        self.WrapProfiledStages()
+        return self.profiler
+
+    def WrapProfiledStages(self):
+        """
+        Local only. Wraps the profiled methods that exist and are not wrapped yet.
+        The backtest engine calls it again after Initialize to pick up handlers
+        created there (E.g OnDataHandler)
+        """
+        profiler = self.profiler
+        if profiler is None:
+            return
+        for name in profiler.stage_names:
+            fn = getattr(self, name, None)
+            if fn is None or name in self.profiled_stages:
+                continue
+            setattr(self, name, profiler.Wrap(name, fn))
+            self.profiled_stages.add(name)
+        if "OnEndOfAlgorithm" not in self.profiled_stages:
+            on_end = self.OnEndOfAlgorithm
+
+            def OnEndOfAlgorithm():
+                on_end()
+                self.ReportProfile()
+            self.OnEndOfAlgorithm = OnEndOfAlgorithm
+            self.profiled_stages.add("OnEndOfAlgorithm")
+
+    def ReportProfile(self):
+        if self.profiler is None:
+            return
+        if self.profile_output:
+            self.profiler.Dump(self.profile_output)
+        else:
+            self.Log("Profile (inclusive times)\n" + self.profiler.Table())
 
 
     # Set up Requested Data, Cash, Time Period.
@@ -205,27 +1061,9 @@ class QCAlgorithm:
     def OnEndOfAlgorithm(self):
             pass
 
-    # ISimple test whether Intialize and OnData works. May not reach all code blocks in both
-    # functions if there is branching based on Instance/Class parameters 
+    # Runs Initialize, the warm up and OnData over the algorithm's date range on
+    # synthetic data through the local event driven backtest engine
     def TestRun(self):
-            self.Initialize()
-            slice = Slice()
-            # fill the slice object
-            for security in self.Securities:
-                if isinstance(security, OptionSecurityObject):
-                    option_chain = OptionChain(security.symbol)
-                    slice.OptionChains.append(option_chain)
-                elif isinstance(security, SecurityObject):
-                    slice.Bars[security.symbol] = Bar(security.symbol)
-            for i in xrange(self.warm_up_length):
-                self.OnData(slice)
-            self.IsWarmingUp = False
-            # post warm up
-            curr_date = self.start_date
-            while curr_date < self.end_date:
-                self.Time = curr_date
-                slice.Time = self.Time
-                self.OnData(slice)
-                curr_date += timedelta(days=1)
-            return
-
+            # imported here as backtest_engine depends on this module
+            from backtest_engine import BacktestEngine
+            return BacktestEngine(self).Run()
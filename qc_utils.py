@@ -1,65 +1,152 @@
-from queue import Queue
-import numpy as np
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from math import sqrt
+import time
+
+from lazy_import import lazy_import
+
+np = lazy_import("numpy", globals(), "np")
 
 
 
 class SlidingWindow(object):
+    """
+    Fixed capacity sliding window backed by a preallocated ring buffer.
+    Every value is written twice (at i and i + length) so the window contents
+    are always a contiguous slice of the buffer, which lets view() hand out the
+    ordered window without copying. The mean and sum of squared deviations are
+    maintained incrementally (Welford, with West's update for replacements) so
+    update, get_sma and get_std are O(1). Rounding errors of the incremental
+    updates build up over a long stream, so the sum, mean and squared
+    deviations are recomputed from the buffer once per length updates, which
+    keeps update amortised O(1).
+    """
 
     def __init__(self, length, init_list=[]):
-        self.q = Queue(length)
-        self.total = None
-        if init_list and len(init_list) <= length:
-            for x in init_list:
-                self.q.put(x)
-                self.total = self.total + x if self.total is not None else x
-        elif len(init_list) > length:
+        if len(init_list) > length:
             raise ValueError("init_list to sliding window too large")
-
         self.length = length
-    
+        self.buf = np.zeros(2 * length, dtype=np.float64)
+        self.head = 0 # index of the oldest element
+        self.count = 0
+        self.total = None
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared deviations from the mean
+        self.since_exact = 0 # updates since the moments were recomputed
+        for x in init_list:
+            self.update(x)
 
     def isFull(self):
-        return self.q.full()
+        return self.count == self.length
 
     def _update_sma(self, data, evicted):
         if self.total is None:
             self.total = data
+        elif evicted is None:
+            self.total = self.total + data
         else:
             self.total = self.total - evicted + data
 
+    def _update_moments(self, data, evicted):
+        if evicted is None:
+            # window grew by one element
+            delta = data - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (data - self.mean)
+        else:
+            # window size unchanged, evicted replaced by data
+            old_mean = self.mean
+            self.mean += (data - evicted) / self.length
+            self.m2 += (data - evicted) * (data - self.mean + evicted - old_mean)
+            if self.m2 < 0.0:
+                # rounding can push a zero variance slightly negative
+                self.m2 = 0.0
+
     def update(self, data):
-        if not self.q.full():
-            self.q.put(data)
+        """
+        Push data into the window
+        :param data: float
+        :return: the evicted element or None if the window was not full
+        """
+        if self.count < self.length:
+            pos = self.head + self.count
             evicted = None
+            self.count += 1
         else:
-            evicted = self.q.get()
-            self.q.put(data)
-        if evicted is not None:
-            self._update_sma(data, evicted)
+            pos = self.head
+            evicted = float(self.buf[pos])
+            self.head = pos + 1 if pos + 1 < self.length else 0
+        self.buf[pos] = data
+        self.buf[pos + self.length] = data
+        self._update_sma(data, evicted)
+        self._update_moments(float(data), evicted)
+        self.since_exact += 1
+        if self.since_exact >= self.length:
+            self._recompute()
         return evicted
 
+    def _recompute(self):
+        # two pass sum, mean and squared deviations of the window, discarding drift
+        v = self.buf[self.head:self.head + self.count]
+        self.total = float(v.sum())
+        self.mean = self.total / self.count
+        deviations = v - self.mean
+        self.m2 = float(np.dot(deviations, deviations))
+        self.since_exact = 0
+
+    # read only view of the elements in the window, oldest first. Not a copy,
+    # so it reflects later updates and must not be held across them
+    def view(self):
+        v = self.buf[self.head:self.head + self.count]
+        v.flags.writeable = False
+        return v
 
     # returns a list of all elements currently in the sliding window
     def to_list(self):
-        new_q = Queue(self.length)
-        ret = []
-        while not self.q.empty():
-            x = self.q.get()
-            new_q.put(x)
-            ret.append(x)
+        return self.view().tolist()
 
-        self.q = new_q
-        return ret
-
-    # get simple moving average 
+    # get simple moving average
     def get_sma(self):
         return None if not self.isFull() else self.total / self.length
 
-    # get variance
+    # get population standard deviation of the elements in the window
     def get_std(self):
-        elems = self.to_list()
-        return np.std(elems)
-        
+        if self.count == 0:
+            return float('nan')
+        return sqrt(self.m2 / self.count)
+
+    def get_state(self):
+        """
+        :return: dict of plain values, the window contents and running moments
+        """
+        return {
+            "length": self.length,
+            "values": self.to_list(),
+            "total": None if self.total is None else float(self.total),
+            "mean": self.mean,
+            "m2": self.m2,
+            "since_exact": self.since_exact,
+        }
+
+    def set_state(self, state):
+        """
+        Restores a get_state snapshot. The moments are restored as saved rather
+        than recomputed, so statistics continue exactly as in the saved run
+        """
+        values = state["values"]
+        if state["length"] != self.length:
+            raise ValueError("Snapshot of a window of length {}, expected {}".format(
+                state["length"], self.length))
+        self.buf[:] = 0.0
+        self.buf[:len(values)] = values
+        self.buf[self.length:self.length + len(values)] = values
+        self.head = 0
+        self.count = len(values)
+        self.total = state["total"]
+        self.mean = state["mean"]
+        self.m2 = state["m2"]
+        self.since_exact = state.get("since_exact", 0)
+
 
 
 
@@ -69,16 +156,7 @@ class SMA(SlidingWindow):
     def __init__(self, lookback):
             super(SMA, self).__init__(lookback)
             self.lookback = lookback
-            self.total = None
 
-    # called at each iteration. Enters new data.
-    def update(self, data):
-            evicted = super(SMA, self).update(data)
-            if evicted is None:
-                self.total = data if self.total is None else self.total + data
-            else: # an item was evicted 
-                self.total = self.total - evicted + data
-        
     def get_sma(self):
             if not self.isFull():
                 return None
@@ -87,10 +165,408 @@ class SMA(SlidingWindow):
                 return self.total / self.lookback
 
 
+class RollingStatsBank(object):
+    """
+    Rolling statistics for many symbols at once. Holds an N symbols x lookback
+    matrix used as a column ring buffer, one column per bar. update() takes one
+    mid per symbol and recomputes SMA, std, min, max and z-score for every
+    symbol in a single vectorized step. Stats for a single symbol can be queried
+    by name, so algorithms can use the bank in place of per symbol windows.
+    Like SlidingWindow the running moments are recomputed from the window once
+    per lookback bars, so rounding errors do not build up.
+    """
+
+    class Stats(object):
+
+        def __init__(self, sma, std, min, max, zscore):
+            self.sma = sma
+            self.std = std
+            self.min = min
+            self.max = max
+            self.zscore = zscore
+
+    def __init__(self, symbols, lookback):
+        """
+        :param symbols: list of ticker symbols, fixes the row order of the bank
+        :param lookback: number of bars in each window
+        """
+        self.symbols = list(symbols)
+        self.index = dict((s, i) for i, s in enumerate(self.symbols))
+        if len(self.index) != len(self.symbols):
+            raise ValueError("Duplicate symbols in RollingStatsBank")
+        self.lookback = lookback
+        n = len(self.symbols)
+        self.window = np.zeros((n, lookback), dtype=np.float64)
+        self.head = 0 # column the next bar is written to
+        self.count = 0
+        self.mean = np.zeros(n, dtype=np.float64)
+        self.m2 = np.zeros(n, dtype=np.float64)
+        self.last = np.zeros(n, dtype=np.float64)
+        self.since_exact = 0 # bars since the moments were recomputed
+        self.stats = None
+
+    def isFull(self):
+        return self.count == self.lookback
+
+    def _to_vector(self, mids):
+        if isinstance(mids, dict):
+            vec = np.empty(len(self.symbols), dtype=np.float64)
+            for symbol, i in self.index.items():
+                vec[i] = mids[symbol]
+            return vec
+        vec = np.asarray(mids, dtype=np.float64)
+        if vec.shape != self.mean.shape:
+            raise ValueError("Expected {} mids, got shape {}".format(len(self.symbols), vec.shape))
+        return vec
+
+    def update(self, mids):
+        """
+        Push one bar for every symbol
+        :param mids: sequence of floats in symbol order, or a dict of symbol to float
+        :return: Stats object of arrays aligned with self.symbols
+        """
+        x = self._to_vector(mids)
+        col = self.head
+        if self.count < self.lookback:
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (x - self.mean)
+        else:
+            evicted = self.window[:, col]
+            old_mean = self.mean.copy()
+            self.mean += (x - evicted) / self.lookback
+            self.m2 += (x - evicted) * (x - self.mean + evicted - old_mean)
+            np.maximum(self.m2, 0.0, out=self.m2)
+        self.window[:, col] = x
+        self.head = col + 1 if col + 1 < self.lookback else 0
+        self.last = x
+        self.since_exact += 1
+        if self.since_exact >= self.lookback:
+            self._recompute()
+        return self._compute_stats(x)
+
+    def _recompute(self):
+        # two pass mean and squared deviations of every row, discarding drift
+        filled = self.window if self.isFull() else self.window[:, :self.count]
+        self.mean = filled.mean(axis=1)
+        deviations = filled - self.mean[:, None]
+        self.m2 = np.einsum('ij,ij->i', deviations, deviations)
+        self.since_exact = 0
+
+    def _compute_stats(self, x):
+        # columns fill from 0 so until full the filled part is a prefix
+        filled = self.window if self.isFull() else self.window[:, :self.count]
+        std = np.sqrt(self.m2 / self.count)
+        safe_std = np.where(std > 0.0, std, 1.0)
+        zscore = np.where(std > 0.0, (x - self.mean) / safe_std, 0.0)
+        sma = self.mean.copy() if self.isFull() else np.full(len(self.symbols), np.nan)
+        self.stats = self.Stats(sma, std, filled.min(axis=1), filled.max(axis=1), zscore)
+        return self.stats
+
+    def _get(self, symbol, field):
+        if self.stats is None:
+            return None
+        return float(getattr(self.stats, field)[self.index[symbol]])
+
+    # the methods below mirror SlidingWindow/SMA for a single symbol
+
+    def get_sma(self, symbol):
+        return None if not self.isFull() else self._get(symbol, 'sma')
+
+    def get_std(self, symbol):
+        return self._get(symbol, 'std')
+
+    def get_min(self, symbol):
+        return self._get(symbol, 'min')
+
+    def get_max(self, symbol):
+        return self._get(symbol, 'max')
+
+    def get_zscore(self, symbol):
+        return self._get(symbol, 'zscore')
+
+    # ordered copy of the window for symbol, oldest first
+    def to_list(self, symbol):
+        row = self.window[self.index[symbol]]
+        if not self.isFull():
+            return row[:self.count].tolist()
+        return np.concatenate((row[self.head:], row[:self.head])).tolist()
+
+    def get_state(self):
+        """
+        :return: dict of plain values, the window matrix and running moments
+        """
+        return {
+            "symbols": self.symbols,
+            "lookback": self.lookback,
+            "window": self.window.tolist(),
+            "head": self.head,
+            "count": self.count,
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "last": self.last.tolist(),
+            "since_exact": self.since_exact,
+        }
+
+    def set_state(self, state):
+        if state["symbols"] != self.symbols or state["lookback"] != self.lookback:
+            raise ValueError("Snapshot of a bank of {} x {}, expected {} x {}".format(
+                state["symbols"], state["lookback"], self.symbols, self.lookback))
+        self.window = np.array(state["window"], dtype=np.float64).reshape(len(self.symbols), self.lookback)
+        self.head = state["head"]
+        self.count = state["count"]
+        self.mean = np.array(state["mean"], dtype=np.float64)
+        self.m2 = np.array(state["m2"], dtype=np.float64)
+        self.last = np.array(state["last"], dtype=np.float64)
+        self.since_exact = state.get("since_exact", 0)
+        self.stats = self._compute_stats(self.last) if self.count else None
+
+
+
+
+
+
+
+
+class TradingCalendar(object):
+    """
+    Regular trading sessions between two dates. The open and close of every
+    session are precomputed into sorted lists, so finding the session a time
+    falls in is a bisect rather than date arithmetic on every bar.
+    """
+
+    def __init__(self, start, end, holidays=(), session_open=timedelta(hours=9, minutes=30),
+                 session_close=timedelta(hours=16)):
+        """
+        :param start: datetime, first day considered
+        :param end: datetime, last day considered
+        :param holidays: dates on which the market is closed
+        :param session_open: offset of the open from midnight
+        :param session_close: offset of the close from midnight
+        """
+        closed = set(datetime(h.year, h.month, h.day) for h in holidays)
+        self.sessions = [] # midnight of every trading day
+        day = datetime(start.year, start.month, start.day)
+        while day <= end:
+            if day.weekday() < 5 and day not in closed:
+                self.sessions.append(day)
+            day += timedelta(days=1)
+        self.opens = [day + session_open for day in self.sessions]
+        self.closes = [day + session_close for day in self.sessions]
+
+    @classmethod
+    def covering(cls, start, end, sessions_before=0, holidays=(), **kwargs):
+        """
+        Calendar from sessions_before trading days before start to end. E.g
+        to include an algorithm's warm up period
+        """
+        closed = set(datetime(h.year, h.month, h.day) for h in holidays)
+        first = datetime(start.year, start.month, start.day)
+        remaining = sessions_before
+        while remaining > 0:
+            first -= timedelta(days=1)
+            if first.weekday() < 5 and first not in closed:
+                remaining -= 1
+        return cls(first, end, holidays, **kwargs)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def next_session(self, time):
+        """
+        :return: index of the session in progress at time or the next one to open,
+                 len(self) if time is after the last close
+        """
+        return bisect_left(self.closes, time)
+
+    def is_session(self, date):
+        i = bisect_left(self.sessions, datetime(date.year, date.month, date.day))
+        return i < len(self.sessions) and self.sessions[i].date() == date.date()
+
+
+class SessionExecutor(object):
+    """
+    Wraps a data handler so it runs exactly once per trading session, on the
+    first slice at or after the session open plus offset. Sessions with no
+    slice between that time and the close are skipped. Calls outside of the
+    scheduled time are a comparison and return, and next_time() tells a data
+    feed when the handler will next want a slice so the rest can be skipped.
+    """
+
+    def __init__(self, qc_instance, handler, calendar, offset=timedelta(0)):
+        """
+        :param qc_instance: QCAlgorithm, its Time is the time of the slice
+        :param handler: fn(slice)
+        :param calendar: TradingCalendar covering every slice the handler should see
+        :param offset: timedelta after the session open to run at
+        """
+        self.qc = qc_instance
+        self.handler = handler
+        self.calendar = calendar
+        self.fire_times = [t + offset for t in calendar.opens]
+        self.session = 0 # index of the next session to run in
+
+    def __call__(self, slice):
+        time = self.qc.Time
+        i = self.session
+        if i >= len(self.fire_times) or time < self.fire_times[i]:
+            return
+        if time > self.calendar.closes[i]:
+            # sessions went by without a slice
+            i = self.session = self.calendar.next_session(time)
+            if i >= len(self.fire_times) or time < self.fire_times[i]:
+                return
+        self.session = i + 1
+        self.handler(slice)
+
+    def get_state(self):
+        """
+        :return: dict with the open plus offset of the next session to run in
+        """
+        i = self.session
+        return {"next_run": self.fire_times[i] if i < len(self.fire_times) else None}
+
+    def set_state(self, state):
+        next_run = state["next_run"]
+        self.session = len(self.fire_times) if next_run is None else bisect_left(self.fire_times, next_run)
+
+    def next_time(self, time):
+        """
+        :return: earliest time >= time the handler can run, None if it never will again
+        """
+        i = max(self.session, self.calendar.next_session(time))
+        if i >= len(self.fire_times):
+            return None
+        return max(time, self.fire_times[i])
+
+
+class LogLevel:
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    NONE = 100 # disables every message
+
+    @classmethod
+    def from_name(cls, name):
+        """
+        :param name: E.g "debug" or "WARNING"
+        """
+        return getattr(cls, name.upper())
+
+
+class AlgorithmLogger(object):
+    """
+    Leveled logging for algorithms. Arguments are %-style and only formatted
+    when a message is emitted, so a disabled level costs a call and a single
+    comparison, whatever is passed. Emitted messages go to emit (E.g the
+    algorithm's Debug). An optional token bucket caps the message rate so a
+    chatty strategy does not run into Quant connect's log limits. Messages
+    over the cap are dropped and counted, the next message emitted says how
+    many were dropped.
+    """
+
+    def __init__(self, emit, level=LogLevel.INFO, rate_limit=None, clock=time.time):
+        """
+        :param emit: fn(str)
+        :param level: LogLevel, messages below it are dropped
+        :param rate_limit: (messages, seconds), at most messages per seconds with
+                           bursts of up to messages. None to emit everything
+        :param clock: fn() returning seconds as a float or a datetime. E.g the
+                      algorithm's Time to limit per backtest day rather than wall time
+        """
+        self.emit = emit
+        self.level = level
+        self.clock = clock
+        self.rate_limit = rate_limit
+        if rate_limit is not None:
+            self.tokens = float(rate_limit[0])
+            self.refill_rate = rate_limit[0] / float(rate_limit[1]) # tokens per second
+            self.last_refill = None
+        self.suppressed = 0 # dropped by the rate limit since the last emitted message
+        self.total_suppressed = 0
+
+    def set_level(self, level):
+        self.level = level
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def _take_token(self):
+        now = self.clock()
+        if self.last_refill is not None:
+            elapsed = now - self.last_refill
+            if not isinstance(elapsed, float):
+                elapsed = elapsed.total_seconds()
+            self.tokens = min(float(self.rate_limit[0]), self.tokens + elapsed * self.refill_rate)
+        self.last_refill = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+        if self.rate_limit is not None and not self._take_token():
+            self.suppressed += 1
+            self.total_suppressed += 1
+            return
+        if args:
+            msg = msg % args
+        if self.suppressed:
+            msg = "({} messages suppressed) {}".format(self.suppressed, msg)
+            self.suppressed = 0
+        self.emit(msg)
+
+    # the level check is repeated so disabled levels return before the call to log
+
+    def debug(self, msg, *args):
+        if LogLevel.DEBUG >= self.level:
+            self.log(LogLevel.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        if LogLevel.INFO >= self.level:
+            self.log(LogLevel.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        if LogLevel.WARNING >= self.level:
+            self.log(LogLevel.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        if LogLevel.ERROR >= self.level:
+            self.log(LogLevel.ERROR, msg, *args)
+
+
+# State snapshots (get_state / GetState) are dicts of plain values and datetimes.
+# They are stored as JSON with datetimes tagged, E.g in a file or Quant connect's
+# ObjectStore
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def _encode_datetime(obj):
+    if isinstance(obj, datetime):
+        return {"__datetime__": obj.strftime(DATETIME_FORMAT)}
+    raise TypeError("{!r} is not serializable in a state snapshot".format(obj))
+
 
+def _decode_datetime(obj):
+    if "__datetime__" in obj:
+        return datetime.strptime(obj["__datetime__"], DATETIME_FORMAT)
+    return obj
 
 
+def dump_state(state):
+    """
+    :param state: dict of lists, dicts, strings, numbers, None and datetimes
+    :return: compact JSON string
+    """
+    import json
+    return json.dumps(state, separators=(',', ':'), default=_encode_datetime)
 
 
-sw = SlidingWindow(5, init_list=[1,1,1,1,1])
-print sw.get_sma(), sw.get_std()
\ No newline at end of file
+def load_state(text):
+    import json
+    return json.loads(text, object_hook=_decode_datetime)
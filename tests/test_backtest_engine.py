@@ -0,0 +1,137 @@
+"""
+BacktestEngine runs over synthetic data and over the same data written to a
+BarStore, read through and skipping to a data schedule.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backtest_engine import BacktestEngine
+from bar_store import BarStore, store_sources, write_events
+from data_sources import synthetic_sources
+from qc_interface import ColumnarOptionChain, QCAlgorithm, Resolution
+from qc_utils import SessionExecutor, TradingCalendar
+
+
+class RecordingAlgorithm(QCAlgorithm):
+    """
+    Records what every OnData and OnEndOfDay call saw
+    """
+
+    def __init__(self, offset=None):
+        """
+        :param offset: timedelta after the open to handle one slice per session at, every slice when None
+        """
+        QCAlgorithm.__init__(self)
+        self.offset = offset
+        self.slices = []
+        self.end_of_day = []
+
+    def Initialize(self):
+        self.SetStartDate(2015, 10, 5)
+        self.SetEndDate(2015, 10, 10)
+        self.SetCash(100000)
+        self.SetWarmUp(1)
+        self.AddEquity("SPY", Resolution.Hourly)
+        option = self.AddOption("SPY", Resolution.Hourly)
+        option.SetFilter(-3, 3, timedelta(0), timedelta(10))
+        if self.offset is not None:
+            calendar = TradingCalendar.covering(self.StartDate, self.EndDate, 1)
+            self.executor = SessionExecutor(self, self.Record, calendar, self.offset)
+            self.SetDataSchedule(self.executor)
+
+    def OnData(self, slice):
+        if self.offset is None:
+            self.Record(slice)
+        else:
+            self.executor(slice)
+
+    def Record(self, slice):
+        chains = []
+        for chain in slice.OptionChains:
+            value = chain.Value
+            if not isinstance(value, ColumnarOptionChain):
+                value = ColumnarOptionChain.FromContracts(value)
+            chains.append((chain.Key, value.Strike.tolist(), value.BidPrice.tolist(), value.AskPrice.tolist()))
+        bars = sorted((symbol, bar.Close) for symbol, bar in slice.Bars.items())
+        self.slices.append((self.Time, self.IsWarmingUp, bars, chains))
+
+    def OnEndOfDay(self, symbol):
+        self.end_of_day.append((self.Time, symbol))
+
+
+class BacktestEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.devnull = open(os.devnull, "w")
+        # the synthetic data of a run, written to a store
+        algorithm = RecordingAlgorithm()
+        algorithm.Initialize()
+        start = BacktestEngine(algorithm).WarmUpStart()
+        self.store = BarStore(self.root)
+        write_events(self.store, synthetic_sources(algorithm, start, algorithm.end_date), start, algorithm.end_date)
+
+    def tearDown(self):
+        self.devnull.close()
+        shutil.rmtree(self.root)
+
+    def run_algorithm(self, sources=None, offset=None):
+        algorithm = RecordingAlgorithm(offset)
+        algorithm.SetLogStream(self.devnull)
+        stats = BacktestEngine(algorithm, sources).Run()
+        return algorithm, stats
+
+    def test_synthetic_run(self):
+        algorithm, stats = self.run_algorithm()
+        times = [record[0] for record in algorithm.slices]
+        # the warm up Friday and five sessions of hourly bars, every slice with a bar and a chain
+        self.assertEqual(len(times), 6 * 6)
+        self.assertEqual(times[0], datetime(2015, 10, 2, 10, 30))
+        self.assertEqual(times[-1], datetime(2015, 10, 9, 15, 30))
+        self.assertEqual(times, sorted(set(times)))
+        self.assertEqual(stats.slices, len(times))
+        self.assertEqual(stats.warm_up_slices, 6)
+        self.assertEqual(stats.events, 2 * len(times))
+        self.assertTrue(all(len(bars) == 1 and len(chains) == 1 for _, _, bars, chains in algorithm.slices))
+        self.assertEqual([warming for _, warming, _, _ in algorithm.slices], [True] * 6 + [False] * 30)
+        # called at the last slice of every session after the warm up
+        self.assertEqual(algorithm.end_of_day, [(datetime(2015, 10, d, 15, 30), "SPY") for d in (5, 6, 7, 8, 9)])
+
+    def test_store_replays_the_synthetic_run(self):
+        synthetic, synthetic_stats = self.run_algorithm()
+        stored, stored_stats = self.run_algorithm(store_sources(self.store))
+        self.assertEqual(stored.slices, synthetic.slices)
+        self.assertEqual(stored.end_of_day, synthetic.end_of_day)
+        self.assertEqual(stored_stats.events, synthetic_stats.events)
+        self.assertEqual(stored_stats.warm_up_slices, synthetic_stats.warm_up_slices)
+
+    def test_schedule_seeks_mid_day_and_across_days(self):
+        full = self.run_algorithm()[0].slices
+        # 11:45 falls between the 11:30 and 12:30 bars
+        offset = timedelta(hours=2, minutes=15)
+        expected = []
+        for day in sorted(set(record[0].date() for record in full)):
+            fire = datetime(day.year, day.month, day.day, 9, 30) + offset
+            expected.append(next(record for record in full if record[0] >= fire))
+        self.assertEqual(expected[0][0], datetime(2015, 10, 2, 12, 30))
+        for sources in (None, store_sources(self.store)):
+            algorithm, stats = self.run_algorithm(sources, offset)
+            self.assertEqual([record[0] for record in algorithm.slices], [record[0] for record in expected])
+            # and the data of each, a chain is the same however much of its day was skipped
+            for record, expected_record in zip(algorithm.slices, expected):
+                self.assertTrue(record == expected_record, record[0])
+            self.assertEqual(stats.slices, len(expected))
+            # only the events of the dispatched slices are consumed
+            self.assertEqual(stats.events, 2 * len(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
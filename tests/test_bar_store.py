@@ -0,0 +1,126 @@
+"""
+Synthetic events written to a BarStore and replayed through its sources,
+read through and with seeks.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backtest_engine import _seek
+from bar_store import BarStore, StoredBarSource, StoredOptionChainSource, write_events
+from data_sources import (EventKind, RepeatedChainSource, SyntheticBarSource, SyntheticOptionChainSource,
+                          SyntheticPricePath)
+from qc_interface import ColumnarOptionChain, Resolution
+
+# Friday to Tuesday, hourly bars end at 10:30 to 15:30
+START = datetime(2015, 10, 2)
+END = datetime(2015, 10, 7)
+FILTER = (-3, 3, timedelta(0), timedelta(10))
+# the next bar of the day, then the second bar after a weekend
+SEEKS = [datetime(2015, 10, 2, 12, 45), datetime(2015, 10, 5, 11, 0)]
+
+
+def summary(event):
+    """
+    :return: event with its data reduced to comparable values
+    """
+    t, kind, symbol, data = event
+    if kind == EventKind.BAR:
+        return t, kind, symbol, (data.Open, data.High, data.Low, data.Close)
+    chain = data.Value
+    if not isinstance(chain, ColumnarOptionChain):
+        chain = ColumnarOptionChain.FromContracts(chain)
+    return t, kind, symbol, (chain.Right.tolist(), chain.Strike.tolist(), chain.Expiry.tolist(),
+                             chain.BidPrice.tolist(), chain.AskPrice.tolist(), chain.UnderlyingLastPrice)
+
+
+def read(source, start=START, end=END):
+    return [summary(event) for event in source.Events(start, end)]
+
+
+def read_seeking(source, seeks, start=START, end=END):
+    """
+    :return: first event, the event each of seeks lands on, then the rest read through
+    """
+    events = source.Events(start, end)
+    result = [summary(next(events))]
+    for time in seeks:
+        result.append(summary(_seek(events, time)))
+    return result + [summary(event) for event in events]
+
+
+def seeked(events, seeks):
+    """
+    :return: what read_seeking should give from the full list of events
+    """
+    expected = [events[0]]
+    for time in seeks:
+        expected.append(next(event for event in events if event[0] >= time))
+    return expected + events[events.index(expected[-1]) + 1:]
+
+
+class BarStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BarStore(self.root)
+        path = SyntheticPricePath(START, END, Resolution.Hourly, seed=3)
+        self.bars = SyntheticBarSource("SPY", path, Resolution.Hourly)
+        self.chains = SyntheticOptionChainSource("SPY", path, Resolution.Hourly, FILTER)
+        self.written = write_events(self.store, [self.bars, self.chains], START, END)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_days_written(self):
+        days = [datetime(2015, 10, d) for d in (2, 5, 6)]
+        self.assertEqual(self.store.Dates("SPY", BarStore.BARS), days)
+        self.assertEqual(self.store.Dates("SPY", BarStore.QUOTES), days)
+        quotes = sum(len(self.store.ReadQuotes("SPY", day)) for day in days)
+        self.assertEqual(self.written, 6 * len(days) + quotes)
+
+    def test_bars_replay(self):
+        expected = read(self.bars)
+        self.assertEqual(len(expected), 18)
+        self.assertEqual(read(StoredBarSource(self.store, "SPY")), expected)
+
+    def test_chains_replay(self):
+        expected = read(self.chains)
+        # one snapshot is stored per day, repeated at every bar time on replay
+        snapshots = read(StoredOptionChainSource(self.store, "SPY"))
+        self.assertEqual(snapshots, expected[::6])
+        repeated = RepeatedChainSource(StoredOptionChainSource(self.store, "SPY"), Resolution.Hourly)
+        self.assertEqual(read(repeated), expected)
+
+    def test_start_and_end_within_a_day(self):
+        start, end = datetime(2015, 10, 2, 12, 0), datetime(2015, 10, 5, 12, 30)
+        expected = read(self.bars, start, end)
+        self.assertEqual([event[0] for event in expected[:2]], [datetime(2015, 10, 2, 12, 30),
+                                                                datetime(2015, 10, 2, 13, 30)])
+        self.assertEqual(expected[-1][0], datetime(2015, 10, 5, 11, 30))
+        self.assertEqual(read(StoredBarSource(self.store, "SPY"), start, end), expected)
+
+    def test_seeks(self):
+        bars = read(self.bars)
+        chains = read(self.chains)
+        self.assertEqual([event[0] for event in read_seeking(self.bars, SEEKS)[1:3]],
+                         [datetime(2015, 10, 2, 13, 30), datetime(2015, 10, 5, 11, 30)])
+        self.assertEqual(read_seeking(StoredBarSource(self.store, "SPY"), SEEKS), seeked(bars, SEEKS))
+        repeated = RepeatedChainSource(StoredOptionChainSource(self.store, "SPY"), Resolution.Hourly)
+        self.assertEqual(read_seeking(repeated, SEEKS), seeked(chains, SEEKS))
+        snapshots = read(StoredOptionChainSource(self.store, "SPY"))
+        # snapshots are taken at the first bar of each day, a later time seeks to the next day's
+        self.assertEqual(read_seeking(StoredOptionChainSource(self.store, "SPY"), SEEKS[:1]), snapshots)
+        self.assertEqual(read_seeking(StoredOptionChainSource(self.store, "SPY"), SEEKS[1:]),
+                         [snapshots[0], snapshots[2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+A run saved part way and resumed from its snapshot ends where the
+uninterrupted run does.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backtest_engine import BacktestEngine
+from basic_template_algorithm import BasicTemplateAlgorithm
+from iron_condor import IronCondorAlgorithm
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.devnull = open(os.devnull, "w")
+
+    def tearDown(self):
+        self.devnull.close()
+        shutil.rmtree(self.root)
+
+    def run_algorithm(self, cls, **kwargs):
+        algorithm = cls()
+        algorithm.SetLogStream(self.devnull)
+        BacktestEngine(algorithm, **kwargs).Run()
+        return algorithm
+
+    def assertResumes(self, cls, snapshot_time):
+        path = os.path.join(self.root, "state.json")
+        full = self.run_algorithm(cls)
+        first = self.run_algorithm(cls, end=snapshot_time, save_to=path)
+        self.assertLess(first.Time, full.Time)
+        resumed = self.run_algorithm(cls, restore_from=path)
+        self.assertEqual(resumed.Time, full.Time)
+        self.assertAlmostEqual(resumed.Portfolio.TotalPortfolioValue, full.Portfolio.TotalPortfolioValue, places=6)
+        self.assertAlmostEqual(resumed.Portfolio.TotalProfit, full.Portfolio.TotalProfit, places=6)
+
+    def test_basic_template(self):
+        # the 200 day window of the rolling stats is restored, not warmed up again
+        self.assertResumes(BasicTemplateAlgorithm, datetime(2013, 1, 1))
+
+    def test_iron_condor(self):
+        self.assertResumes(IronCondorAlgorithm, datetime(2015, 11, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Iron condor enumeration against a brute force search of a small chain, and
+ranking by each objective.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import itertools
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from condor_search import OBJECTIVES, enumerate_condors, rank_condors
+from option_pricing import black_scholes_price, years_to_expiry
+from payoff import Legs, risk_summary
+from qc_interface import ColumnarOptionChain, OptionRight, PortfolioClass
+
+TIME = datetime(2015, 10, 5, 10, 0)
+EXPIRIES = [datetime(2015, 10, 16), datetime(2015, 10, 23)]
+STRIKES = np.arange(1940.0, 2061.0, 10.0)
+SPOT = 2003.0
+MAX_WIDTH = 20.0
+
+
+def quoted_chain():
+    rows = [(right, expiry, strike) for right in (OptionRight.PUT, OptionRight.CALL)
+            for expiry in EXPIRIES for strike in STRIKES]
+    right, expiry, strike = [np.array(column) for column in zip(*rows)]
+    mid = black_scholes_price(right, SPOT, strike, years_to_expiry(expiry, TIME), 0.2)
+    return ColumnarOptionChain(right, strike, expiry, np.maximum(mid - 0.1, 0.0), mid + 0.1,
+                               underlying_price=SPOT, symbol="SPY")
+
+
+def brute_force(chain, max_width, min_credit):
+    """
+    :return: set of (short call, long call, short put, long put) strikes and expiry of every condor
+    """
+    found = set()
+    for expiry in np.unique(chain.Expiry):
+        def listed(right):
+            return [i for i in range(len(chain.Right)) if chain.Right[i] == right and chain.Expiry[i] == expiry]
+        calls, puts = listed(OptionRight.CALL), listed(OptionRight.PUT)
+        for sc, lc, sp, lp in itertools.product(calls, calls, puts, puts):
+            strike = chain.Strike
+            if not (SPOT <= strike[sc] < strike[lc] <= strike[sc] + max_width):
+                continue
+            if not (SPOT >= strike[sp] > strike[lp] >= strike[sp] - max_width):
+                continue
+            credit = chain.BidPrice[sc] - chain.AskPrice[lc] + chain.BidPrice[sp] - chain.AskPrice[lp]
+            if credit > min_credit:
+                found.add((strike[sc], strike[lc], strike[sp], strike[lp], expiry))
+    return found
+
+
+class EnumerateCondorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = quoted_chain()
+        self.candidates = enumerate_condors(self.chain, TIME, max_width=MAX_WIDTH)
+
+    def test_matches_brute_force(self):
+        chain, candidates = self.chain, self.candidates
+        found = set(tuple(strikes) + (expiry,) for strikes, expiry in
+                    zip(candidates.Strikes.tolist(), candidates.Expiry))
+        self.assertEqual(len(found), len(candidates))
+        self.assertEqual(found, brute_force(chain, MAX_WIDTH, 0.0))
+        self.assertEqual(enumerate_condors(chain, TIME, max_width=MAX_WIDTH, min_credit=1.0).Legs.tolist(),
+                         candidates.Legs[candidates.Credit > 1.0].tolist())
+
+    def test_leg_order(self):
+        chain, candidates = self.chain, self.candidates
+        self.assertGreater(len(candidates), 0)
+        long_put, short_put = candidates.Strikes[:, 3], candidates.Strikes[:, 2]
+        short_call, long_call = candidates.Strikes[:, 0], candidates.Strikes[:, 1]
+        self.assertTrue((long_put < short_put).all())
+        self.assertTrue((short_put < short_call).all())
+        self.assertTrue((short_call < long_call).all())
+        rights = chain.Right[candidates.Legs]
+        self.assertTrue((rights == [OptionRight.CALL, OptionRight.CALL, OptionRight.PUT, OptionRight.PUT]).all())
+        self.assertTrue((chain.Expiry[candidates.Legs] == candidates.Expiry[:, None]).all())
+
+    def test_expiry_bounds(self):
+        later = enumerate_condors(self.chain, TIME, min_expiry=EXPIRIES[0], max_width=MAX_WIDTH)
+        self.assertTrue((later.Expiry == np.datetime64(EXPIRIES[1], 's')).all())
+        earlier = enumerate_condors(self.chain, TIME, max_expiry=EXPIRIES[0], max_width=MAX_WIDTH)
+        self.assertEqual(len(earlier) + len(later), len(self.candidates))
+        self.assertEqual(len(enumerate_condors(self.chain, TIME, min_expiry=EXPIRIES[1])), 0)
+
+    def test_risk_matches_payoff(self):
+        candidates = self.candidates
+        risk = risk_summary(Legs.FromChain(self.chain, candidates.Legs, [-1, 1, -1, 1]))
+        np.testing.assert_allclose(candidates.MaxLoss, -risk.MaxLoss)
+        np.testing.assert_allclose(candidates.MaxLoss,
+                                   candidates.Width * PortfolioClass.OPTION_MULTIPLIER -
+                                   candidates.Credit * PortfolioClass.OPTION_MULTIPLIER)
+        np.testing.assert_allclose(risk.MaxProfit, candidates.Credit * PortfolioClass.OPTION_MULTIPLIER)
+        both = ~np.isnan(candidates.LowerBreakeven) & ~np.isnan(candidates.UpperBreakeven)
+        np.testing.assert_allclose(risk.Breakevens[both, 0], candidates.LowerBreakeven[both])
+        np.testing.assert_allclose(risk.Breakevens[both, 1], candidates.UpperBreakeven[both])
+
+
+class RankCondorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.candidates = enumerate_condors(quoted_chain(), TIME, max_width=MAX_WIDTH)
+
+    def test_best_first_for_every_objective(self):
+        for name, objective in sorted(OBJECTIVES.items()):
+            ranked, scores = rank_condors(self.candidates, name)
+            self.assertEqual(len(ranked), len(self.candidates), name)
+            self.assertTrue((np.diff(scores) <= 0).all(), name)
+            np.testing.assert_allclose(objective(ranked), scores, err_msg=name)
+            np.testing.assert_allclose(scores[0], np.nanmax(objective(self.candidates)), err_msg=name)
+
+    def test_top_is_a_prefix_of_the_full_ranking(self):
+        scores = rank_condors(self.candidates, "expected_value")[1]
+        top, top_scores = rank_condors(self.candidates, "expected_value", top=5)
+        self.assertEqual(len(top), 5)
+        np.testing.assert_allclose(top_scores, scores[:5])
+        # rows tied on score may be taken in either order
+        np.testing.assert_allclose(OBJECTIVES["expected_value"](top), top_scores)
+
+    def test_nan_scores_rank_last(self):
+        candidates = self.candidates
+
+        def objective(c):
+            return np.where(np.arange(len(c)) % 2 == 0, np.nan, c.Credit)
+
+        ranked, scores = rank_condors(candidates, objective)
+        odd = len(candidates) // 2
+        self.assertTrue(np.isfinite(scores[:odd]).all())
+        self.assertTrue((scores[odd:] == -np.inf).all())
+        self.assertEqual(sorted(ranked.Credit[:odd].tolist()),
+                         sorted(candidates.Credit[1::2].tolist()))
+
+
+if __name__ == "__main__":
+    unittest.main()
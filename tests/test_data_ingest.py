@@ -0,0 +1,112 @@
+"""
+CSV parsing of data_ingest against float() of the same text.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bar_store import record_dtype
+from data_ingest import BARS, QUOTES, parse_block, read_batches
+from qc_interface import OptionRight
+
+HEADER = ["Time", "Open", "High", "Low", "Close", "Volume"]
+
+DECIMALS = ["1.5", "-1.5", "2000", "-2000", "0", "-0", "0.05", "-0.000001", "1972.0349", "+3.25",
+            ".5", "-.25", "5.", "123456789012345", "0.1234567890123456", "1e5", "-2.5E-3",
+            "1972.0349112356262", "007.50"]
+
+
+def bar_lines(values):
+    # one value per row, repeated across the price columns
+    return ["2015-10-05 09:{:02d}:00,{v},{v},{v},{v},{v}".format(i % 60, v=v) for i, v in enumerate(values)]
+
+
+def read_all(path, kind, chunk_bytes=1 << 22):
+    return np.concatenate(list(read_batches(path, kind, chunk_bytes)))
+
+
+class ParseBlockTest(unittest.TestCase):
+
+    def assertParsed(self, records, values):
+        expected = np.array([float(v) for v in values])
+        for name in HEADER[1:]:
+            column = records[name]
+            self.assertEqual(column.tolist(), expected.tolist(), name)
+            # -0 keeps its sign as float() does
+            self.assertEqual(np.signbit(column).tolist(), np.signbit(expected).tolist(), name)
+
+    def test_decimals_match_float(self):
+        block = ("\n".join(bar_lines(DECIMALS)) + "\n").encode("ascii")
+        records = parse_block(block, HEADER, record_dtype(BARS))
+        self.assertParsed(records, DECIMALS)
+        self.assertEqual(records.Time[1].tolist(), datetime(2015, 10, 5, 9, 1))
+
+    def test_random_decimals_match_float(self):
+        rng = np.random.RandomState(0)
+        values = ["{:.{}f}".format(x, places) for x, places in
+                  zip(rng.uniform(-1e6, 1e6, 20000), rng.randint(0, 9, 20000))]
+        block = ("\n".join(bar_lines(values)) + "\n").encode("ascii")
+        self.assertParsed(parse_block(block, HEADER, record_dtype(BARS)), values)
+
+    def test_padded_fields(self):
+        block = b" 2015-10-05 09:31:00 , -1.25 ,2,  3.5,4 , 0\n"
+        records = parse_block(block, HEADER, record_dtype(BARS))
+        self.assertEqual(records.Time[0].tolist(), datetime(2015, 10, 5, 9, 31))
+        self.assertEqual([records[name][0] for name in HEADER[1:]], [-1.25, 2.0, 3.5, 4.0, 0.0])
+
+    def test_malformed_block(self):
+        with self.assertRaises(ValueError):
+            parse_block(b"2015-10-05 09:31:00,1,2\n", HEADER, record_dtype(BARS))
+
+
+class ReadBatchesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        path = os.path.join(self.root, name)
+        with open(path, "wb") as f:
+            f.write(text.encode("ascii"))
+        return path
+
+    def test_crlf_and_no_trailing_newline(self):
+        path = self.write("SPY_bars.csv", "\r\n".join([",".join(HEADER)] + bar_lines(DECIMALS)))
+        records = read_all(path, BARS)
+        self.assertEqual(records["Close"].tolist(), [float(v) for v in DECIMALS])
+        self.assertEqual(len(records), len(DECIMALS))
+
+    def test_blocks_split_mid_line(self):
+        rng = np.random.RandomState(1)
+        values = ["{:.{}f}".format(x, places) for x, places in
+                  zip(rng.uniform(-100, 100, 3000), rng.randint(0, 5, 3000))]
+        path = self.write("SPY_bars.csv", "\n".join([",".join(HEADER)] + bar_lines(values)) + "\n\n")
+        records = read_all(path, BARS, chunk_bytes=1000)
+        self.assertEqual(records["Open"].tolist(), [float(v) for v in values])
+
+    def test_quotes(self):
+        path = self.write("SPY_quotes.csv", "Time,Right,Strike,Expiry,BidPrice,AskPrice,UnderlyingLastPrice\n"
+                                            "2015-10-05 09:31:00,C,1990,2015-10-16,-0.0,1.05,1972.25\n"
+                                            "2015-10-05 09:31:00,p,1980.5,2015-10-16 00:00:00,2,2.10,1972.25")
+        records = read_all(path, QUOTES)
+        self.assertEqual(records["Right"].tolist(), [OptionRight.CALL, OptionRight.PUT])
+        self.assertEqual(records["Strike"].tolist(), [1990.0, 1980.5])
+        self.assertEqual(records["Expiry"].tolist(), [datetime(2015, 10, 16)] * 2)
+        self.assertEqual(records["BidPrice"].tolist(), [-0.0, 2.0])
+        self.assertEqual(records["AskPrice"].tolist(), [1.05, 2.1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Strike and iron condor leg selection on a small ColumnarOptionChain.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from leg_selection import Side, first_common_expiry, select_iron_condor_legs, select_strikes
+from qc_interface import ColumnarOptionChain, OptionRight
+
+NEAR = datetime(2015, 10, 16)
+FAR = datetime(2015, 10, 23)
+STRIKES = [1950.0, 1960.0, 1970.0, 1980.0, 1990.0, 2000.0, 2010.0, 2020.0, 2030.0, 2040.0, 2050.0]
+# only calls are listed on FAR, at strikes in between those of NEAR
+FAR_STRIKES = [1995.0, 2005.0, 2015.0, 2025.0]
+
+
+def small_chain():
+    rows = [(right, NEAR, strike) for right in (OptionRight.CALL, OptionRight.PUT) for strike in STRIKES]
+    rows += [(OptionRight.CALL, FAR, strike) for strike in FAR_STRIKES]
+    # listed out of order, the chain sorts its columns
+    rows.reverse()
+    right, expiry, strike = [np.array(column) for column in zip(*rows)]
+    price = np.ones(len(rows))
+    return ColumnarOptionChain(right, strike, expiry, price, price, underlying_price=2000.0, symbol="SPY")
+
+
+class SelectStrikesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = small_chain()
+
+    def strikes(self, idx):
+        return [self.chain.Strike[i] if i >= 0 else None for i in idx]
+
+    def test_nearest_listed_strike_on_each_side(self):
+        targets = [1940.0, 1950.0, 2001.0, 2049.9, 2050.0, 2060.0]
+        above = select_strikes(self.chain, OptionRight.CALL, NEAR, targets, Side.AT_OR_ABOVE)
+        below = select_strikes(self.chain, OptionRight.CALL, NEAR, targets, Side.AT_OR_BELOW)
+        self.assertEqual(self.strikes(above), [1950.0, 1950.0, 2010.0, 2050.0, 2050.0, None])
+        self.assertEqual(self.strikes(below), [None, 1950.0, 2000.0, 2040.0, 2050.0, 2050.0])
+
+    def test_stays_within_the_expiry(self):
+        chain = self.chain
+        idx = select_strikes(chain, OptionRight.CALL, FAR, [2000.0, 2030.0], Side.AT_OR_ABOVE)
+        self.assertEqual(self.strikes(idx), [2005.0, None])
+        idx = select_strikes(chain, OptionRight.CALL, NEAR, 2012.0, Side.AT_OR_BELOW)
+        self.assertEqual(chain.Expiry[idx[0]], np.datetime64(NEAR, 's'))
+        self.assertEqual(chain.Right[idx[0]], OptionRight.CALL)
+        idx = select_strikes(chain, OptionRight.PUT, NEAR, 2012.0, Side.AT_OR_BELOW)
+        self.assertEqual(chain.Right[idx[0]], OptionRight.PUT)
+        self.assertEqual(self.strikes(idx), [2010.0])
+
+    def test_first_common_expiry(self):
+        chain = self.chain
+        self.assertEqual(first_common_expiry(chain, datetime(2015, 10, 5)), np.datetime64(NEAR, 's'))
+        # FAR lists no puts
+        self.assertIsNone(first_common_expiry(chain, NEAR))
+        self.assertEqual(first_common_expiry(chain, NEAR, rights=(OptionRight.CALL,)), np.datetime64(FAR, 's'))
+
+
+class SelectIronCondorLegsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = small_chain()
+
+    def condor(self, *targets):
+        """
+        :return: [[short call, long call, short put, long put]] strikes per row, None for a missing row
+        """
+        legs = select_iron_condor_legs(self.chain, NEAR, *targets)
+        self.assertEqual(legs.shape[1], 4)
+        rows = []
+        for row in legs:
+            if (row < 0).all():
+                rows.append(None)
+                continue
+            self.assertTrue((row >= 0).all())
+            self.assertEqual(self.chain.Right[row].tolist(), [OptionRight.CALL] * 2 + [OptionRight.PUT] * 2)
+            rows.append(self.chain.Strike[row].tolist())
+        return rows
+
+    def test_listed_targets(self):
+        self.assertEqual(self.condor(2010.0, 2030.0, 1990.0, 1970.0), [[2010.0, 2030.0, 1990.0, 1970.0]])
+
+    def test_targets_between_strikes_move_away_from_the_money(self):
+        self.assertEqual(self.condor(2002.0, 2024.0, 1998.0, 1976.0), [[2010.0, 2030.0, 1990.0, 1970.0]])
+
+    def test_long_legs_strictly_beyond_short_legs(self):
+        # a width narrower than the strike spacing lands both legs on one strike, the wing is widened
+        self.assertEqual(self.condor(2010.0, 2013.0, 1990.0, 1987.0), [[2010.0, 2020.0, 1990.0, 1980.0]])
+        self.assertEqual(self.condor(2010.0, 2010.0, 1990.0, 1990.0), [[2010.0, 2020.0, 1990.0, 1980.0]])
+
+    def test_width_the_chain_cannot_satisfy(self):
+        rows = self.condor(
+            np.array([2010.0, 2050.0, 2040.0, 2010.0, 2010.0, 2060.0]),
+            np.array([2030.0, 2060.0, 2070.0, 2030.0, 2030.0, 2070.0]),
+            np.array([1990.0, 1990.0, 1990.0, 1950.0, 1960.0, 1990.0]),
+            np.array([1970.0, 1970.0, 1970.0, 1940.0, 1930.0, 1970.0]))
+        # no call above the top strike for the long call, or for either call in the last row
+        self.assertEqual(rows[0], [2010.0, 2030.0, 1990.0, 1970.0])
+        self.assertIsNone(rows[1])
+        self.assertIsNone(rows[2])
+        # and no put below the bottom strike
+        self.assertIsNone(rows[3])
+        self.assertIsNone(rows[4])
+        self.assertIsNone(rows[5])
+
+    def test_scalar_and_array_targets_broadcast(self):
+        rows = self.condor(np.array([2000.0, 2010.0, 2020.0]), np.array([2020.0, 2030.0, 2040.0]), 1990.0, 1970.0)
+        self.assertEqual(rows, [[2000.0, 2020.0, 1990.0, 1970.0], [2010.0, 2030.0, 1990.0, 1970.0],
+                                [2020.0, 2040.0, 1990.0, 1970.0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+The live adapter fed by a ReplayServer trades as a backtest of the same data.
+Python 3 only, like live_feed.
+
+    python3 -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import live_adapter
+
+
+@unittest.skipIf(sys.version_info < live_adapter.REQUIRES, "live_adapter requires Python 3")
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.devnull = open(os.devnull, "w")
+
+    def tearDown(self):
+        self.devnull.close()
+
+    def test_replay_matches_backtest(self):
+        import asyncio
+        from backtest_runner import load_algorithm, run
+        spec = "iron_condor:IronCondorAlgorithm"
+        backtest, results = run(spec, log_stream=self.devnull)
+        algorithm = load_algorithm(spec)()
+        algorithm.SetLogStream(self.devnull)
+        loop = asyncio.new_event_loop()
+        try:
+            stats = loop.run_until_complete(live_adapter.replay(algorithm))
+        finally:
+            loop.close()
+        self.assertEqual(stats.slices, results["slices"])
+        self.assertEqual(algorithm.Time, backtest.Time)
+        self.assertAlmostEqual(algorithm.Portfolio.TotalPortfolioValue, results["portfolio_value"], places=6)
+        self.assertAlmostEqual(algorithm.Portfolio.TotalProfit, backtest.Portfolio.TotalProfit, places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
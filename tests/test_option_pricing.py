@@ -0,0 +1,118 @@
+"""
+Black Scholes prices, implied volatilities and greeks across strikes and expiries.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import unittest
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from option_pricing import black_scholes_price, chain_greeks, greeks, implied_vol, years_to_expiry
+from qc_interface import ColumnarOptionChain, OptionRight
+
+SPOT = 2000.0
+RATE = 0.02
+DIVIDEND = 0.01
+STRIKES = SPOT * np.linspace(0.7, 1.3, 25)
+YEARS = np.array([1.0, 7.0, 30.0, 91.0, 365.0]) / 365.0
+VOLS = np.array([0.1, 0.25, 0.6])
+
+
+def grid():
+    """
+    :return: right, strike, years, vol arrays of every combination
+    """
+    columns = np.meshgrid([OptionRight.PUT, OptionRight.CALL], STRIKES, YEARS, VOLS, indexing='ij')
+    return [column.ravel() for column in columns]
+
+
+class ImpliedVolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.right, self.strike, self.years, self.vol = grid()
+        self.price = black_scholes_price(self.right, SPOT, self.strike, self.years, self.vol, RATE, DIVIDEND)
+
+    def test_round_trip(self):
+        vol = implied_vol(self.right, self.price, SPOT, self.strike, self.years, RATE, DIVIDEND)
+        solved = ~np.isnan(vol)
+        repriced = black_scholes_price(self.right, SPOT, self.strike, self.years, vol, RATE, DIVIDEND)
+        np.testing.assert_allclose(repriced[solved], self.price[solved], atol=1e-5)
+        # wherever the price moves with volatility the volatility itself comes back
+        sensitive = greeks(self.right, SPOT, self.strike, self.years, self.vol, RATE, DIVIDEND).Vega > 1.0
+        self.assertGreater(sensitive.sum(), len(vol) // 2)
+        self.assertTrue(solved[sensitive].all())
+        np.testing.assert_allclose(vol[sensitive], self.vol[sensitive], atol=1e-5)
+
+    def test_broadcasts_against_scalars(self):
+        price = black_scholes_price(OptionRight.CALL, SPOT, STRIKES, 0.25, 0.2)
+        vol = implied_vol(OptionRight.CALL, price, SPOT, STRIKES, 0.25)
+        self.assertEqual(vol.shape, STRIKES.shape)
+        near = np.abs(STRIKES / SPOT - 1.0) < 0.15
+        np.testing.assert_allclose(vol[near], 0.2, atol=1e-5)
+
+    def test_outside_bounds_is_nan(self):
+        right = np.array([OptionRight.CALL, OptionRight.PUT, OptionRight.CALL, OptionRight.PUT, OptionRight.CALL])
+        strike = np.array([1900.0, 2100.0, 2000.0, 2000.0, 2100.0])
+        # below intrinsic, at intrinsic, above the underlying, above the strike, zero
+        price = np.array([99.0, 100.0, SPOT + 1.0, 2001.0, 0.0])
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            vol = implied_vol(right, price, SPOT, strike, 0.25)
+        self.assertTrue(np.isnan(vol).all())
+
+
+class GreeksTest(unittest.TestCase):
+
+    def test_delta_matches_finite_difference(self):
+        right, strike, years, vol = grid()
+        h = SPOT * 1e-4
+
+        def price(spot):
+            return black_scholes_price(right, spot, strike, years, vol, RATE, DIVIDEND)
+
+        delta = greeks(right, SPOT, strike, years, vol, RATE, DIVIDEND).Delta
+        np.testing.assert_allclose(delta, (price(SPOT + h) - price(SPOT - h)) / (2.0 * h), atol=1e-4)
+        # put call parity
+        calls = right == OptionRight.CALL
+        np.testing.assert_allclose(delta[calls] - delta[~calls], np.exp(-DIVIDEND * years[calls]), atol=1e-12)
+
+    def test_vega_matches_finite_difference(self):
+        right, strike, years, vol = grid()
+        h = 1e-4
+        vega = greeks(right, SPOT, strike, years, vol, RATE, DIVIDEND).Vega
+        bumped = [black_scholes_price(right, SPOT, strike, years, vol + d, RATE, DIVIDEND) for d in (h, -h)]
+        np.testing.assert_allclose(vega, (bumped[0] - bumped[1]) / (2.0 * h), atol=1e-2)
+
+
+class ChainGreeksTest(unittest.TestCase):
+
+    def test_expired_and_below_intrinsic_contracts_are_nan(self):
+        time = datetime(2015, 10, 19, 10, 0)
+        expired, live = datetime(2015, 10, 16), datetime(2015, 11, 20)
+        strike = np.array([1950.0, 2000.0, 2050.0] * 2)
+        expiry = np.array([expired] * 3 + [live] * 3)
+        right = np.full(len(strike), OptionRight.CALL)
+        years = years_to_expiry(expiry, time)
+        self.assertTrue((years > 0).all())
+        mid = black_scholes_price(right, SPOT, strike, years_to_expiry(np.array([live] * 6), time), 0.2)
+        # the live 1950 call quoted below its intrinsic value of 50
+        mid[3] = 45.0
+        chain = ColumnarOptionChain(right, strike, expiry, mid - 0.05, mid + 0.05, underlying_price=SPOT,
+                                    symbol="SPY")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            result = chain_greeks(chain, time)
+        nan = np.isnan(result.ImpliedVol)
+        self.assertEqual(nan.tolist(), [True, True, True, True, False, False])
+        self.assertEqual(np.isnan(result.Delta).tolist(), nan.tolist())
+        np.testing.assert_allclose(result.ImpliedVol[~nan], 0.2, atol=1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
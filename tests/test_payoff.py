@@ -0,0 +1,111 @@
+"""
+Expiry payoff and risk of iron condors and open ended positions against hand
+computed values.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payoff import Legs, expiry_payoff, risk_summary
+from qc_interface import OptionChain, OptionRight, PortfolioClass
+
+MakeSymbol = OptionChain.OptionChainValue.Option.MakeSymbol
+EXPIRY = datetime(2015, 10, 16)
+MULTIPLIER = PortfolioClass.OPTION_MULTIPLIER
+
+
+def condor(short_call, long_call, short_put, long_put, premiums):
+    """
+    :param premiums: (short call, long call, short put, long put) prices the legs opened at
+    :return: Legs of one short iron condor
+    """
+    legs = [(MakeSymbol("SPY", OptionRight.CALL, EXPIRY, short_call), -1),
+            (MakeSymbol("SPY", OptionRight.CALL, EXPIRY, long_call), 1),
+            (MakeSymbol("SPY", OptionRight.PUT, EXPIRY, short_put), -1),
+            (MakeSymbol("SPY", OptionRight.PUT, EXPIRY, long_put), 1)]
+    return Legs.FromOrders(legs, dict((symbol, price) for (symbol, _), price in zip(legs, premiums)))
+
+
+class IronCondorRiskTest(unittest.TestCase):
+
+    def test_symmetric_wings(self):
+        # credit 5 - 2 + 4 - 1.5 = 5.5 on 10 wide wings
+        legs = condor(2010.0, 2020.0, 1990.0, 1980.0, (5.0, 2.0, 4.0, 1.5))
+        risk = risk_summary(legs)
+        self.assertAlmostEqual(risk.MaxProfit[0], 5.5 * MULTIPLIER)
+        self.assertAlmostEqual(risk.MaxLoss[0], -(10.0 * MULTIPLIER - 5.5 * MULTIPLIER))
+        np.testing.assert_allclose(risk.Breakevens[0, :2], [1984.5, 2015.5])
+        self.assertTrue(np.isnan(risk.Breakevens[0, 2:]).all())
+        pnl = expiry_payoff(legs, [1900.0, 1980.0, 1984.5, 1990.0, 2000.0, 2010.0, 2015.5, 2020.0, 2100.0])
+        np.testing.assert_allclose(pnl[0], np.array([-4.5, -4.5, 0.0, 5.5, 5.5, 5.5, 0.0, -4.5, -4.5]) * MULTIPLIER,
+                                   atol=1e-9)
+
+    def test_uneven_wings_lose_the_wider_one(self):
+        # 10 wide calls, 20 wide puts, credit 3 - 1 + 4 - 1 = 5
+        legs = condor(2010.0, 2020.0, 1990.0, 1970.0, (3.0, 1.0, 4.0, 1.0))
+        risk = risk_summary(legs)
+        self.assertAlmostEqual(risk.MaxLoss[0], -(20.0 - 5.0) * MULTIPLIER)
+        self.assertAlmostEqual(risk.MaxProfit[0], 5.0 * MULTIPLIER)
+        np.testing.assert_allclose(risk.Breakevens[0, :2], [1985.0, 2015.0])
+        pnl = expiry_payoff(legs, [1960.0, 2030.0])
+        np.testing.assert_allclose(pnl[0], [-15.0 * MULTIPLIER, -5.0 * MULTIPLIER])
+
+    def test_credit_covering_a_wing_has_one_breakeven(self):
+        # credit 6 - 0.5 + 2 - 1 = 6.5 covers the 5 wide call wing
+        legs = condor(2010.0, 2015.0, 1990.0, 1980.0, (6.0, 0.5, 2.0, 1.0))
+        risk = risk_summary(legs)
+        self.assertAlmostEqual(risk.MaxLoss[0], -(10.0 - 6.5) * MULTIPLIER)
+        np.testing.assert_allclose(risk.Breakevens[0, :1], [1983.5])
+        self.assertTrue(np.isnan(risk.Breakevens[0, 1:]).all())
+        self.assertGreater(expiry_payoff(legs, [2100.0])[0, 0], 0.0)
+
+    def test_many_positions_match_a_price_grid(self):
+        rng = np.random.RandomState(0)
+        shorts = rng.choice(np.arange(1990.0, 2011.0, 5.0), (50, 2))
+        widths = rng.choice([5.0, 10.0, 15.0], (50, 2))
+        premiums = rng.uniform(0.5, 6.0, (50, 4))
+        positions = [condor(2000.0 + abs(c - 2000.0), 2000.0 + abs(c - 2000.0) + wc,
+                            2000.0 - abs(p - 2000.0), 2000.0 - abs(p - 2000.0) - wp, premium)
+                     for (c, p), (wc, wp), premium in zip(shorts, widths, premiums)]
+        legs = Legs(*[np.concatenate([getattr(position, name) for position in positions])
+                      for name in ('Right', 'Strike', 'Expiry', 'Quantity', 'Premium', 'Multiplier')])
+        risk = risk_summary(legs)
+        # every strike is a multiple of 5, so the grid holds every kink
+        pnl = expiry_payoff(legs, np.arange(1900.0, 2100.5, 0.5))
+        np.testing.assert_allclose(risk.MaxLoss, pnl.min(axis=1))
+        np.testing.assert_allclose(risk.MaxProfit, pnl.max(axis=1))
+        for i, breakevens in enumerate(risk.Breakevens):
+            breakevens = breakevens[~np.isnan(breakevens)]
+            np.testing.assert_allclose(expiry_payoff(legs, breakevens)[i], 0.0, atol=1e-6)
+
+
+class OpenEndedRiskTest(unittest.TestCase):
+
+    def test_short_call_loss_is_unbounded(self):
+        legs = Legs.FromOrders([(MakeSymbol("SPY", OptionRight.CALL, EXPIRY, 2010.0), -1)],
+                               {MakeSymbol("SPY", OptionRight.CALL, EXPIRY, 2010.0): 5.0})
+        risk = risk_summary(legs)
+        self.assertEqual(risk.MaxLoss[0], -np.inf)
+        self.assertAlmostEqual(risk.MaxProfit[0], 5.0 * MULTIPLIER)
+        np.testing.assert_allclose(risk.Breakevens[0, :1], [2015.0])
+
+    def test_covered_call(self):
+        call = MakeSymbol("SPY", OptionRight.CALL, EXPIRY, 2010.0)
+        # 100 shares bought at 2000, one call sold for 5
+        legs = Legs.FromOrders([("SPY", 100), (call, -1)], {"SPY": 2000.0, call: 5.0})
+        risk = risk_summary(legs)
+        self.assertAlmostEqual(risk.MaxProfit[0], 15.0 * MULTIPLIER)
+        self.assertAlmostEqual(risk.MaxLoss[0], -1995.0 * MULTIPLIER)
+        np.testing.assert_allclose(risk.Breakevens[0, :1], [1995.0])
+        np.testing.assert_allclose(expiry_payoff(legs, [1990.0, 2050.0])[0], [-500.0, 1500.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+PortfolioClass fills and settlement against hand computed cash and profits.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qc_interface import OptionChain, OptionRight, PortfolioClass, QCAlgorithm
+
+MakeSymbol = OptionChain.OptionChainValue.Option.MakeSymbol
+
+
+class PortfolioFillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.portfolio = PortfolioClass()
+        self.portfolio.SetCash(10000.0)
+
+    def assertBooks(self, cash, realized, unrealized, quantity=None):
+        portfolio = self.portfolio
+        self.assertAlmostEqual(portfolio.Cash, cash)
+        self.assertAlmostEqual(portfolio.TotalProfit, realized)
+        self.assertAlmostEqual(portfolio.TotalUnrealizedProfit, unrealized)
+        if quantity is not None:
+            self.assertEqual(portfolio["SPY"].Quantity, quantity)
+
+    def test_open_add_partial_close_and_flip(self):
+        portfolio = self.portfolio
+        portfolio.Fill("SPY", 10, 100.0)
+        self.assertBooks(9000.0, 0.0, 0.0, 10)
+        # average price (10 * 100 + 10 * 110) / 20 = 105, marked at 110
+        portfolio.Fill("SPY", 10, 110.0)
+        self.assertBooks(7900.0, 0.0, 100.0, 20)
+        # 5 closed 15 above the average, the other 15 marked at 120
+        portfolio.Fill("SPY", -5, 120.0)
+        self.assertBooks(8500.0, 75.0, 225.0, 15)
+        # 15 closed 5 below the average, then short 5 at 100
+        portfolio.Fill("SPY", -20, 100.0)
+        self.assertBooks(10500.0, 0.0, 0.0, -5)
+        portfolio.Mark("SPY", 90.0)
+        self.assertBooks(10500.0, 0.0, 50.0, -5)
+        self.assertAlmostEqual(portfolio.TotalPortfolioValue, 10050.0)
+        portfolio.Fill("SPY", 5, 90.0)
+        self.assertBooks(10050.0, 50.0, 0.0, 0)
+        self.assertFalse(portfolio.Invested)
+
+    def test_zero_fill_changes_nothing(self):
+        portfolio = self.portfolio
+        portfolio.Fill("SPY", 0, 100.0)
+        self.assertBooks(10000.0, 0.0, 0.0)
+        self.assertFalse(portfolio.Invested)
+        portfolio.Fill("SPY", 10, 100.0)
+        portfolio.Fill("SPY", 0, 150.0)
+        self.assertBooks(9000.0, 0.0, 0.0, 10)
+        self.assertAlmostEqual(portfolio.cost_basis, 1000.0)
+
+    def test_settle_expired(self):
+        portfolio = self.portfolio
+        expiry = datetime(2015, 10, 16)
+        short_call = MakeSymbol("SPY", OptionRight.CALL, expiry, 2000.0)
+        long_call = MakeSymbol("SPY", OptionRight.CALL, expiry, 2010.0)
+        portfolio.Fill(short_call, -1, 5.0)
+        portfolio.Fill(long_call, 1, 2.0)
+        self.assertBooks(10300.0, 0.0, 0.0)
+        portfolio.underlying_prices["SPY"] = 2004.0
+        # not expired on its expiry date
+        self.assertEqual(portfolio.SettleExpired(datetime(2015, 10, 16, 15, 59)), [])
+        settled = portfolio.SettleExpired(datetime(2015, 10, 19, 9, 31))
+        self.assertEqual(sorted(settled), sorted([(short_call, 1.0), (long_call, -1.0)]))
+        # short call bought back at its intrinsic 4, long call expires worthless
+        self.assertBooks(9900.0, -100.0, 0.0)
+        self.assertFalse(portfolio.Invested)
+
+
+class MarketOrderTest(unittest.TestCase):
+
+    def test_zero_quantity_is_not_submitted(self):
+        algorithm = QCAlgorithm()
+        algorithm.SetLogStream(LogStream())
+        algorithm.SetCash(10000.0)
+        self.assertIsNone(algorithm.MarketOrder("SPY", 0))
+        algorithm.CloseLogs()
+        self.assertIn("zero quantity", algorithm.log_stream.text)
+        self.assertEqual(algorithm.Portfolio.Cash, 10000.0)
+        self.assertNotIn("SPY", algorithm.Portfolio)
+
+
+class LogStream(object):
+
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text):
+        self.text += text
+
+    def flush(self):
+        pass
+
+
+if __name__ == "__main__":
+    unittest.main()
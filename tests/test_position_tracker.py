@@ -0,0 +1,125 @@
+"""
+PositionTracker structures closed leg by leg and the PositionScheduler of
+their close times.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from position_tracker import PositionScheduler, PositionTracker
+from qc_utils import dump_state, load_state
+
+EXPIRY = datetime(2015, 10, 16)
+CONDOR = [("SPY C2010", -2), ("SPY C2020", 2), ("SPY P1950", -2), ("SPY P1940", 2)]
+
+
+class CloseLegsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = PositionTracker()
+        self.structure_id = self.tracker.OpenStructure(CONDOR, EXPIRY)
+
+    def test_partial_close_keeps_the_open_legs(self):
+        tracker = self.tracker
+        # the call side filled, the put side did not
+        remaining = tracker.CloseLegs(self.structure_id, [("SPY C2010", 2), ("SPY C2020", -2)])
+        self.assertEqual(remaining, CONDOR[2:])
+        self.assertEqual(tracker.GetStructure(self.structure_id).legs, CONDOR[2:])
+        self.assertEqual(tracker.GetCurrPosition("SPY C2010"), 0)
+        self.assertEqual(tracker.GetCurrPosition("SPY P1950"), -2)
+        self.assertEqual(tracker.NumOpenLegs(), 2)
+        self.assertEqual(sorted(tracker.ToCloseOrders()), [("SPY P1940", -2), ("SPY P1950", 2)])
+        # the rest on a later session
+        self.assertEqual(tracker.CloseLegs(self.structure_id, [("SPY P1940", -2)]), [("SPY P1950", -2)])
+        self.assertEqual(tracker.CloseLegs(self.structure_id, [("SPY P1950", 2)]), [])
+        self.assertIsNone(tracker.GetStructure(self.structure_id))
+        self.assertEqual(tracker.NumOpenStructures(), 0)
+        self.assertTrue(tracker.IsFlat())
+
+    def test_nothing_filled(self):
+        self.assertEqual(self.tracker.CloseLegs(self.structure_id, []), CONDOR)
+        self.assertEqual(self.tracker.NumOpenLegs(), len(CONDOR))
+
+    def test_shared_contracts_net_across_structures(self):
+        tracker = self.tracker
+        # a second condor sharing the short call of the first
+        other = [("SPY C2010", -1), ("SPY C2030", 1), ("SPY P1950", -1), ("SPY P1930", 1)]
+        other_id = tracker.OpenStructure(other, EXPIRY)
+        self.assertEqual(tracker.GetCurrPosition("SPY C2010"), -3)
+        tracker.CloseLegs(self.structure_id, [("SPY C2010", 2), ("SPY P1950", 2)])
+        self.assertEqual(tracker.GetCurrPosition("SPY C2010"), -1)
+        self.assertEqual(tracker.GetCurrPosition("SPY P1950"), -1)
+        self.assertEqual(tracker.GetStructure(other_id).legs, other)
+        tracker.CloseStructure(other_id)
+        self.assertEqual(sorted(tracker.ToCloseOrders()), [("SPY C2020", -2), ("SPY P1940", -2)])
+
+    def test_state_round_trip_after_partial_close(self):
+        self.tracker.CloseLegs(self.structure_id, [("SPY C2010", 2)])
+        restored = PositionTracker()
+        restored.SetState(load_state(dump_state(self.tracker.GetState())))
+        structure = restored.GetStructure(self.structure_id)
+        self.assertEqual(structure.legs, CONDOR[1:])
+        self.assertEqual(structure.expiry, EXPIRY)
+        # legs come back as tuples, so the remaining ones can still be closed
+        self.assertEqual(restored.CloseLegs(self.structure_id, [("SPY C2020", -2), ("SPY P1950", 2)]),
+                         [("SPY P1940", 2)])
+        self.assertEqual(restored.ToCloseOrders(), [("SPY P1940", -2)])
+        self.assertEqual(restored.OpenStructure(CONDOR, EXPIRY), self.structure_id + 1)
+
+
+class PositionSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PositionScheduler()
+        self.close = [EXPIRY - timedelta(days=d) for d in (3, 2, 1)]
+
+    def test_same_close_time_pops_in_id_order(self):
+        scheduler = self.scheduler
+        for structure_id in (3, 1, 2):
+            scheduler.Schedule(structure_id, self.close[1])
+        scheduler.Schedule(4, self.close[2])
+        scheduler.Schedule(0, self.close[0])
+        self.assertEqual(scheduler.PopDue(self.close[0] - timedelta(minutes=1)), [])
+        self.assertEqual(scheduler.NextCloseTime(), self.close[0])
+        self.assertEqual(scheduler.PopDue(self.close[1]), [0, 1, 2, 3])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.PopDue(EXPIRY), [4])
+        self.assertIsNone(scheduler.NextCloseTime())
+
+    def test_cancelled_are_not_popped(self):
+        scheduler = self.scheduler
+        for structure_id, close_time in enumerate(self.close):
+            scheduler.Schedule(structure_id, close_time)
+        scheduler.Cancel(1)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.PopDue(self.close[1]), [0])
+        # the earliest entry left is the cancelled one
+        self.assertFalse(scheduler.HasDue(self.close[1]))
+        self.assertEqual(scheduler.NextCloseTime(), self.close[2])
+        scheduler.Cancel(0) # already popped
+        scheduler.Cancel(2)
+        self.assertEqual(scheduler.PopDue(EXPIRY), [])
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.heap, [])
+
+    def test_state_round_trip(self):
+        scheduler = self.scheduler
+        for structure_id, close_time in enumerate(self.close + [self.close[2]]):
+            scheduler.Schedule(structure_id, close_time)
+        scheduler.Cancel(2)
+        self.assertEqual(scheduler.PopDue(self.close[0]), [0])
+        restored = PositionScheduler()
+        restored.SetState(load_state(dump_state(scheduler.GetState())))
+        self.assertEqual(len(restored), 2)
+        self.assertEqual(restored.NextCloseTime(), self.close[1])
+        self.assertEqual(restored.PopDue(EXPIRY), [1, 3])
+        self.assertEqual(scheduler.PopDue(EXPIRY), [1, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+Rolling statistics against NumPy recomputed over the same window.
+
+    python -m pytest tests
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qc_utils import (SlidingWindow, SMA, RollingStatsBank, SessionExecutor, TradingCalendar, dump_state,
+                      load_state)
+
+# (price level, std of the stream), the last two stress the incremental update
+STREAMS = [(100.0, 1.0), (2000.0, 1e-4), (1e6, 1e-3)]
+NUM_UPDATES = 200000
+LOOKBACK = 14
+RTOL = 1e-6
+CHECK_EVERY = 997 # prime, so checks fall at every phase of the recompute cycle
+
+
+def stream(price, std, n=NUM_UPDATES, seed=0):
+    return price + np.random.RandomState(seed).normal(0.0, std, n)
+
+
+class SlidingWindowTest(unittest.TestCase):
+
+    def test_matches_numpy_over_long_streams(self):
+        for price, std in STREAMS:
+            x = stream(price, std)
+            window = SlidingWindow(LOOKBACK)
+            for i, value in enumerate(x):
+                window.update(value)
+                if i % CHECK_EVERY == 0 or i == len(x) - 1:
+                    expected = x[max(0, i - LOOKBACK + 1):i + 1]
+                    np.testing.assert_allclose(window.get_std(), np.std(expected), rtol=RTOL)
+                    if window.isFull():
+                        np.testing.assert_allclose(window.get_sma(), np.mean(expected), rtol=RTOL)
+                    self.assertEqual(window.to_list(), expected.tolist())
+
+    def test_sma_subclass(self):
+        x = stream(2000.0, 5.0, n=5000)
+        sma = SMA(LOOKBACK)
+        for i, value in enumerate(x):
+            sma.update(value)
+            if i < LOOKBACK - 1:
+                self.assertIsNone(sma.get_sma())
+        np.testing.assert_allclose(sma.get_sma(), np.mean(x[-LOOKBACK:]), rtol=RTOL)
+
+    def test_state_round_trip(self):
+        x = stream(2000.0, 1.0, n=1000)
+        window = SlidingWindow(LOOKBACK)
+        for value in x[:500]:
+            window.update(value)
+        restored = SlidingWindow(LOOKBACK)
+        restored.set_state(window.get_state())
+        for value in x[500:]:
+            window.update(value)
+            restored.update(value)
+        self.assertEqual(restored.get_std(), window.get_std())
+        self.assertEqual(restored.get_sma(), window.get_sma())
+
+
+class RollingStatsBankTest(unittest.TestCase):
+
+    def test_matches_numpy_over_long_streams(self):
+        x = np.stack([stream(price, std, seed=i) for i, (price, std) in enumerate(STREAMS)], axis=1)
+        symbols = ["S{}".format(i) for i in range(len(STREAMS))]
+        bank = RollingStatsBank(symbols, LOOKBACK)
+        for i, mids in enumerate(x):
+            stats = bank.update(mids)
+            if i % CHECK_EVERY == 0 or i == len(x) - 1:
+                expected = x[max(0, i - LOOKBACK + 1):i + 1]
+                np.testing.assert_allclose(stats.std, np.std(expected, axis=0), rtol=RTOL)
+                np.testing.assert_array_equal(stats.min, expected.min(axis=0))
+                np.testing.assert_array_equal(stats.max, expected.max(axis=0))
+                if bank.isFull():
+                    np.testing.assert_allclose(stats.sma, np.mean(expected, axis=0), rtol=RTOL)
+                for j, symbol in enumerate(symbols):
+                    self.assertEqual(bank.to_list(symbol), expected[:, j].tolist())
+
+    def test_matches_sliding_window(self):
+        x = stream(2000.0, 3.0, n=3000)
+        bank = RollingStatsBank(["SPY"], LOOKBACK)
+        window = SlidingWindow(LOOKBACK)
+        for value in x:
+            bank.update([value])
+            window.update(value)
+            np.testing.assert_allclose(bank.get_std("SPY"), window.get_std(), rtol=RTOL)
+
+
+# Monday 2018-01-01 is a holiday, the 6th and 7th a weekend
+HOLIDAYS = [datetime(2018, 1, 1)]
+SESSIONS = [datetime(2018, 1, d) for d in (2, 3, 4, 5, 8, 9, 10, 11, 12)]
+OFFSET = timedelta(minutes=15)
+
+
+class Clock(object):
+    """
+    Stands in for the QCAlgorithm, the executor only reads its Time
+    """
+
+    def __init__(self):
+        self.Time = None
+
+
+class SessionExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calendar = TradingCalendar(datetime(2018, 1, 1), datetime(2018, 1, 14), HOLIDAYS)
+        self.clock = Clock()
+        self.fired = []
+        self.executor = self.make_executor()
+
+    def make_executor(self):
+        return SessionExecutor(self.clock, lambda slice: self.fired.append(self.clock.Time), self.calendar, OFFSET)
+
+    def feed(self, times, executor=None):
+        for time in times:
+            self.clock.Time = time
+            (executor or self.executor)(None)
+
+    def minutes(self, day, start=timedelta(hours=9, minutes=30), end=timedelta(hours=16)):
+        return [day + start + timedelta(minutes=m) for m in range(int((end - start).total_seconds() // 60) + 1)]
+
+    def test_calendar_skips_weekends_and_holidays(self):
+        self.assertEqual(self.calendar.sessions, SESSIONS)
+        self.assertFalse(self.calendar.is_session(datetime(2018, 1, 6, 10, 0)))
+        self.assertTrue(self.calendar.is_session(datetime(2018, 1, 8, 10, 0)))
+        covering = TradingCalendar.covering(datetime(2018, 1, 8), datetime(2018, 1, 12), sessions_before=2,
+                                            holidays=HOLIDAYS)
+        self.assertEqual(covering.sessions[:3], [datetime(2018, 1, 4), datetime(2018, 1, 5), datetime(2018, 1, 8)])
+
+    def test_fires_once_per_session_at_offset(self):
+        day = datetime(2018, 1, 1)
+        while day <= datetime(2018, 1, 14):
+            self.feed(self.minutes(day, timedelta(hours=4), timedelta(hours=20)))
+            day += timedelta(days=1)
+        self.assertEqual(self.fired, [session + timedelta(hours=9, minutes=30) + OFFSET for session in SESSIONS])
+
+    def test_fires_on_first_slice_after_fire_time(self):
+        self.feed([datetime(2018, 1, 2, 11, 7), datetime(2018, 1, 2, 11, 8)])
+        # nothing in the session of the 3rd until after its close
+        self.feed([datetime(2018, 1, 3, 16, 30), datetime(2018, 1, 4, 9, 40), datetime(2018, 1, 4, 9, 50)])
+        self.assertEqual(self.fired, [datetime(2018, 1, 2, 11, 7), datetime(2018, 1, 4, 9, 50)])
+
+    def test_next_time_skips_weekends(self):
+        executor = self.executor
+        self.assertEqual(executor.next_time(datetime(2018, 1, 1, 10, 0)), datetime(2018, 1, 2, 9, 45))
+        self.assertEqual(executor.next_time(datetime(2018, 1, 2, 10, 0)), datetime(2018, 1, 2, 10, 0))
+        self.feed(self.minutes(datetime(2018, 1, 5)))
+        self.assertEqual(executor.next_time(datetime(2018, 1, 5, 12, 0)), datetime(2018, 1, 8, 9, 45))
+        self.assertEqual(executor.next_time(datetime(2018, 1, 6, 10, 0)), datetime(2018, 1, 8, 9, 45))
+        self.feed(self.minutes(datetime(2018, 1, 12)))
+        self.assertIsNone(executor.next_time(datetime(2018, 1, 12, 12, 0)))
+
+    def test_state_round_trip_does_not_refire(self):
+        self.feed(self.minutes(datetime(2018, 1, 3), end=timedelta(hours=10)))
+        self.assertEqual(self.fired, [datetime(2018, 1, 3, 9, 45)])
+        resumed = self.make_executor()
+        resumed.set_state(load_state(dump_state(self.executor.get_state())))
+        self.feed(self.minutes(datetime(2018, 1, 3), start=timedelta(hours=10)), resumed)
+        self.feed(self.minutes(datetime(2018, 1, 4)), resumed)
+        self.assertEqual(self.fired, [datetime(2018, 1, 3, 9, 45), datetime(2018, 1, 4, 9, 45)])
+        # and once every session has run
+        self.feed(self.minutes(datetime(2018, 1, 12)), resumed)
+        finished = self.make_executor()
+        finished.set_state(load_state(dump_state(resumed.get_state())))
+        self.assertIsNone(finished.next_time(datetime(2018, 1, 12, 12, 0)))
+
+
+if __name__ == "__main__":
+    unittest.main()
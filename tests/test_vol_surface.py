@@ -0,0 +1,103 @@
+"""
+ImpliedVolSurface caching, re-solving and eviction across chain snapshots.
+
+    python -m unittest discover -s tests
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qc_interface import ColumnarOptionChain, OptionRight
+from option_pricing import black_scholes_price, years_to_expiry
+from vol_surface import ImpliedVolSurface
+
+TIME = datetime(2018, 1, 2, 10, 0)
+EXPIRIES = [datetime(2018, 1, 5), datetime(2018, 1, 19)]
+STRIKES = np.arange(1960.0, 2041.0, 10.0)
+SPOT = 2000.0
+VOL = 0.2
+
+
+def quoted_chain(spot=SPOT, time=TIME, expiries=EXPIRIES, strikes=STRIKES, vols=None):
+    """
+    Both rights of every (expiry, strike), bid and ask 0.01 either side of the
+    Black Scholes price at VOL or vols[(expiry, strike)]
+    """
+    vols = vols or {}
+    rows = [(right, expiry, strike) for right in (OptionRight.PUT, OptionRight.CALL)
+            for expiry in expiries for strike in strikes]
+    right, expiry, strike = [np.array(column) for column in zip(*rows)]
+    vol = np.array([vols.get((e, k), VOL) for _, e, k in rows])
+    mid = black_scholes_price(right, spot, strike, years_to_expiry(expiry, time), vol)
+    return ColumnarOptionChain(right, strike, expiry, mid - 0.01, mid + 0.01, underlying_price=spot,
+                               symbol="SPY")
+
+
+class ImpliedVolSurfaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.surface = ImpliedVolSurface()
+        self.points = len(EXPIRIES) * len(STRIKES)
+
+    def test_first_update_solves_every_point(self):
+        vol = self.surface.Update(quoted_chain(), TIME)
+        self.assertEqual(self.surface.solved, self.points)
+        self.assertEqual(self.surface.reused, 0)
+        self.assertEqual(len(self.surface), self.points)
+        np.testing.assert_allclose(vol, VOL, atol=1e-4)
+
+    def test_unchanged_quotes_are_cache_hits(self):
+        first = self.surface.Update(quoted_chain(), TIME)
+        second = self.surface.Update(quoted_chain(), TIME + timedelta(minutes=1))
+        self.assertEqual(self.surface.solved, 0)
+        self.assertEqual(self.surface.reused, self.points)
+        np.testing.assert_array_equal(first, second)
+
+    def test_changed_quote_is_resolved(self):
+        self.surface.Update(quoted_chain(), TIME)
+        moved = (EXPIRIES[1], 2030.0)
+        chain = quoted_chain(vols={moved: 0.3})
+        vol = self.surface.Update(chain, TIME)
+        # the call is the out of the money contract at 2030, only its point moved
+        self.assertEqual(self.surface.solved, 1)
+        self.assertEqual(self.surface.reused, self.points - 1)
+        at_strike = (chain.Expiry == np.datetime64(moved[0], 's')) & (chain.Strike == moved[1])
+        self.assertEqual(at_strike.sum(), 2)
+        np.testing.assert_allclose(vol[at_strike], 0.3, atol=1e-4)
+        np.testing.assert_allclose(vol[~at_strike], VOL, atol=1e-4)
+
+    def test_underlying_move_resolves_everything(self):
+        self.surface.Update(quoted_chain(), TIME)
+        vol = self.surface.Update(quoted_chain(spot=SPOT * 1.01), TIME)
+        self.assertEqual(self.surface.solved, self.points)
+        np.testing.assert_allclose(vol, VOL, atol=1e-4)
+
+    def test_unlisted_points_are_evicted(self):
+        self.surface.Update(quoted_chain(), TIME)
+        self.surface.Update(quoted_chain(strikes=STRIKES[1:-1]), TIME)
+        self.assertEqual(len(self.surface), len(EXPIRIES) * (len(STRIKES) - 2))
+        dropped = self.surface.Lookup(np.array(EXPIRIES, dtype='datetime64[s]'), [STRIKES[0], STRIKES[-1]])
+        self.assertTrue(np.isnan(dropped).all())
+
+    def test_expired_points_are_evicted(self):
+        self.surface.Update(quoted_chain(), TIME)
+        # the first expiry settles at its close, 16:00
+        self.assertEqual(self.surface.Evict(datetime(2018, 1, 5, 15, 59)), 0)
+        self.assertEqual(self.surface.Evict(datetime(2018, 1, 5, 16, 0)), len(STRIKES))
+        self.assertEqual(len(self.surface), len(STRIKES))
+        self.assertTrue((self.surface.expiry == np.datetime64(EXPIRIES[1], 's')).all())
+        # an expired contract still listed in a snapshot gets no volatility
+        later = datetime(2018, 1, 8, 10, 0)
+        vol = self.surface.Update(quoted_chain(time=later), later)
+        expired = quoted_chain(time=later).Expiry == np.datetime64(EXPIRIES[0], 's')
+        self.assertTrue(np.isnan(vol[expired]).all())
+        self.assertFalse(np.isnan(vol[~expired]).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+from lazy_import import lazy_import
+from qc_interface import OptionRight
+from option_pricing import EXPIRY_OFFSET_SECONDS, implied_vol, years_to_expiry
+
+np = lazy_import("numpy", globals(), "np")
+
+
+# Strikes are keyed in thousandths, so a key is expiry seconds * KEY_SCALE + strike
+# in thousandths and fits an int64 for strikes below 1e6
+KEY_SCALE = 10 ** 9
+
+
+def surface_keys(expiry, strike):
+    """
+    :param expiry: datetime64 array
+    :param strike: float array
+    :return: int64 array, one key per (expiry, strike) ordered like the pairs
+    """
+    seconds = np.asarray(expiry, dtype='datetime64[s]').astype(np.int64)
+    return seconds * KEY_SCALE + np.round(np.asarray(strike) * 1000.0).astype(np.int64)
+
+
+class ImpliedVolSurface(object):
+    """
+    Implied volatility by (expiry, strike) carried across chain snapshots.
+    Between two snapshots only a few quotes change, so Update re-solves a point
+    only when its mid quote or the underlying has moved past a tolerance since
+    it was last solved, and reuses the cached volatility otherwise. Each point
+    is solved from its out of the money contract (puts below the underlying,
+    calls at or above), the better conditioned of the two. Points are evicted
+    when they expire or are no longer listed, E.g after falling outside the
+    SetFilter window as the underlying moves.
+    Entries are held in arrays sorted by key, so matching a snapshot against
+    the cache is one sorted intersection rather than a lookup per contract.
+    """
+
+    def __init__(self, price_tolerance=0.005, underlying_tolerance=0.0005, rate=0.0, dividend=0.0):
+        """
+        :param price_tolerance: change in mid quote that triggers a re-solve
+        :param underlying_tolerance: relative change in the underlying that triggers a re-solve
+        """
+        self.price_tolerance = price_tolerance
+        self.underlying_tolerance = underlying_tolerance
+        self.rate = rate
+        self.dividend = dividend
+        self.time = None
+        self.underlying_price = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.expiry = np.zeros(0, dtype='datetime64[s]')
+        self.strike = np.zeros(0)
+        self.mid = np.zeros(0) # quote each vol was solved from
+        self.spot = np.zeros(0) # underlying price each vol was solved at
+        self.vol = np.zeros(0) # NaN where the quote has no solution
+        self.solved = 0 # points solved by the last Update
+        self.reused = 0 # points served from the cache by the last Update
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _Keep(self, keep):
+        self.keys, self.expiry, self.strike = self.keys[keep], self.expiry[keep], self.strike[keep]
+        self.mid, self.spot, self.vol = self.mid[keep], self.spot[keep], self.vol[keep]
+
+    def Update(self, chain, time):
+        """
+        Brings the surface up to date with a chain snapshot
+        :param chain: ColumnarOptionChain
+        :param time: datetime the chain was quoted at
+        :return: float64 array of the volatility of every contract of chain, index
+                 i is chain.Contract(i). Calls and puts of a strike share its vol
+        """
+        spot = float(chain.UnderlyingLastPrice)
+        is_call = chain.Right == OptionRight.CALL
+        otm = np.flatnonzero(np.where(is_call, chain.Strike >= spot, chain.Strike < spot))
+        keys = surface_keys(chain.Expiry[otm], chain.Strike[otm])
+        order = np.argsort(keys, kind='mergesort')
+        otm, keys = otm[order], keys[order]
+        mid = 0.5 * (chain.BidPrice[otm] + chain.AskPrice[otm])
+
+        # carry over the points still listed whose inputs have not moved
+        vol = np.full(len(keys), np.nan)
+        stale = np.ones(len(keys), dtype=bool)
+        _, new_i, old_i = np.intersect1d(keys, self.keys, assume_unique=True, return_indices=True)
+        if len(new_i):
+            moved = (np.abs(mid[new_i] - self.mid[old_i]) > self.price_tolerance) | \
+                (np.abs(spot - self.spot[old_i]) > self.underlying_tolerance * self.spot[old_i])
+            stale[new_i] = moved
+            vol[new_i] = self.vol[old_i]
+        spots = np.full(len(keys), spot)
+        mids = mid.copy()
+        if len(new_i):
+            # reused points keep the inputs they were solved from, so drift is measured from there
+            spots[new_i[~moved]] = self.spot[old_i[~moved]]
+            mids[new_i[~moved]] = self.mid[old_i[~moved]]
+        resolve = np.flatnonzero(stale)
+        vol[resolve] = implied_vol(chain.Right[otm[resolve]], mid[resolve], spot, chain.Strike[otm[resolve]],
+                                   years_to_expiry(chain.Expiry[otm[resolve]], time), self.rate, self.dividend)
+        self.solved = len(resolve)
+        self.reused = len(keys) - len(resolve)
+
+        # unlisted points are dropped by replacing the cache with this snapshot's points
+        self.time = time
+        self.underlying_price = spot
+        self.keys, self.expiry, self.strike = keys, chain.Expiry[otm], chain.Strike[otm]
+        self.mid, self.spot, self.vol = mids, spots, vol
+        self.Evict(time)
+        return self.Lookup(chain.Expiry, chain.Strike)
+
+    def Lookup(self, expiry, strike):
+        """
+        :return: cached vols of exact (expiry, strike) points, NaN where not cached
+        """
+        keys = surface_keys(expiry, strike)
+        if not len(self.keys):
+            return np.full(keys.shape, np.nan)
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[idx] == keys, self.vol[idx], np.nan)
+
+    def Evict(self, time):
+        """
+        Drops expired points. Points no longer listed are dropped by Update, the
+        chains are already cut to the SetFilter window
+        :return: number of points evicted
+        """
+        size = len(self)
+        self._Keep(self.expiry + np.timedelta64(EXPIRY_OFFSET_SECONDS, 's') > np.datetime64(time, 's'))
+        return size - len(self)
+
+    def Vol(self, strike, expiry=None, years=None):
+        """
+        Interpolated volatility at any strike and tenor. Linear in strike along
+        each listed expiry, then linear in total variance (vol^2 * years) between
+        the two expiries around the tenor. Flat beyond the first and last strike
+        and expiry.
+        :param strike: float or array
+        :param expiry: datetime, datetime64 or array of them
+        :param years: float or array, tenor in years from the last Update, instead of expiry
+        :return: float64 array broadcast from strike and the tenor, NaN when the surface is empty
+        """
+        if years is None:
+            years = years_to_expiry(expiry, self.time)
+        strike, years = np.broadcast_arrays(np.asarray(strike, dtype=np.float64),
+                                            np.asarray(years, dtype=np.float64))
+        solved = ~np.isnan(self.vol)
+        expiries = np.unique(self.expiry[solved])
+        if not len(expiries):
+            return np.full(strike.shape, np.nan)
+        tenors = years_to_expiry(expiries, self.time)
+        # total variance of every query along every expiry, (expiries, queries)
+        variance = np.empty((len(expiries), strike.size))
+        for e, expiry_time in enumerate(expiries):
+            on_expiry = solved & (self.expiry == expiry_time)
+            smile = np.interp(strike.ravel(), self.strike[on_expiry], self.vol[on_expiry])
+            variance[e] = smile * smile * tenors[e]
+        t = np.clip(years.ravel(), tenors[0], tenors[-1])
+        upper = np.minimum(np.searchsorted(tenors, t), len(tenors) - 1)
+        lower = np.maximum(upper - 1, 0)
+        columns = np.arange(t.size)
+        span = tenors[upper] - tenors[lower]
+        weight = np.where(span > 0, (t - tenors[lower]) / np.where(span > 0, span, 1.0), 0.0)
+        total = (1.0 - weight) * variance[lower, columns] + weight * variance[upper, columns]
+        return np.sqrt(total / t).reshape(strike.shape)